@@ -0,0 +1,246 @@
+#:  -*- coding: utf-8 -*-
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from chanlun.backtesting.backtest import BackTest
+from chanlun.backtesting.base import Operation, Strategy
+from chanlun.backtesting.klines_share import SharedKlines
+
+"""
+多进程按时间同步回测（BackTest.run_parallel）与单进程回测（BackTest.run）的对比测试
+使用随机生成的共享K线数据（不需要数据库），对比两种方式的订单、持仓记录、资金与资产历史是否一致，以及运行时间
+策略在 on_bt_loop_start 中检查 bt.codes 是全部的代码，回调方法在固定的循环次数提前结束回测，两种方式的回调记录也需要一致
+"""
+
+market = "currency"
+code_nums = 12
+frequency = "30m"
+kline_nums = 1500
+start_datetime = "2023-01-05 00:00:00"
+end_datetime = "2023-02-10 00:00:00"
+max_workers = 3
+# 回调方法在第几次循环时返回 False，提前结束回测
+stop_loop_nums = 1200
+
+
+class MaStrategy(Strategy):
+    """
+    均线交叉策略，金叉开仓，死叉或跌破止损价平仓，过滤时只保留均线差值最大的几个信号
+    """
+
+    def __init__(self, use_filter: bool = False):
+        super().__init__()
+        self.use_filter = use_filter
+
+    def on_bt_loop_start(self, bt):
+        # 多进程中 bt.codes 如果只有分片的代码，会抛出异常，代码执行失败，回测结果与单进程不一致
+        if len(bt.codes) != code_nums:
+            raise Exception(f"on_bt_loop_start 中的代码数量错误：{len(bt.codes)}")
+
+    def is_filter_opts(self):
+        return self.use_filter
+
+    def filter_opts(self, opts, trader=None):
+        return sorted(opts, key=lambda _o: _o.info["score"], reverse=True)[:3]
+
+    def open(self, code, market_data, poss):
+        klines = market_data.klines(code, frequency)
+        if len(klines) < 30:
+            return []
+        c = klines["close"].values
+        ma5, ma20 = c[-5:].mean(), c[-20:].mean()
+        pre_ma5, pre_ma20 = c[-6:-1].mean(), c[-21:-1].mean()
+        key = str(klines.iloc[-1]["date"])
+        if pre_ma5 <= pre_ma20 and ma5 > ma20:
+            return [
+                Operation(
+                    code,
+                    "buy",
+                    "1buy",
+                    loss_price=c[-1] * 0.95,
+                    info={"score": float(ma5 - ma20)},
+                    msg="金叉",
+                    key=key,
+                    pos_rate=0.5,
+                )
+            ]
+        if len(poss) > 0 and ma5 > ma20 * 1.01:
+            return [
+                Operation(
+                    code,
+                    "buy",
+                    "1buy",
+                    info={"score": 0.0},
+                    msg="加仓",
+                    key="add" + key,
+                    pos_rate=0.5,
+                )
+            ]
+        return []
+
+    def close(self, code, mmd, pos, market_data):
+        klines = market_data.klines(code, frequency)
+        c = klines["close"].values
+        # 移动止损价格（修改持仓，不返回操作）
+        pos.loss_price = max(pos.loss_price or 0, c[-1] * 0.95)
+        if c[-1] < pos.loss_price * 1.001 or c[-5:].mean() < c[-20:].mean():
+            return Operation(
+                code, "sell", mmd, msg="死叉", key=str(klines.iloc[-1]["date"])
+            )
+        return None
+
+
+class LoopRecorder:
+    """
+    回测循环的回调方法，记录每次回调的时间、剩余的循环次数与资金，到达指定次数后返回 False 提前结束
+    """
+
+    def __init__(self, stop_nums: int):
+        self.stop_nums = stop_nums
+        self.records = []
+
+    def __call__(self, bt) -> bool:
+        self.records.append(
+            (
+                bt.datas.now_date,
+                len(bt.datas.loop_datetime_list[bt.next_frequency]),
+                bt.trader.balance,
+            )
+        )
+        return len(self.records) < self.stop_nums
+
+
+def make_shared_klines(bt: BackTest, path: str) -> SharedKlines:
+    """
+    生成所有代码的随机K线，写入共享K线数据，基准代码设置回测循环的开始位置
+    """
+    tz = bt.datas.ex.tz
+    dates = pd.date_range("2023-01-01", periods=kline_nums, freq="30min", tz=tz)
+    loop_start = int((dates < pd.Timestamp(start_datetime, tz=tz)).sum())
+    shared = SharedKlines.create(path)
+    for i, code in enumerate(bt.codes):
+        rng = np.random.RandomState(i)
+        close = 100 + np.cumsum(rng.randn(kline_nums))
+        klines = pd.DataFrame(
+            {
+                "code": code,
+                "date": dates,
+                "open": close + rng.rand(kline_nums) - 0.5,
+                "high": close + 1,
+                "low": close - 1,
+                "close": close,
+                "volume": 1000.0,
+            }
+        )
+        shared.write(
+            code, frequency, klines, loop_start if code == bt.base_code else None
+        )
+    shared.write_meta()
+    return shared
+
+
+def make_bt(mode: str, use_filter: bool, shared: SharedKlines = None) -> BackTest:
+    bt = BackTest(
+        {
+            "save_file": None,
+            "strategy": MaStrategy(use_filter),
+            "mode": mode,
+            "market": market,
+            "base_code": "C0",
+            "codes": [f"C{i}" for i in range(code_nums)],
+            "frequencys": [frequency],
+            "start_datetime": start_datetime,
+            "end_datetime": end_datetime,
+            "init_balance": 100000,
+            "fee_rate": 0.001,
+            "max_pos": 4,
+            "cl_config": {},
+            "is_stock": False,
+            "is_futures": False,
+        }
+    )
+    bt.datas.shared_klines = shared
+    return bt
+
+
+def bt_results(bt: BackTest, recorder: LoopRecorder) -> dict:
+    """
+    需要一致的回测结果
+    trade 模式下，订单、持仓与资产历史记录的时间是运行时的当前时间（资产历史同一秒的记录会覆盖），只比较时间无关的部分，
+    每次循环的资金在回调记录中比较
+    """
+    trader = bt.trader
+    history = trader.history if bt.mode == "signal" else None
+    return {
+        "balance": trader.balance,
+        "fee_total": trader.fee_total,
+        "orders": {
+            _c: [{_k: _v for _k, _v in _o.items() if _k != "datetime"} for _o in _os]
+            for _c, _os in trader.orders.items()
+        },
+        "positions": {
+            _c: [
+                (
+                    _p.open_uid,
+                    _p.amount,
+                    _p.balance,
+                    _p.profit,
+                    _p.profit_rate,
+                    _p.max_profit_rate,
+                    _p.max_loss_rate,
+                    _p.loss_price,
+                    len(_p.close_records),
+                )
+                for _p in _ps
+            ]
+            for _c, _ps in trader.positions_history.items()
+        },
+        "history": (
+            None
+            if history is None
+            else (
+                history.dts.tolist(),
+                history.balances.tolist(),
+                history.hold_profits.tolist(),
+            )
+        ),
+        "callback": recorder.records,
+    }
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        shared = make_shared_klines(make_bt("trade", False), tmp_dir)
+        for mode in ["signal", "trade"]:
+            for use_filter in [False, True]:
+                serial_bt = make_bt(mode, use_filter, shared)
+                serial_recorder = LoopRecorder(stop_loop_nums)
+                s_time = time.time()
+                serial_bt.run(frequency, loop_callback_fun=serial_recorder)
+                serial_time = time.time() - s_time
+
+                parallel_bt = make_bt(mode, use_filter, shared)
+                parallel_recorder = LoopRecorder(stop_loop_nums)
+                s_time = time.time()
+                parallel_bt.run_parallel(
+                    frequency,
+                    max_workers=max_workers,
+                    loop_callback_fun=parallel_recorder,
+                )
+                parallel_time = time.time() - s_time
+
+                serial_res = bt_results(serial_bt, serial_recorder)
+                parallel_res = bt_results(parallel_bt, parallel_recorder)
+                diff_keys = [
+                    _k for _k in serial_res.keys() if serial_res[_k] != parallel_res[_k]
+                ]
+                order_nums = sum([len(_os) for _os in serial_res["orders"].values()])
+                print(
+                    f"{mode} filter={use_filter} 订单数量：{order_nums} "
+                    f"回调次数：{len(serial_recorder.records)} "
+                    f"单进程：{serial_time:.2f}s 多进程：{parallel_time:.2f}s "
+                    f"{'结果一致' if len(diff_keys) == 0 else f'结果不一致：{diff_keys}'}"
+                )
@@ -0,0 +1,67 @@
+#:  -*- coding: utf-8 -*-
+import time
+
+import numpy as np
+import pandas as pd
+
+from chanlun import config
+from chanlun.db import db
+
+"""
+数据库K线写入/读取的性能测试，输出每秒处理的行数
+
+当前使用的数据库由 config.DB_TYPE 决定，分别设置为 sqlite 与 mysql 运行，即可对比两种数据库的速度
+测试数据写入到 a 市场的 TEST.BENCH 代码中，测试结束后会删除
+"""
+
+market = "a"
+code = "TEST.BENCH"
+frequency = "5m"
+nums = [1000, 10000, 100000]
+
+
+def make_klines(num: int) -> pd.DataFrame:
+    dates = pd.date_range("2014-01-01 09:35:00", periods=num, freq="5min")
+    close = np.random.rand(num) * 10 + 10
+    return pd.DataFrame(
+        {
+            "date": dates.tz_localize("Asia/Shanghai"),
+            "open": close - 0.1,
+            "high": close + 0.2,
+            "low": close - 0.2,
+            "close": close,
+            "volume": np.random.rand(num) * 10000,
+        }
+    )
+
+
+if __name__ == "__main__":
+    print(f"DB_TYPE : {config.DB_TYPE}")
+    for num in nums:
+        klines = make_klines(num)
+        db.klines_delete(market, code, frequency)
+
+        s_time = time.time()
+        db.klines_insert(market, code, frequency, klines)
+        insert_time = time.time() - s_time
+
+        # 已存在的数据，再次写入，走更新逻辑
+        klines["close"] = klines["close"] + 1
+        s_time = time.time()
+        db.klines_insert(market, code, frequency, klines)
+        upsert_time = time.time() - s_time
+
+        s_time = time.time()
+        read_klines = db.klines_query_columns(
+            market, code, frequency, limit=None, order="asc"
+        )
+        read_time = time.time() - s_time
+        assert len(read_klines) == num
+
+        print(
+            f"rows {num:>7} : insert {num / insert_time:>10.0f} rows/sec | "
+            f"upsert {num / upsert_time:>10.0f} rows/sec | "
+            f"read {num / read_time:>10.0f} rows/sec"
+        )
+
+    db.klines_delete(market, code, frequency)
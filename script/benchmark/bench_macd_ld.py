@@ -0,0 +1,99 @@
+#:  -*- coding: utf-8 -*-
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import talib
+
+from chanlun.cl_interface import query_macd_ld
+
+"""
+MACD 力度计算（query_macd_ld）的性能测试
+对比之前每次切片复制数据并用列表推导计算的方式，与当前使用前缀和与稀疏表查询的方式，并检查结果是否一致
+"""
+
+kline_nums = [1000, 10000, 50000]
+query_nums = 2000
+range_nums = 200
+
+
+class BenchCD:
+    """
+    只提供 MACD 指标的缠论数据对象
+    """
+
+    def __init__(self, nums: int):
+        close = np.cumsum(np.random.randn(nums)) + 1000
+        dif, dea, hist = talib.MACD(close)
+        self.idx = {"macd": {"dif": list(dif), "dea": list(dea), "hist": list(hist)}}
+
+    def get_idx(self):
+        return self.idx
+
+
+def query_macd_ld_old(cd, start_fx, end_fx):
+    """
+    之前的实现
+    """
+    dea = np.array(
+        cd.get_idx()["macd"]["dea"][start_fx.k.k_index : end_fx.k.k_index + 1]
+    )
+    dif = np.array(
+        cd.get_idx()["macd"]["dif"][start_fx.k.k_index : end_fx.k.k_index + 1]
+    )
+    hist = np.array(
+        cd.get_idx()["macd"]["hist"][start_fx.k.k_index : end_fx.k.k_index + 1]
+    )
+    if len(hist) == 0:
+        hist = np.array([0])
+    if len(dea) == 0:
+        dea = np.array([0])
+    if len(dif) == 0:
+        dif = np.array([0])
+
+    hist_abs = abs(hist)
+    hist_up = np.array([_i for _i in hist if _i > 0])
+    hist_down = np.array([_i for _i in hist if _i < 0])
+    return {
+        "dea": {"end": dea[-1], "max": np.max(dea), "min": np.min(dea)},
+        "dif": {"end": dif[-1], "max": np.max(dif), "min": np.min(dif)},
+        "hist": {
+            "sum": hist_abs.sum(),
+            "up_sum": hist_up.sum(),
+            "down_sum": abs(hist_down.sum()),
+            "max": np.max(hist),
+            "min": np.min(hist),
+            "end": hist[-1],
+        },
+    }
+
+
+def make_fx(k_index: int):
+    return SimpleNamespace(index=k_index, k=SimpleNamespace(k_index=k_index))
+
+
+if __name__ == "__main__":
+    for nums in kline_nums:
+        cd = BenchCD(nums)
+        starts = np.random.randint(0, nums - range_nums, query_nums)
+        fxs = [(make_fx(_s), make_fx(_s + range_nums)) for _s in starts]
+
+        s_time = time.time()
+        old_res = [query_macd_ld_old(cd, _s, _e) for _s, _e in fxs]
+        old_time = time.time() - s_time
+
+        s_time = time.time()
+        new_res = [query_macd_ld(cd, _s, _e) for _s, _e in fxs]
+        new_time = time.time() - s_time
+
+        for _o, _n in zip(old_res, new_res):
+            for _k in _o.keys():
+                for _kk in _o[_k].keys():
+                    np.testing.assert_allclose(
+                        _o[_k][_kk], _n[_k][_kk], rtol=1e-9, atol=1e-9
+                    )
+
+        print(
+            f"klines {nums:>6} : old {old_time / query_nums * 1e6:>8.1f} us/query | "
+            f"new {new_time / query_nums * 1e6:>8.1f} us/query"
+        )
@@ -0,0 +1,139 @@
+#:  -*- coding: utf-8 -*-
+import time
+
+import numpy as np
+import pandas as pd
+
+from chanlun.backtesting.signal_to_trade import SignalToTrade
+
+"""
+信号回测转换交易回测（SignalToTrade.run_bt）回放的性能测试
+对比之前每个时间点查询全部持仓、每次获取价格都对K线进行布尔过滤的方式，
+与当前按照开平仓时间建立索引、K线价格使用时间游标的方式，并检查结果是否一致
+"""
+
+code_nums = 50
+kline_nums = 5000
+pos_nums = 1000
+market = "a"
+
+
+def make_klines(code: str, dates: pd.DatetimeIndex) -> pd.DataFrame:
+    close = np.cumsum(np.random.randn(len(dates))) + 1000
+    return pd.DataFrame(
+        {
+            "code": code,
+            "date": dates,
+            "open": close + np.random.rand(len(dates)),
+            "close": close,
+            "high": close + 2,
+            "low": close - 2,
+        }
+    )
+
+
+def make_positions(codes: list, dates: pd.DatetimeIndex) -> pd.DataFrame:
+    open_idx = np.random.randint(0, len(dates) - 100, pos_nums)
+    close_idx = open_idx + np.random.randint(1, 100, pos_nums)
+    return pd.DataFrame(
+        {
+            "code": np.random.choice(codes, pos_nums),
+            "open_datetime": dates[open_idx],
+            "close_datetime": dates[close_idx],
+        }
+    )
+
+
+def get_price_old(st: SignalToTrade, code: str):
+    """
+    之前的实现
+    """
+    if st.market in ["us", "currency", "futures"]:
+        kline = st.cache_klines[code][st.cache_klines[code]["date"] < st.now_datetime]
+    else:
+        kline = st.cache_klines[code][st.cache_klines[code]["date"] <= st.now_datetime]
+    return {
+        "date": kline.iloc[-1]["date"],
+        "open": float(kline.iloc[-1]["open"]),
+        "close": float(kline.iloc[-1]["close"]),
+        "high": float(kline.iloc[-1]["high"]),
+        "low": float(kline.iloc[-1]["low"]),
+    }
+
+
+def replay_old(st: SignalToTrade, pos_df: pd.DataFrame, base_dates: list):
+    """
+    之前的实现：每个时间点查询开平仓，持仓的代码每次获取价格
+    """
+    res = []
+    hold_codes = {}
+    for _d in base_dates:
+        st.now_datetime = _d
+        trade_pos_codes = list(hold_codes.keys())
+        if len(trade_pos_codes) > 0:
+            close_poss = pos_df.query(
+                "code in @trade_pos_codes and close_datetime == @_d"
+            ).to_dict(orient="records")
+            for _p in close_poss:
+                hold_codes.pop(_p["code"], None)
+                res.append(("close", _p["code"], _d))
+        for _p in pos_df.query("open_datetime == @_d").to_dict(orient="records"):
+            if _p["code"] not in hold_codes.keys():
+                hold_codes[_p["code"]] = True
+                res.append(("open", _p["code"], _d))
+        for _code in hold_codes.keys():
+            res.append(("price", _code, get_price_old(st, _code)))
+    return res
+
+
+def replay_new(st: SignalToTrade, pos_df: pd.DataFrame, base_dates: list):
+    """
+    当前的实现：开平仓时间索引，K线价格时间游标
+    """
+    res = []
+    hold_codes = {}
+    open_events, close_events = st.position_events(pos_df)
+    for _d in base_dates:
+        st.now_datetime = _d
+        _d_key = pd.Timestamp(_d).value
+        trade_pos_codes = list(hold_codes.keys())
+        if len(trade_pos_codes) > 0:
+            close_poss = [
+                _p
+                for _p in close_events.get(_d_key, [])
+                if _p["code"] in trade_pos_codes
+            ]
+            for _p in close_poss:
+                hold_codes.pop(_p["code"], None)
+                res.append(("close", _p["code"], _d))
+        for _p in open_events.get(_d_key, []):
+            if _p["code"] not in hold_codes.keys():
+                hold_codes[_p["code"]] = True
+                res.append(("open", _p["code"], _d))
+        for _code in hold_codes.keys():
+            res.append(("price", _code, st.get_price(_code)))
+    return res
+
+
+if __name__ == "__main__":
+    dates = pd.date_range(
+        "2020-01-01 09:30:00", periods=kline_nums, freq="5min", tz="Asia/Shanghai"
+    )
+    codes = [f"SH.{600000 + _i}" for _i in range(code_nums)]
+    cache_klines = {_c: make_klines(_c, dates) for _c in codes}
+    pos_df = make_positions(codes, dates)
+    base_dates = dates.to_list()
+
+    results = {}
+    for _name, _fun in [("old", replay_old), ("new", replay_new)]:
+        st = SignalToTrade("bench", mode="trade")
+        st.market = market
+        st.cache_klines = cache_klines
+        s_time = time.time()
+        results[_name] = (_fun(st, pos_df, base_dates), time.time() - s_time)
+
+    assert results["old"][0] == results["new"][0]
+    print(
+        f"klines {kline_nums} codes {code_nums} positions {pos_nums} : "
+        f"old {results['old'][1]:.2f}s | new {results['new'][1]:.2f}s"
+    )
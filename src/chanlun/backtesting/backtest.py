@@ -5,8 +5,7 @@ import pickle
 import time
 import gc
 import traceback
-from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from multiprocessing import get_context
 
 import prettytable as pt
@@ -18,13 +17,32 @@ import pyfolio as pf
 from chanlun import cl
 from chanlun import kcharts, fun
 from chanlun.backtesting.backtest_klines import BackTestKlines
+from chanlun.backtesting.backtest_parallel import LockStepDatas, lock_step_worker
 from chanlun.backtesting.backtest_trader import BackTestTrader
 from chanlun.backtesting.base import POSITION, Strategy
+from chanlun.backtesting.klines_share import SharedKlines
+from chanlun.backtesting.metrics import (
+    MMD_NAMES,
+    backtest_metrics,
+    balance_metrics,
+    day_balances,
+    mmd_metrics,
+)
+from chanlun.backtesting.results_store import (
+    BackTestResults,
+    ResultsTrader,
+    results_exists,
+    results_path,
+)
 from chanlun.backtesting.klines_generator import KlinesGenerator
-from chanlun.backtesting.optimize import OptimizationSetting
-from chanlun.backtesting.klines_generator import KlinesGenerator
-from chanlun.backtesting.optimize import OptimizationSetting
+from chanlun.backtesting.optimize import (
+    EarlyStopping,
+    GridSearch,
+    OptimizationSearch,
+    OptimizationSetting,
+)
 from chanlun.cl_interface import *
+from chanlun.config import get_data_path
 from chanlun.exchange.exchange import (
     convert_stock_kline_frequency,
     convert_currency_kline_frequency,
@@ -119,6 +137,7 @@ class BackTest:
     def save(self):
         """
         保存回测结果到配置的文件中
+        结果保存在 save_file 对应的结果存储目录中（xxx.pkl 保存到 xxx.bt 目录），见 results_store 模块
         """
         if self.save_file is None:
             return
@@ -126,7 +145,17 @@ class BackTest:
         if self.strategy is not None:
             self.strategy.clear()
 
-        save_dict = {
+        # 保存策略结果，进行页面查看
+        self.log.info(f"save to : {results_path(self.save_file)}")
+        BackTestResults.from_trader(
+            self.trader, self._save_config(), self.strategy
+        ).save(self.save_file)
+
+    def _save_config(self) -> dict:
+        """
+        保存的回测配置
+        """
+        return {
             "save_file": self.save_file,
             "mode": self.mode,
             "market": self.market,
@@ -141,21 +170,24 @@ class BackTest:
             "cl_config": self.cl_config,
             "is_stock": self.is_stock,
             "is_futures": self.is_futures,
-            "strategy": self.strategy,
-            "trader": self.trader,
             "next_frequency": self.next_frequency,
         }
-        # 保存策略结果到 file 中，进行页面查看
-        self.log.info(f"save to : {self.save_file}")
-        with open(file=self.save_file, mode="wb") as file:
-            pickle.dump(save_dict, file)
 
     def load(self, _file: str):
         """
         从指定的文件中恢复回测结果
+        优先读取结果存储目录（历史持仓、订单、资金历史在使用时才读取），不存在则读取之前版本保存的 pkl 文件
         """
-        with open(file=_file, mode="rb") as fp:
-            config_dict = pickle.load(fp)
+        if (results_path(_file) / "meta.json").is_file():
+            results = BackTestResults.load(_file)
+            config_dict = {
+                **results.meta["config"],
+                "strategy": results.state["strategy"],
+                "trader": ResultsTrader(results),
+            }
+        else:
+            with open(file=_file, mode="rb") as fp:
+                config_dict = pickle.load(fp)
         self.save_file = config_dict["save_file"]
         self.mode = config_dict["mode"]
         self.market = config_dict["market"]
@@ -258,8 +290,9 @@ class BackTest:
             except Exception as e:
                 self.log.error(f"执行 {code} 操作二次过滤 : {self.datas.now_date} 异常")
                 self.log.error(traceback.format_exc())
-            if loop_callback_fun:
-                loop_callback_fun(self)
+            if loop_callback_fun and loop_callback_fun(self) is False:
+                # 回调方法返回 False，提前结束回测
+                break
 
         # 清空持仓
         self.trader.end()
@@ -281,7 +314,7 @@ class BackTest:
             + "_process_.pkl"
         )
         # 默认如果之前的回测文件还有保存，可以直接返回，如果设置 重新运行，则不返回
-        if self._process_re_again is False and Path(new_file).exists():
+        if self._process_re_again is False and results_exists(new_file):
             return new_file
 
         self.save_file = new_file
@@ -296,10 +329,15 @@ class BackTest:
         return self.save_file
 
     def run_process(
-        self, next_frequency: str = None, max_workers: int = None, re_again=False
+        self,
+        next_frequency: str = None,
+        max_workers: int = None,
+        re_again=False,
+        shared_klines: bool = True,
     ):
         """
         多进程执行回测模式
+        @param shared_klines: 是否将K线数据写入共享的内存映射文件，子进程直接读取，不再各自从数据库读取
         """
         if self.mode != "signal":
             raise Exception(f"多进程回测，不支持 {self.mode} 回测模式")
@@ -310,59 +348,286 @@ class BackTest:
 
         self._process_re_again = re_again
 
+        if shared_klines:
+            self.build_shared_klines(next_frequency)
+
         start = time.time()
-        with ProcessPoolExecutor(
-            max_workers, mp_context=get_context("spawn")
-        ) as executor:
-            results = list(executor.map(self.run_by_code, self.codes))
-            end = time.time()
-            cost: int = int(end - start)
-            self.log.info(f"多进程回测完成，耗时{cost}秒")
-
-            # 记录 资金变动历史
-            balance_history = {}
-            # 回测结果合并
-            for f in tqdm(results, desc="结果汇总"):
-                BT = BackTest()
-                BT.load(f)
-                # 汇总结果
-                for mmd, res in BT.trader.results.items():
-                    for _k, _v in res.items():
-                        self.trader.results[mmd][_k] += _v
-                # 历史持仓合并
-                for _code, _poss in BT.trader.positions_history.items():
-                    self.trader.positions_history[_code] = _poss
-                # 持仓盈亏合并
-                for _dt, _hold_profits in BT.trader.hold_profit_history.items():
-                    if _dt not in self.trader.hold_profit_history.keys():
-                        self.trader.hold_profit_history[_dt] = 0
-                    self.trader.hold_profit_history[_dt] += _hold_profits
-                # 合并订单记录
-                for _code, _orders in BT.trader.orders.items():
-                    self.trader.orders[_code] = _orders
-                # 资金历史记录
-                balance_history[BT.base_code] = BT.trader.balance_history
-                # 手续费合并
-                self.trader.fee_total += BT.trader.fee_total
-
-                # 释放内存
-                del BT
+        try:
+            with ProcessPoolExecutor(
+                max_workers, mp_context=get_context("spawn")
+            ) as executor:
+                results = list(executor.map(self.run_by_code, self.codes))
+                end = time.time()
+                cost: int = int(end - start)
+                self.log.info(f"多进程回测完成，耗时{cost}秒")
+
+                # 回测结果合并，按照表格直接拼接，不需要加载每个代码的持仓对象
+                parts = [
+                    BackTestResults.load(f) for f in tqdm(results, desc="结果汇总")
+                ]
+                merged = BackTestResults.merge(
+                    parts, self.trader, self._save_config(), self.strategy
+                )
+                self.trader = ResultsTrader(merged)
+                del parts
                 gc.collect()
+                self.log.info("合并回测结果完成，可调用 save 方法进行保存")
+        finally:
+            self.clear_shared_klines()
+        return True
 
-            # 整理并汇总资金变动历史
-            bh_df = pd.DataFrame(balance_history.values())
-            bh_df = bh_df.T.sort_index().fillna(method="ffill").fillna(0)
-            self.trader.balance_history = bh_df.sum(axis=1)
-            self.log.info("合并回测结果完成，可调用 save 方法进行保存")
+    def build_shared_klines(self, next_frequency: str = None) -> SharedKlines:
+        """
+        将回测代码所有周期的K线数据，写入共享的内存映射文件（每个代码周期只读取一次数据库）
+        多进程回测与参数优化的子进程，以只读的方式映射使用，不再各自从数据库读取与保存一份数据
+        """
+        if next_frequency is None:
+            next_frequency = self.frequencys[-1]
+        codes = list(dict.fromkeys([self.base_code] + list(self.codes)))
+        key = f"{self.market}_{codes}_{self.frequencys}_{self.start_datetime}_{self.end_datetime}"
+        key = hashlib.md5(key.encode(encoding="UTF-8")).hexdigest()
+        path = get_data_path() / "backtest_klines_share" / f"{key}_{os.getpid()}"
+        self.log.info(f"写入共享K线数据：{path}")
+        return self.datas.build_shared_klines(path, codes, codes, next_frequency)
+
+    def clear_shared_klines(self):
+        """
+        删除共享的K线数据文件
+        """
+        if self.datas.shared_klines is not None:
+            self.datas.shared_klines.remove()
+            self.datas.shared_klines = None
         return True
 
-    def run_params(self, new_cl_setting: dict):
+    def _bt_config(self) -> dict:
+        """
+        当前回测的配置，用于在子进程中创建相同配置的回测对象
+        """
+        return {
+            "save_file": None,
+            "strategy": self.strategy,
+            "mode": self.mode,
+            "market": self.market,
+            "base_code": self.base_code,
+            "codes": self.codes,
+            "frequencys": self.frequencys,
+            "start_datetime": self.start_datetime,
+            "end_datetime": self.end_datetime,
+            "is_stock": self.is_stock,
+            "is_futures": self.is_futures,
+            "init_balance": self.init_balance,
+            "fee_rate": self.fee_rate,
+            "max_pos": self.max_pos,
+            "cl_config": self.cl_config,
+        }
+
+    def run_parallel(
+        self,
+        next_frequency: str = None,
+        max_workers: int = None,
+        loop_callback_fun: object = None,
+    ):
+        """
+        多进程按时间同步执行回测，支持 trade 与 signal 模式
+
+        回测代码分片到多个进程中，每个进程计算自己代码的缠论数据与策略信号，每个时间点所有进程同步执行
+        主进程汇总信号后按照代码顺序执行交易，资金、max_pos、filter_opts 的处理与 run 方法相同，回测结果与 run 一致
+        设置了共享K线数据（build_shared_klines），子进程直接读取共享数据
+
+        注意事项：
+            每个进程中是独立的策略对象，策略中不要保存跨代码的状态
+            on_bt_loop_start 在子进程中执行，bt.codes 是全部的代码，bt.trader 中只有当前进程代码的持仓
+            filter_opts 与 loop_callback_fun 在主进程中执行，bt.datas 只有当前时间、回测循环日期与 trader.get_price 获取的价格
+
+        @param next_frequency: 回测每次循环的周期
+        @param max_workers: 进程数量，默认为 CPU 数量
+        @param loop_callback_fun: 每次循环的回调方法（与 run 方法相同），返回 False 则提前结束回测
+        """
+        if next_frequency is None:
+            next_frequency = self.frequencys[-1]
+        self.next_frequency = next_frequency
+
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        max_workers = max(1, min(max_workers, len(self.codes)))
+
+        run_options = {
+            "load_data_to_cache": self.load_data_to_cache,
+            "begin_run_dt": self.trader.begin_run_dt,
+            "allow_mmds": self.trader.allow_mmds,
+            "shared_klines": self.datas.shared_klines,
+        }
+        ctx = get_context("spawn")
+        workers = []
+        for i in range(max_workers):
+            shard_codes = self.codes[i::max_workers]
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(
+                target=lock_step_worker,
+                args=(
+                    child_conn,
+                    self._bt_config(),
+                    next_frequency,
+                    dict(run_options, run_codes=shard_codes),
+                ),
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            workers.append((process, parent_conn, set(shard_codes)))
+
+        datas = LockStepDatas(self.market, self.frequencys, self.cl_config)
+        self.trader.set_data(datas)
+        # 回测过程中，主进程的 bt.datas 使用汇总的行情数据（给 loop_callback_fun 使用），结束后恢复
+        bt_datas = self.datas
+        self.datas = datas
+
+        _st = time.time()
+        bar = tqdm(desc=f"Run {self.base_code}")
+        try:
+            for _, _conn, _ in workers:
+                status, msg = _conn.recv()
+                if status == "error":
+                    raise Exception(f"回测进程初始化异常：{msg}")
+                # 所有进程的回测循环日期相同（基准代码的K线日期）
+                datas.loop_datetime_list = {next_frequency: msg}
+            bar.total = len(datas.loop_datetime_list[next_frequency])
+            bar.refresh()
+
+            while True:
+                hold_poss = [
+                    (_uid, _p)
+                    for _uid, _p in self.trader.positions.items()
+                    if _p.balance != 0
+                ]
+                for _, _conn, _codes in workers:
+                    _conn.send(
+                        (
+                            "step",
+                            (
+                                [(_u, _p) for _u, _p in hold_poss if _p.code in _codes],
+                                self.trader.balance,
+                            ),
+                        )
+                    )
+                step_results = [_conn.recv() for _, _conn, _ in workers]
+                if any([_status == "done" for _status, _ in step_results]):
+                    break
+
+                code_results = {}
+                for _, (_now_date, _prices, _results) in step_results:
+                    datas.now_date = _now_date
+                    datas.prices.update(_prices)
+                    code_results.update(_results)
+                loop_dates = datas.loop_datetime_list[next_frequency]
+                while len(loop_dates) > 0 and loop_dates[0] <= datas.now_date:
+                    loop_dates.pop(0)
+                bar.update(1)
+
+                # 更新持仓盈亏与资金变化
+                try:
+                    self.trader.update_position_record()
+                except Exception:
+                    self.log.error(f"执行记录持仓信息 : {datas.now_date} 异常")
+                    self.log.error(traceback.format_exc())
+
+                is_filter = self.strategy.is_filter_opts()
+                for code in self.codes:
+                    if code not in code_results.keys():
+                        continue
+                    try:
+                        self._run_lock_step_code(code, code_results[code], is_filter)
+                    except Exception:
+                        self.log.error(f"执行 {code} : {datas.now_date} 异常")
+                        self.log.error(traceback.format_exc())
+                try:
+                    # 如果有开启操作二次过滤，则调用一下进行执行
+                    self.trader.buffer_opts = self.strategy.filter_opts(
+                        self.trader.buffer_opts, self.trader
+                    )
+                    self.trader.run_buffer_opts()
+                except Exception:
+                    self.log.error(f"执行操作二次过滤 : {datas.now_date} 异常")
+                    self.log.error(traceback.format_exc())
+                if loop_callback_fun and loop_callback_fun(self) is False:
+                    # 回调方法返回 False，提前结束回测
+                    break
+        finally:
+            bar.close()
+            self.datas = bt_datas
+            for _process, _conn, _ in workers:
+                try:
+                    _conn.send(("end", None))
+                    _status, _infos = _conn.recv()
+                    for _k, _v in _infos["trader_use_times"].items():
+                        self.trader.add_times(_k, _v)
+                    for _k, _v in _infos["strategy_use_times"].items():
+                        self.strategy.add_times(_k, _v)
+                    for _k, _v in _infos.get("strategy_use_counts", {}).items():
+                        self.strategy.add_counts(_k, _v)
+                except Exception:
+                    pass
+                _process.join(timeout=10)
+                if _process.is_alive():
+                    _process.terminate()
+
+        # 清空持仓
+        self.trader.end()
+        self.trader.datas = None
+        # 调用策略的清理方法
+        self.strategy.clear()
+        _et = time.time()
+
+        self.log.info(f"多进程运行完成，执行时间：{_et - _st}")
+        return True
+
+    def _run_lock_step_code(self, code: str, result: dict, is_filter: bool):
+        """
+        在主进程中，按照子进程的执行结果，执行代码的交易（与 trader.run 的过程一致）
+        """
+        # 重放 close 方法返回的操作（平仓或加仓），持仓第一次执行时使用子进程中执行前的状态（包括策略中对持仓的修改）
+        # 之后的执行与执行后的结果以主进程为准（子进程只有分片的持仓，加仓的金额与主进程可能不同）
+        replay_uids = set()
+        for _uid, _opt, _pos in result["executes"]:
+            if _uid is not None:
+                if _uid in replay_uids:
+                    _pos = self.trader.positions[_uid]
+                else:
+                    self.trader.positions[_uid] = _pos
+                    replay_uids.add(_uid)
+            self.trader.execute(code, _opt, _pos)
+        # 没有执行操作的持仓，更新为子进程中的状态（策略中对持仓的修改）
+        for _uid, _pos in result["poss"]:
+            if _uid not in replay_uids:
+                self.trader.positions[_uid] = _pos
+        if result["error"]:
+            return True
+        for _opt in result["opens"]:
+            if is_filter:
+                self.trader.buffer_opts.append(_opt)
+            else:
+                self.trader.execute(code, _opt, None)
+        # 只保留有资金的持仓
+        self.trader.positions = {
+            _uid: _p for _uid, _p in self.trader.positions.items() if _p.balance != 0
+        }
+        return True
+
+    def run_params(
+        self,
+        new_cl_setting: dict,
+        window: float = 1,
+        early_stopping: EarlyStopping = None,
+    ):
         """
         参数优化，执行不同的参数配置
+        @param new_cl_setting: 缠论的参数配置
+        @param window: 回测区间的比例（从开始时间起），1 为完整的回测区间
+        @param early_stopping: 提前停止明显较差参数的回调对象，提前停止的回测不保存落地文件
 
-        注意事项：如果有修改过 Strategy 策略文件，并需要重新进行参数优化的，需要手动将 notebook/data/bk/_optimization_*.pkl 文件删除
-        注意事项：如果有修改过 Strategy 策略文件，并需要重新进行参数优化的，需要手动将 notebook/data/bk/_optimization_*.pkl 文件删除
-        注意事项：如果有修改过 Strategy 策略文件，并需要重新进行参数优化的，需要手动将 notebook/data/bk/_optimization_*.pkl 文件删除
+        注意事项：如果有修改过 Strategy 策略文件，并需要重新进行参数优化的，需要手动将 notebook/data/bk/_optimization_*.bt 目录删除
+        注意事项：如果有修改过 Strategy 策略文件，并需要重新进行参数优化的，需要手动将 notebook/data/bk/_optimization_*.bt 目录删除
+        注意事项：如果有修改过 Strategy 策略文件，并需要重新进行参数优化的，需要手动将 notebook/data/bk/_optimization_*.bt 目录删除
 
         """
         copy_cl_config = copy.deepcopy(self.cl_config)
@@ -372,7 +637,8 @@ class BackTest:
             else:
                 copy_cl_config[k] = v
         # 生成一个唯一的key，用于避免重复执行相同配置的回测
-        key = f"{self.base_code}_{self.market}_{self.codes}_{self.frequencys}_{self.start_datetime}_{self.end_datetime}_{type(self.strategy)}_{copy_cl_config}"
+        end_datetime = self._window_end_datetime(window)
+        key = f"{self.base_code}_{self.market}_{self.codes}_{self.frequencys}_{self.start_datetime}_{end_datetime}_{type(self.strategy)}_{copy_cl_config}"
         key = hashlib.md5(key.encode(encoding="UTF-8")).hexdigest()
         # 保存到新的文件中，进行落地
         new_save_file = f"./data/bk/_optimization_{key}.pkl"
@@ -395,7 +661,7 @@ class BackTest:
                 # 回测开始的时间
                 "start_datetime": self.start_datetime,
                 # 回测的结束时间
-                "end_datetime": self.end_datetime,
+                "end_datetime": end_datetime,
                 # 是否是股票，True 当日开仓不可平仓，False 当日开当日可平
                 "is_stock": self.is_stock,
                 # 是否是期货，True 可做空，False 不可做空
@@ -412,26 +678,41 @@ class BackTest:
         )
 
         BT.load_data_to_cache = self.load_data_to_cache
+        BT.datas.shared_klines = self.datas.shared_klines
 
         BT.log.info(
             f"执行参数优化，参数配置：{new_cl_setting}，落地文件：{new_save_file}"
         )
         balance = 0
+        stopped = False
+        curve = None
         try:
             # 判断文件不存在，执行回测，文件存在，加载回测结果
-            if os.path.isfile(new_save_file) is False:
+            if results_exists(new_save_file) is False:
                 BT.log.info(f"落地文件：{new_save_file} 不存在，开始执行回测")
+                if early_stopping is not None:
+                    early_stopping = copy.deepcopy(early_stopping)
+                    early_stopping.start(window)
                 BT.run(
-                    self.next_frequency
+                    self.next_frequency, loop_callback_fun=early_stopping
                 )  # 节省参数优化执行的时间，这里可以手动设置每次循环的周期
-                BT.save()
+                if early_stopping is not None:
+                    stopped = early_stopping.stopped
+                    curve = early_stopping.curve
+                if stopped:
+                    BT.log.info(f"回测{new_cl_setting} 明显较差，提前停止")
+                else:
+                    BT.save()
             else:
                 BT.log.info(f"落地文件：{new_save_file} 已经存在，直接进行加载")
                 BT.load(new_save_file)
 
-            # 如果是交易模式，评价标准是最终余额，信号模式，总盈利比率
-            pos_pd = BT.positions()
-            balance = pos_pd[self.evaluate].sum() if len(pos_pd) > 0 else 0
+            # 评价标准：持仓的字段（profit_rate/max_profit_rate）按照历史持仓求和，否则使用回测的指标
+            if self.evaluate in ["profit_rate", "max_profit_rate"]:
+                pos_pd = BT.positions()
+                balance = pos_pd[self.evaluate].sum() if len(pos_pd) > 0 else 0
+            else:
+                balance = BT.metrics().get(self.evaluate, 0)
 
             BT.log.info(f"回测{new_cl_setting} : {new_save_file} 结果：{balance}")
         except Exception:
@@ -442,8 +723,22 @@ class BackTest:
             "end_balance": balance,
             "params": new_cl_setting,
             "save_file": new_save_file,
+            "window": window,
+            "stopped": stopped,
+            "curve": curve,
         }
 
+    def _window_end_datetime(self, window: float) -> str:
+        """
+        根据回测区间的比例，计算回测的结束时间
+        """
+        if window >= 1:
+            return self.end_datetime
+        time_fmt = "%Y-%m-%d %H:%M:%S"
+        start_dt = datetime.datetime.strptime(self.start_datetime, time_fmt)
+        end_dt = datetime.datetime.strptime(self.end_datetime, time_fmt)
+        return (start_dt + (end_dt - start_dt) * window).strftime(time_fmt)
+
     def run_optimization(
         self,
         optimization_setting: OptimizationSetting,
@@ -451,46 +746,108 @@ class BackTest:
         next_frequency: str = None,
         evaluate: str = "profit_rate",
         load_data_to_cache: bool = True,
+        shared_klines: bool = True,
+        search: OptimizationSearch = None,
+        early_stopping: EarlyStopping = None,
     ):
         """
         运行参数优化
         @param optimization_setting: 优化参数对象
         @param max_workers: 最大运行进程数
         @param next_frequency: 回测每次循环的周期
-        @param evaluate: 评价的指标 允许 profit_rate /  max_profit_rate
+        @param evaluate: 评价的指标 允许 profit_rate /  max_profit_rate，或者 metrics 方法返回的指标（如 sharpe_ratio / total_return / net_balance）
         @param load_data_to_cache: 批量优化，如果使用加载数据到内存中的做法，会占用太多内存，这里可以设置为 False，直接读取数据到方式执行
+        @param shared_klines: 是否将K线数据写入共享的内存映射文件，所有参数的回测直接读取，只读取一次数据库，也不会每个进程保存一份数据
+        @param search: 参数搜索策略，默认为穷举所有参数组合（GridSearch），可选 RandomSearch / SuccessiveHalvingSearch / TPESearch
+        @param early_stopping: 提前停止明显较差参数的回测，None 则不启用
         """
-        cl_settings: List[Dict] = optimization_setting.generate_cl_settings()
+        if search is None:
+            search = GridSearch(optimization_setting)
+        if max_workers is None:
+            max_workers = os.cpu_count()
 
-        self.log.info("开始执行穷举算法优化")
-        self.log.info(f"参数优化空间：{len(cl_settings)}")
+        self.log.info(f"开始执行参数优化，搜索策略：{type(search).__name__}")
+        self.log.info(f"参数优化空间：{optimization_setting.cl_settings_nums()}")
 
         self.next_frequency = next_frequency  # 每次循环的周期
         self.load_data_to_cache = load_data_to_cache
         self.evaluate = evaluate
 
+        if shared_klines:
+            self.build_shared_klines(next_frequency)
+
         start = time.perf_counter()
 
-        with ProcessPoolExecutor(
-            max_workers, mp_context=get_context("spawn")
-        ) as executor:
-            results = list(executor.map(self.run_params, cl_settings))
-            results.sort(reverse=True, key=lambda _r: _r["end_balance"])
+        try:
+            with ProcessPoolExecutor(
+                max_workers, mp_context=get_context("spawn")
+            ) as executor:
+                while True:
+                    trials = search.ask()
+                    if len(trials) == 0:
+                        break
+                    trial_results = self._run_trials(
+                        executor, trials, max_workers, early_stopping
+                    )
+                    search.tell(trial_results)
+                    self.log.info(
+                        f"完成 {len(trial_results)} 个参数的回测，其中提前停止 {len([_r for _r in trial_results if _r['stopped']])} 个"
+                    )
+
+                results = sorted(
+                    search.results, reverse=True, key=lambda _r: _r["end_balance"]
+                )
 
-            end = time.perf_counter()
-            cost: int = int((end - start))
-            self.log.info(f"穷举算法优化完成，耗时{cost}秒")
+                end = time.perf_counter()
+                cost: int = int((end - start))
+                self.log.info(f"参数优化完成，耗时{cost}秒")
 
-            for r in results:
-                BT = BackTest()
-                BT.load(r["save_file"])
-                print("* * " * 10)
-                print(f'参数：{r["params"]}')
-                print(f'落地文件：{r["save_file"]}')
-                BT.result(True)
+                for r in results:
+                    BT = BackTest()
+                    BT.load(r["save_file"])
+                    print("* * " * 10)
+                    print(f'参数：{r["params"]}')
+                    print(f'落地文件：{r["save_file"]}')
+                    BT.result(True)
+        finally:
+            self.clear_shared_klines()
 
         return results
 
+    def _run_trials(
+        self,
+        executor: ProcessPoolExecutor,
+        trials: List[dict],
+        max_workers: int,
+        early_stopping: EarlyStopping = None,
+    ) -> List[dict]:
+        """
+        执行一批参数的回测，同时提交的数量不超过进程数
+        每个回测完成后立即更新提前停止的参考记录，之后提交的回测使用最新的参考记录
+        @return: 与 trials 顺序相同的回测结果
+        """
+        results: List[dict] = [None] * len(trials)
+        futures = {}
+        trial_iter = iter(enumerate(trials))
+        while True:
+            while len(futures) < max_workers:
+                _i, _t = next(trial_iter, (None, None))
+                if _t is None:
+                    break
+                _f = executor.submit(
+                    self.run_params, _t["params"], _t["window"], early_stopping
+                )
+                futures[_f] = _i
+            if len(futures) == 0:
+                break
+            done, _ = wait(futures.keys(), return_when=FIRST_COMPLETED)
+            for _f in done:
+                _r = _f.result()
+                results[futures.pop(_f)] = _r
+                if early_stopping is not None:
+                    early_stopping.update(_r["window"], [_r])
+        return results
+
     def show_charts(
         self,
         code,
@@ -596,83 +953,37 @@ class BackTest:
             base_close = float(base_klines.iloc[-1]["close"])
 
             # 每年交易日设置
-            annual_days = 240 if self.market in ["a", "us", "hk" "futures"] else 365
-            # 无风险收益率
-            risk_free = 0.03
-
-            # 按照日期聚合资产变化
-            new_day_balances = {}
-            for dt, b in self.trader.balance_history.items():
-                day = fun.str_to_datetime(
-                    fun.datetime_to_str(fun.str_to_datetime(dt), "%Y-%m-%d"), "%Y-%m-%d"
-                )
-                new_day_balances[day] = b
-            df = pd.DataFrame.from_dict(
-                new_day_balances, orient="index", columns=["balance"]
-            )
-            df.index.name = "date"
-            pre_balance = df["balance"].shift(1)
-            pre_balance.iloc[0] = self.init_balance
-            x = df["balance"] / pre_balance
-            x[x <= 0] = np.nan
-            df["return"] = np.log(x).fillna(0)
-            df["highlevel"] = (
-                df["balance"].rolling(min_periods=1, window=len(df), center=False).max()
-            )
-            df["drawdown"] = df["balance"] - df["highlevel"]
-            df["ddpercent"] = df["drawdown"] / df["highlevel"] * 100
-            # Calculate statistics value
-            start_date = df.index[0]
-            end_date = df.index[-1]
-            total_days = len(df)
-            end_balance = df["balance"].iloc[-1]
-            max_drawdown = df["drawdown"].min()
-            max_ddpercent = df["ddpercent"].min()
-            max_drawdown_end = df["drawdown"].idxmin()
-            if isinstance(max_drawdown_end, datetime.datetime):
-                max_drawdown_start = df["balance"][:max_drawdown_end].idxmax()
-                max_drawdown_duration = (max_drawdown_end - max_drawdown_start).days
-            else:
-                max_drawdown_duration = 0
-
-            total_return = (end_balance / self.init_balance - 1) * 100
-            annual_return = total_return / total_days * annual_days
-            daily_return = df["return"].mean() * 100
-            return_std = df["return"].std() * 100
+            annual_days = self._annual_days()
 
-            if return_std:
-                daily_risk_free = risk_free / np.sqrt(annual_days)
-                sharpe_ratio = (
-                    (daily_return - daily_risk_free) / return_std * np.sqrt(annual_days)
-                )
-            else:
-                sharpe_ratio = 0
-
-            return_drawdown_ratio = -total_return / max_ddpercent
-
-            # 总的手续费
-            total_fee = self.trader.fee_total
+            # 资产历史的指标（日收益率、回撤、Sharpe 等），见 metrics 模块
+            metrics = balance_metrics(
+                self.trader.history, self.init_balance, annual_days
+            )
+            total_days = metrics["total_days"]
             base_annual_return = (
                 (base_close / base_open - 1) / total_days * annual_days * 100
             )
 
-            res["start_date"] = start_date
-            res["end_date"] = end_date
+            res["start_date"] = metrics["start_date"]
+            res["end_date"] = metrics["end_date"]
             res["total_days"] = total_days
             res["init_balance"] = self.init_balance
-            res["end_balance"] = end_balance
-            res["total_fee"] = total_fee
+            res["end_balance"] = metrics["end_balance"]
+            res["total_fee"] = self.trader.fee_total
             res["base_return"] = (base_close - base_open) / base_open * 100
             res["base_annual_return"] = base_annual_return
-            res["total_return"] = total_return
-            res["annual_return"] = annual_return
-            res["max_drawdown"] = max_drawdown
-            res["max_ddpercent"] = max_ddpercent
-            res["max_drawdown_duration"] = max_drawdown_duration
-            res["daily_return"] = daily_return
-            res["return_std"] = return_std
-            res["sharpe_ratio"] = sharpe_ratio
-            res["return_drawdown_ratio"] = return_drawdown_ratio
+            for _k in [
+                "total_return",
+                "annual_return",
+                "max_drawdown",
+                "max_ddpercent",
+                "max_drawdown_duration",
+                "daily_return",
+                "return_std",
+                "sharpe_ratio",
+                "return_drawdown_ratio",
+            ]:
+                res[_k] = metrics[_k]
         else:
             res["start_date"] = ""
             res["end_date"] = ""
@@ -706,112 +1017,24 @@ class BackTest:
             "平均亏损",
             "盈亏比",
         ]
-
-        mmds = {
-            "1buy": "一类买点",
-            "2buy": "二类买点",
-            "l2buy": "类二类买点",
-            "3buy": "三类买点",
-            "l3buy": "类三类买点",
-            "down_bi_bc_buy": "下跌笔背驰",
-            "down_xd_bc_buy": "下跌线段背驰",
-            "down_pz_bc_buy": "下跌盘整背驰",
-            "down_qs_bc_buy": "下跌趋势背驰",
-            "1sell": "一类卖点",
-            "2sell": "二类卖点",
-            "l2sell": "类二类卖点",
-            "3sell": "三类卖点",
-            "l3sell": "类三类卖点",
-            "up_bi_bc_sell": "上涨笔背驰",
-            "up_xd_bc_sell": "上涨线段背驰",
-            "up_pz_bc_sell": "上涨盘整背驰",
-            "up_qs_bc_sell": "上涨趋势背驰",
-        }
-        total_trade_num = 0  # 总的交易数量
-        total_win_num = 0  # 总的盈利数量
-        total_loss_num = 0  # 总的亏损数量
-        total_win_balance = 0
-        total_loss_balance = 0
-        for k in self.trader.results.keys():
-            mmd = mmds[k]
-            win_num = self.trader.results[k]["win_num"]
-            loss_num = self.trader.results[k]["loss_num"]
-            shenglv = (
-                0
-                if win_num == 0 and loss_num == 0
-                else win_num / (win_num + loss_num) * 100
-            )
-            win_balance = self.trader.results[k]["win_balance"]
-            loss_balance = self.trader.results[k]["loss_balance"]
-            net_balance = win_balance - loss_balance
-            back_rate = 0 if win_balance == 0 else loss_balance / win_balance * 100
-            win_mean_balance = 0 if win_num == 0 else win_balance / win_num
-            loss_mean_balance = 0 if loss_num == 0 else loss_balance / loss_num
-            ykb = (
-                0
-                if loss_mean_balance == 0 or win_mean_balance == 0
-                else win_mean_balance / loss_mean_balance
-            )
-
-            total_trade_num += win_num + loss_num
-            total_win_num += win_num
-            total_loss_num += loss_num
-            total_win_balance += win_balance
-            total_loss_balance += loss_balance
-
+        # 每个买卖点与汇总的统计
+        mmd_df = mmd_metrics(self.trader.results)
+        for row in mmd_df.itertuples():
             tb.add_row(
                 [
-                    mmd,
-                    win_num,
-                    loss_num,
-                    f"{str(round(shenglv, 2))}%",
-                    round(win_balance, 2),
-                    round(loss_balance, 2),
-                    round(net_balance, 2),
-                    round(back_rate, 2),
-                    round(win_mean_balance, 2),
-                    round(loss_mean_balance, 2),
-                    round(ykb, 4),
+                    "汇总" if row.Index == "total" else MMD_NAMES[row.Index],
+                    row.win_num,
+                    row.loss_num,
+                    f"{round(row.win_rate, 2)}%",
+                    round(row.win_balance, 2),
+                    round(row.loss_balance, 2),
+                    round(row.net_balance, 2),
+                    round(row.back_rate, 2),
+                    round(row.win_mean_balance, 2),
+                    round(row.loss_mean_balance, 2),
+                    round(row.ykb, 4),
                 ]
             )
-
-        total_shenglv = (
-            0
-            if total_win_num == 0 == total_loss_num
-            else total_win_num / (total_win_num + total_loss_num) * 100
-        )
-        total_net_balance = total_win_balance - total_loss_balance
-        total_back_rate = (
-            0
-            if total_win_balance == 0
-            else total_loss_balance / total_win_balance * 100
-        )
-        total_win_mean_balance = (
-            0 if total_win_num == 0 else total_win_balance / total_win_num
-        )
-        total_loss_mean_balance = (
-            0 if total_loss_num == 0 else total_loss_balance / total_loss_num
-        )
-        total_ykb = (
-            0
-            if total_loss_mean_balance == 0
-            else total_win_mean_balance / total_loss_mean_balance
-        )
-        tb.add_row(
-            [
-                "汇总",
-                total_win_num,
-                total_loss_num,
-                f"{round(total_shenglv, 2)}%",
-                round(total_win_balance, 2),
-                round(total_loss_balance, 2),
-                round(total_net_balance, 2),
-                round(total_back_rate, 2),
-                round(total_win_mean_balance, 2),
-                round(total_loss_mean_balance, 2),
-                round(total_ykb, 4),
-            ]
-        )
         res["mmd_infos"] = tb
         if is_print:
             self.print_result(res)
@@ -819,6 +1042,24 @@ class BackTest:
 
         return res
 
+    def metrics(self) -> dict:
+        """
+        回测的指标（交易模式的资产指标与买卖点汇总统计），不需要获取行情数据，也不需要历史持仓
+        参数优化可以使用其中的指标作为评价标准
+        """
+        return backtest_metrics(
+            self.mode,
+            self.trader.history,
+            self.trader.results,
+            self.init_balance,
+            self.trader.fee_total,
+            self._annual_days(),
+        )
+
+    def _annual_days(self) -> int:
+        # 每年交易日
+        return 240 if self.market in ["a", "us", "hk" "futures"] else 365
+
     @staticmethod
     def print_result(res: dict):
         """
@@ -855,28 +1096,24 @@ class BackTest:
             return None
 
         # 按照日期聚合资产变化
-        new_day_balances = {}
-        for dt, b in self.trader.balance_history.items():
-            day = dt[0:10]  # 2022-02-22
-            new_day_balances[fun.str_to_datetime(day, "%Y-%m-%d")] = b
-        df = pd.DataFrame.from_dict(
-            new_day_balances, orient="index", columns=["balance"]
-        )
+        days, balances = day_balances(self.trader.history)
+        index = pd.DatetimeIndex(days.astype("M8[ns]")).tz_localize("Asia/Shanghai")
+        df = pd.DataFrame({"balance": balances}, index=index)
         df.index.name = "date"
-        df = df.sort_index()
         df["return"] = df["balance"].pct_change()
 
-        # 持仓记录
-        positions = {}
-        for _dt, _pos_balance in self.trader.positions_balance_history.items():
-            _dt = fun.str_to_datetime(_dt[0:10], "%Y-%m-%d")
-            if _dt not in positions.keys():
-                positions[_dt] = {}
-            for _code, _b in _pos_balance.items():
-                if _code == "Cash":
-                    _code = "cash"
-                positions[_dt][_code] = _b
-        positions = pd.DataFrame(positions).T
+        # 持仓记录（每日各个代码最后的持仓金额）
+        positions = self.trader.history.positions_frame()
+        positions["dt"] = (
+            pd.DatetimeIndex(positions["dt"]).normalize().tz_localize("Asia/Shanghai")
+        )
+        positions["code"] = positions["code"].replace("Cash", "cash")
+        positions = (
+            positions.groupby(["dt", "code"], sort=False)["balance"]
+            .last()
+            .unstack("code")
+        )
+        positions.index.name = None
 
         # 交易记录
         transactions = []
@@ -939,38 +1176,28 @@ class BackTest:
             end_date=self.end_datetime,
             args={"limit": None},
         )
-        dts = list(base_klines["date"].to_list())
+        dts = pd.DatetimeIndex(base_klines["date"])
+        if dts.tz is not None:
+            # 历史记录的时间为本地时间
+            dts = dts.tz_localize(None)
+        dts = dts.floor("s")
         base_prices["val"] = list(base_klines["close"].to_list())
-
-        # 按照时间统计当前时间持仓累计盈亏
-        _hold_profit_sums = {}
-        for _dt, _p in self.trader.hold_profit_history.items():
-            if _dt not in _hold_profit_sums.keys():
-                _hold_profit_sums[_dt] = _p
-            else:
-                _hold_profit_sums[_dt] += _p
-
-        # 按照时间累加总的收益
-        for _dt in dts:
-            _dt = _dt.strftime("%Y-%m-%d %H:%M:%S")
-            base_prices["datetime"].append(_dt)
-
-            # 资金余额
-            if _dt in self.trader.balance_history.keys():
-                balance_history["datetime"].append(_dt)
-                balance_history["val"].append(self.trader.balance_history[_dt])
-            else:
-                balance_history["datetime"].append(_dt)
-                balance_history["val"].append(
-                    balance_history["val"][-1] if len(balance_history["val"]) > 0 else 0
-                )
-
-            # 当前时间持仓累计
-            hold_profit_history["datetime"].append(_dt)
-            if _dt in _hold_profit_sums.keys():
-                hold_profit_history["val"].append(_hold_profit_sums[_dt])
-            else:
-                hold_profit_history["val"].append(0)
+        base_prices["datetime"] = dts.strftime("%Y-%m-%d %H:%M:%S").to_list()
+
+        # 资金余额，没有记录的时间使用之前的资金余额
+        balance_history["datetime"] = base_prices["datetime"]
+        balance_history["val"] = (
+            self.trader.history.balance_series()
+            .reindex(dts)
+            .ffill()
+            .fillna(0)
+            .to_list()
+        )
+        # 当前时间持仓累计
+        hold_profit_history["datetime"] = base_prices["datetime"]
+        hold_profit_history["val"] = (
+            self.trader.history.hold_profit_series().reindex(dts).fillna(0).to_list()
+        )
 
         return self.__create_backtest_charts(
             base_prices, balance_history, hold_profit_history
@@ -1133,6 +1360,13 @@ class BackTest:
         输出历史持仓信息
         如果 code 为 str 返回 特定 code 的数据
         """
+        if (
+            close_uids is None
+            and isinstance(self.trader, ResultsTrader)
+            and self.trader.is_loaded("positions_history") is False
+        ):
+            # 从结果存储加载的回测，直接使用历史持仓表
+            return self.trader.results_store.positions_frame(code, add_columns)
         pos_objs = []
         for _code in self.trader.positions_history.keys():
             if code is not None and _code != code:
@@ -1170,6 +1404,11 @@ class BackTest:
         输出订单列表
         如果 code 返回 特定 code 的数据
         """
+        if (
+            isinstance(self.trader, ResultsTrader)
+            and self.trader.is_loaded("orders") is False
+        ):
+            return self.trader.results_store.orders_frame(code)
         order_objs = []
         for _code, orders in self.trader.orders.items():
             if code is not None and _code != code:
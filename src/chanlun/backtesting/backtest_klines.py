@@ -2,6 +2,7 @@
 import hashlib
 import json
 import time
+from pathlib import Path
 
 import pytz
 from tqdm.auto import tqdm
@@ -9,6 +10,7 @@ from tqdm.auto import tqdm
 from chanlun import cl
 from chanlun import fun
 from chanlun.backtesting.base import MarketDatas
+from chanlun.backtesting.klines_share import SharedKlines
 from chanlun.cl_interface import *
 from chanlun.exchange.exchange_db import ExchangeDB
 
@@ -71,9 +73,19 @@ class BackTestKlines(MarketDatas):
 
         # 保存k线数据
         self.all_klines: Dict[str, pd.DataFrame] = {}
+        # k线数据对应的时间戳数组（纳秒），用于二分查找当前时间所在的位置
+        self.all_klines_ts: Dict[str, np.ndarray] = {}
+        # 共享的K线数据（内存映射文件），设置后优先从这里读取K线，不再访问数据库
+        self.shared_klines: Union[SharedKlines, None] = None
 
         # 每个周期缓存的k线数据，避免多次请求重复计算
         self.cache_klines: Dict[str, Dict[str, pd.DataFrame]] = {}
+        # 每个周期缓存的最后一根k线信息
+        self.cache_last_k_info: Dict[str, dict] = {}
+        # 每个代码上一次转换的大周期k线，下次转换时只重新合并最后未完成的k线
+        self.period_klines: Dict[Tuple[str, str], pd.DataFrame] = {}
+        # 使用缓存时，全部小周期k线转换后，每根大周期k线开始的小周期k线时间戳
+        self.period_first_ts: Dict[Tuple[str, str, str], Union[np.ndarray, None]] = {}
 
         self.ex = ExchangeDB(self.market)
 
@@ -101,6 +113,16 @@ class BackTestKlines(MarketDatas):
         if isinstance(frequency, str):
             frequency = [frequency]
         for _f in frequency:
+            if self.shared_klines is not None and self.shared_klines.has_loop(
+                base_code, _f
+            ):
+                # 共享数据是完整回测区间的，回测的结束时间可能更早（参数优化的连续减半搜索）
+                self.loop_datetime_list[_f] = [
+                    _d
+                    for _d in self.shared_klines.loop_dates(base_code, _f, self.ex.tz)
+                    if _d <= self.end_date
+                ]
+                continue
             klines = self.ex.klines(
                 base_code,
                 _f,
@@ -119,12 +141,58 @@ class BackTestKlines(MarketDatas):
             desc=f"Run {base_code}",
         )
 
+    def build_shared_klines(
+        self,
+        path: Union[str, Path],
+        codes: List[str],
+        loop_codes: List[str],
+        loop_frequency: str,
+    ) -> SharedKlines:
+        """
+        将代码所有周期回测区间内的K线数据，写入共享的内存映射文件，并设置为当前使用的共享数据
+        :param path: 存储的目录
+        :param codes: 代码列表
+        :param loop_codes: 需要作为回测循环基准的代码列表
+        :param loop_frequency: 回测循环的周期
+        """
+        shared = SharedKlines.create(path)
+        for code in tqdm(codes, desc="共享K线数据"):
+            for _f in self.frequencys:
+                all_klines = self.ex.klines(
+                    code,
+                    _f,
+                    start_date=self._cal_start_date_by_frequency(self.start_date, _f),
+                    end_date=fun.datetime_to_str(self.end_date),
+                    args={"limit": None},
+                )
+                all_klines = all_klines.sort_values("date").reset_index(drop=True)
+                loop_start = None
+                if code in loop_codes and _f == loop_frequency:
+                    # 与 init 方法获取的循环日期相同，是全部K线的最后一部分
+                    loop_klines = self.ex.klines(
+                        code,
+                        _f,
+                        start_date=fun.datetime_to_str(self.start_date),
+                        end_date=fun.datetime_to_str(self.end_date),
+                        args={"limit": None},
+                    )
+                    loop_nums = 0 if loop_klines is None else len(loop_klines)
+                    loop_start = max(len(all_klines) - loop_nums, 0)
+                shared.write(code, _f, all_klines, loop_start)
+        shared.write_meta()
+        self.shared_klines = shared
+        return shared
+
     def clear_all_cache(self):
         """
         清除所有可用缓存，释放内存
         """
         self.cache_klines = {}
+        self.cache_last_k_info = {}
+        self.period_klines = {}
+        self.period_first_ts = {}
         self.all_klines = {}
+        self.all_klines_ts = {}
         self.cache_cl_datas = {}
         self.cl_datas = {}
         return True
@@ -141,18 +209,23 @@ class BackTestKlines(MarketDatas):
         # 清除之前的 cl_datas 、klines 缓存，重新计算
         self.cache_cl_datas = {}
         self.cache_klines = {}
+        self.cache_last_k_info = {}
         self.bar.update(1)
         return True
 
     def last_k_info(self, code) -> dict:
+        if code in self.cache_last_k_info.keys():
+            return dict(self.cache_last_k_info[code])
         kline = self.klines(code, self.frequencys[-1])
-        return {
-            "date": kline.iloc[-1]["date"],
-            "open": float(kline.iloc[-1]["open"]),
-            "close": float(kline.iloc[-1]["close"]),
-            "high": float(kline.iloc[-1]["high"]),
-            "low": float(kline.iloc[-1]["low"]),
+        # 按列取值，避免 iloc 取行时混合类型的转换
+        self.cache_last_k_info[code] = {
+            "date": kline["date"].iloc[-1],
+            "open": float(kline["open"].iloc[-1]),
+            "close": float(kline["close"].iloc[-1]),
+            "high": float(kline["high"].iloc[-1]),
+            "low": float(kline["low"].iloc[-1]),
         }
+        return dict(self.cache_last_k_info[code])
 
     def get_cl_data(self, code, frequency, cl_config: dict = None) -> ICL:
         _time = time.time()
@@ -238,11 +311,21 @@ class BackTestKlines(MarketDatas):
 
         _time = time.time()
         klines = {}
-        if self.load_data_to_cache:
+        use_shared = self.shared_klines is not None and self.shared_klines.has(code)
+        if self.load_data_to_cache or use_shared:
             # 使用缓存
             for _f in self.frequencys:
                 key = "%s-%s" % (code, _f)
-                if key not in self.all_klines.keys():
+                if use_shared:
+                    # 共享数据是映射的只读数据，截取后的K线是复制的，可以修改
+                    if key not in self.all_klines.keys():
+                        self.all_klines[key] = self.shared_klines.klines(
+                            code, _f, self.ex.tz
+                        )
+                        self.all_klines_ts[key] = self.shared_klines.dates_ts(
+                            code, _f, self.ex.tz
+                        )
+                elif key not in self.all_klines.keys():
                     # 从数据库获取日期区间的所有行情
                     all_klines = self.ex.klines(
                         code,
@@ -256,7 +339,12 @@ class BackTestKlines(MarketDatas):
                     self.all_klines[key] = all_klines.sort_values("date").reset_index(
                         drop=True
                     )
+                    self.all_klines_ts[key] = self._dates_to_ts(
+                        self.all_klines[key]["date"]
+                    )
 
+            # 数据已按时间排序，二分查找当前时间的位置，截取需要的k线
+            now_ts = pd.Timestamp(self.now_date).value
             for _f in self.frequencys:
                 key = "%s-%s" % (code, _f)
                 if self.market in [
@@ -264,16 +352,19 @@ class BackTestKlines(MarketDatas):
                     "futures",
                     "us",
                 ]:  # 后对其的，不能包含当前日期
-                    kline = self.all_klines[key][
-                        self.all_klines[key]["date"] < self.now_date
-                    ][-self.load_kline_nums : :]
+                    end_idx = np.searchsorted(
+                        self.all_klines_ts[key], now_ts, side="left"
+                    )
                 else:
-                    kline = self.all_klines[key][
-                        self.all_klines[key]["date"] <= self.now_date
-                    ][-self.load_kline_nums : :]
+                    end_idx = np.searchsorted(
+                        self.all_klines_ts[key], now_ts, side="right"
+                    )
+                kline = self.all_klines[key].iloc[
+                    max(0, end_idx - self.load_kline_nums) : end_idx
+                ]
                 if self.del_volume_zero and len(kline) > 0:
                     kline = kline[kline["volume"] != 0]
-                kline = kline.sort_values("date").reset_index(drop=True)
+                kline = kline.reset_index(drop=True)
                 klines[_f] = kline
         else:
             # 使用数据库按需查询
@@ -317,19 +408,32 @@ class BackTestKlines(MarketDatas):
         for i in range(len(self.frequencys), 1, -1):
             min_f = self.frequencys[i - 1]
             max_f = self.frequencys[i - 2]
-            new_kline = self.ex.convert_kline_frequency(klines[min_f][-120::], max_f)
+            new_kline = self._convert_period_klines(
+                code, klines[min_f][-120::], min_f, max_f
+            )
             if new_kline is None:
                 continue
-            new_kline = new_kline.iloc[1::]
             if len(klines[max_f]) > 0 and len(new_kline) > 0:
                 # 先删除下大周期的最后一行数据，用合并后的数据代替
-                klines[max_f] = klines[max_f].drop(klines[max_f].index[-1])
+                max_klines = klines[max_f].iloc[:-1]
 
-                klines[max_f] = (
-                    pd.concat([klines[max_f], new_kline], ignore_index=True)
-                    .drop_duplicates(subset=["date"], keep="last")
-                    .sort_values("date")
-                    .reset_index(drop=True)
+                # 大周期数据是有序的，只有在合并数据开始时间之后的几根需要与合并数据去重排序，之前的直接保留
+                split_idx = max_klines["date"].searchsorted(
+                    new_kline.iloc[0]["date"], side="left"
+                )
+                if np.isin(
+                    max_klines["date"].values[split_idx:], new_kline["date"].values
+                ).all():
+                    # 合并数据包含了需要去重的所有大周期k线（合并数据是有序的），直接使用合并数据
+                    tail_klines = new_kline
+                else:
+                    tail_klines = (
+                        pd.concat([max_klines.iloc[split_idx:], new_kline])
+                        .drop_duplicates(subset=["date"], keep="last")
+                        .sort_values("date")
+                    )
+                klines[max_f] = pd.concat(
+                    [max_klines.iloc[:split_idx], tail_klines], ignore_index=True
                 )
 
         # 检测在数据列中，是否有大于最后一个时间的行
@@ -344,6 +448,142 @@ class BackTestKlines(MarketDatas):
         self._use_times["convert_klines"] += time.time() - _time
         return klines
 
+    def _convert_period_klines(
+        self, code: str, min_klines: pd.DataFrame, min_f: str, max_f: str
+    ) -> Union[pd.DataFrame, None]:
+        """
+        将最后的小周期k线转换成大周期k线，结果与 convert_kline_frequency(min_klines).iloc[1:] 一致
+        （去掉第一根小周期k线所在的大周期k线，可能是不完整的）
+        保存上一次的转换结果，已经完成的大周期k线直接使用，只重新合并最后未完成的大周期k线
+        """
+        if len(min_klines) == 0:
+            return None
+        period_klines = self._update_last_period_kline(
+            code, min_klines, min_f, max_f, self.period_klines.get((code, max_f))
+        )
+        if period_klines is None:
+            period_klines = self.ex.convert_kline_frequency_incremental(
+                min_klines, max_f, self.period_klines.get((code, max_f))
+            )
+        if period_klines is None:
+            return None
+        start_idx = period_klines["first_date"].searchsorted(
+            min_klines.iloc[0]["date"], side="right"
+        )
+        self.period_klines[(code, max_f)] = period_klines.iloc[max(start_idx - 1, 0) :]
+        return period_klines.iloc[max(start_idx, 1) :].drop(columns=["first_date"])
+
+    def _update_last_period_kline(
+        self,
+        code: str,
+        min_klines: pd.DataFrame,
+        min_f: str,
+        max_f: str,
+        period_klines: Union[pd.DataFrame, None],
+    ) -> Union[pd.DataFrame, None]:
+        """
+        新的小周期k线仍然属于最后一根大周期k线，则不需要调用转换方法，直接使用这些小周期k线重新合并最后一根大周期k线
+        不能直接更新的（没有缓存全部的k线、已经是新的大周期k线等），返回 None
+        """
+        if period_klines is None or len(period_klines) == 0:
+            return None
+        period_first_ts = self._period_first_ts(code, min_f, max_f)
+        if period_first_ts is None:
+            return None
+        last_first_date = period_klines["first_date"].iloc[-1]
+        dates = min_klines["date"]
+        start_idx = int(dates.searchsorted(last_first_date, side="left"))
+        if start_idx >= len(dates) or dates.iloc[start_idx] != last_first_date:
+            return None
+        # 最后一根小周期k线所在的大周期，开始时间需要与最后一根大周期k线相同
+        first_ts, last_ts = self._dates_to_ts(dates.iloc[[start_idx, -1]])
+        period_idx = np.searchsorted(period_first_ts, last_ts, side="right") - 1
+        if period_idx < 0 or period_first_ts[period_idx] != first_ts:
+            return None
+
+        update_klines = min_klines.iloc[start_idx:]
+        update_cols = ["open", "high", "low", "close", "volume"]
+        period_klines = period_klines.copy()
+        period_klines.iloc[-1, period_klines.columns.get_indexer(update_cols)] = [
+            update_klines["open"].iloc[0],
+            update_klines["high"].max(),
+            update_klines["low"].min(),
+            update_klines["close"].iloc[-1],
+            self._sum_volume(update_klines["volume"].to_numpy()),
+        ]
+        return period_klines
+
+    def _period_first_ts(self, code: str, min_f: str, max_f: str):
+        """
+        将缓存的全部小周期k线转换为大周期（每个代码只转换一次），返回每根大周期k线开始的小周期k线时间戳
+        大周期k线的开始位置，只与k线的时间有关，不会引入未来的行情数据
+        转换后的时间与包含的小周期k线有关（比如使用最后一根k线的时间），或者没有缓存数据，则返回 None
+        """
+        key = (code, min_f, max_f)
+        if key in self.period_first_ts.keys():
+            return self.period_first_ts[key]
+        self.period_first_ts[key] = None
+        all_klines = self.all_klines.get("%s-%s" % (code, min_f))
+        if all_klines is None or len(all_klines) == 0:
+            return None
+        if self.del_volume_zero:
+            all_klines = all_klines[all_klines["volume"] != 0]
+        all_klines = all_klines.reset_index(drop=True)
+        period_klines = self.ex.convert_kline_frequency_incremental(all_klines, max_f)
+        if period_klines is None or len(period_klines) == 0:
+            return None
+
+        # 使用大周期k线中的第一根小周期k线转换，时间不同则说明合并后的时间与包含的k线有关
+        period_first_ts = self._dates_to_ts(period_klines["first_date"])
+        first_pos = np.searchsorted(
+            self._dates_to_ts(all_klines["date"]), period_first_ts
+        )
+        multi_idx = np.nonzero(np.diff(np.append(first_pos, len(all_klines))) >= 2)[0]
+        if len(multi_idx) > 0:
+            _pos = first_pos[multi_idx[-1]]
+            one_kline = self.ex.convert_kline_frequency(
+                all_klines.iloc[_pos : _pos + 1].copy(), max_f
+            )
+            if (
+                one_kline is None
+                or len(one_kline) != 1
+                or one_kline["date"].iloc[0]
+                != period_klines["date"].iloc[multi_idx[-1]]
+            ):
+                return None
+
+        self.period_first_ts[key] = period_first_ts
+        return self.period_first_ts[key]
+
+    @staticmethod
+    def _sum_volume(volumes: np.ndarray):
+        """
+        成交量求和，与 pandas 分组求和的方式一致（浮点数使用 Kahan 补偿求和），保证与转换周期的结果相同
+        """
+        if volumes.dtype.kind != "f":
+            return volumes.sum()
+        total = 0.0
+        compensation = 0.0
+        for _v in volumes.tolist():
+            if _v != _v:
+                continue
+            y = _v - compensation
+            t = total + y
+            compensation = t - total - y
+            if compensation != compensation:
+                compensation = 0.0
+            total = t
+        return total
+
+    @staticmethod
+    def _dates_to_ts(dates: pd.Series) -> np.ndarray:
+        """
+        将日期列转换成纳秒时间戳数组
+        """
+        if len(dates) == 0:
+            return np.array([], dtype=np.int64)
+        return pd.to_datetime(dates).values.view(np.int64)
+
     def _cal_start_date_by_frequency(self, start_date: datetime, frequency) -> str:
         """
         按照周期，计算行情获取的开始时间
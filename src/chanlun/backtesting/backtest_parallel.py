@@ -0,0 +1,177 @@
+import copy
+import traceback
+
+from tqdm.auto import tqdm
+
+from chanlun.backtesting.backtest_trader import BackTestTrader
+from chanlun.backtesting.base import MarketDatas, Operation, POSITION
+from chanlun.cl_interface import *
+
+"""
+回测的多进程按时间同步（lock-step）执行
+
+代码按照进程分片，每个进程只加载与计算自己分片代码的 K 线与缠论数据，并执行策略的 close/open 方法得到交易信号
+主进程在每个时间点汇总所有进程的信号，按照代码顺序，在唯一的交易对象上执行（资金、max_pos、filter_opts 在主进程处理）
+
+执行的过程与 BackTest.run 相同：
+    1. 子进程根据主进程发送的持仓，执行策略的 close 方法，并在本地执行平仓（用于得到执行后的持仓，给 open 方法使用），记录平仓的操作与执行前的持仓
+    2. 子进程执行策略的 open 方法，开仓操作不执行，返回给主进程
+    3. 主进程按照代码顺序，重放 close 方法的操作（执行的结果以主进程为准），没有操作的持仓更新为子进程中的持仓，再执行（或缓存等待过滤）开仓操作
+"""
+
+
+class LockStepTrader(BackTestTrader):
+    """
+    子进程中的交易对象，记录策略 close 方法产生并执行的操作
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 记录执行的操作 (持仓uid, 操作, 执行前的持仓)
+        self.lock_step_executes: List[Tuple[str, Operation, POSITION]] = []
+
+    def execute(self, code, opt: Operation, pos: POSITION = None):
+        uid = None
+        if pos is not None:
+            for _uid, _p in self.positions.items():
+                if _p is pos:
+                    uid = _uid
+                    break
+        # 执行会修改操作与持仓，这里记录执行前的状态
+        self.lock_step_executes.append(
+            (uid, copy.deepcopy(opt), copy.deepcopy(pos) if pos is not None else None)
+        )
+        return super().execute(code, opt, pos)
+
+
+class LockStepDatas(MarketDatas):
+    """
+    主进程中的行情数据对象，只有当前时间与子进程返回的代码最新价格
+    """
+
+    def __init__(self, market: str, frequencys: List[str], cl_config=None):
+        super().__init__(market, frequencys, cl_config)
+        self.now_date: datetime.datetime = None
+        self.prices: Dict[str, dict] = {}
+
+    def klines(self, code, frequency) -> pd.DataFrame:
+        raise Exception("多进程回测的主进程中，不支持获取 K 线数据")
+
+    def last_k_info(self, code) -> dict:
+        return self.prices[code]
+
+    def get_cl_data(self, code, frequency, cl_config: dict = None) -> ICL:
+        raise Exception("多进程回测的主进程中，不支持获取缠论数据")
+
+
+def lock_step_worker(conn, config: dict, next_frequency: str, run_options: dict):
+    """
+    子进程的执行方法
+
+    接收主进程的命令：
+        ('step', ([(uid, 持仓), ...], 资金余额))  执行下一个时间点
+        ('end', None) 结束运行，返回时间统计信息
+
+    config 中的 codes 是全部的代码（on_bt_loop_start 中使用），run_options 的 run_codes 是当前进程执行的代码
+    """
+    from chanlun.backtesting.backtest import BackTest
+
+    try:
+        bt = BackTest(config)
+        trader = LockStepTrader(
+            "回测",
+            bt.mode,
+            is_stock=bt.is_stock,
+            is_futures=bt.is_futures,
+            init_balance=bt.init_balance,
+            fee_rate=bt.fee_rate,
+            max_pos=bt.max_pos,
+        )
+        trader.set_strategy(bt.strategy)
+        trader.set_data(bt.datas)
+        trader.begin_run_dt = run_options["begin_run_dt"]
+        trader.allow_mmds = run_options["allow_mmds"]
+        bt.trader = trader
+        bt.next_frequency = next_frequency
+        bt.datas.load_data_to_cache = run_options["load_data_to_cache"]
+        bt.datas.shared_klines = run_options["shared_klines"]
+        bt.datas.init(bt.base_code, next_frequency)
+        # 进度在主进程中展示
+        bt.datas.bar.close()
+        bt.datas.bar = tqdm(disable=True)
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+        conn.close()
+        return
+    # 返回回测循环日期，主进程用于展示进度与 loop_callback_fun
+    conn.send(("ready", list(bt.datas.loop_datetime_list[next_frequency])))
+
+    while True:
+        cmd, data = conn.recv()
+        if cmd == "end":
+            conn.send(
+                (
+                    "end",
+                    {
+                        "trader_use_times": trader.use_times,
+                        "strategy_use_times": bt.strategy.use_times,
+                        "strategy_use_counts": getattr(bt.strategy, "use_counts", {}),
+                    },
+                )
+            )
+            break
+
+        if bt.datas.next(next_frequency) is False:
+            conn.send(("done", None))
+            continue
+
+        poss: List[Tuple[str, POSITION]] = data[0]
+        trader.positions = {_uid: _p for _uid, _p in poss}
+        # 资金的变化在主进程中，子进程的开仓不执行，资金只影响在 close 中返回的加仓操作
+        trader.balance = data[1]
+        # 与主进程的 update_position_record 相同，更新持仓的盈亏信息
+        try:
+            for _uid, _p in poss:
+                if _p.balance != 0:
+                    trader.position_record(_p)
+        except Exception:
+            bt.log.error(f"执行记录持仓信息 : {bt.datas.now_date} 异常")
+            bt.log.error(traceback.format_exc())
+        prices = {}
+        results = {}
+        for code in run_options["run_codes"]:
+            trader.lock_step_executes = []
+            trader.buffer_opts = []
+            is_error = False
+            try:
+                bt.strategy.on_bt_loop_start(bt)
+                # 开仓的操作统一记录到缓冲区，交由主进程执行
+                trader.run(code, is_filter=True)
+            except Exception:
+                is_error = True
+                bt.log.error(f"执行 {code} : {bt.datas.now_date} 异常")
+                bt.log.error(traceback.format_exc())
+            code_poss = [(_uid, _p) for _uid, _p in poss if _p.code == code]
+            if (
+                is_error is False
+                and len(code_poss) == 0
+                and len(trader.lock_step_executes) == 0
+                and len(trader.buffer_opts) == 0
+            ):
+                continue
+            try:
+                prices[code] = bt.datas.last_k_info(code)
+            except Exception:
+                bt.log.error(f"获取 {code} : {bt.datas.now_date} 价格异常")
+                bt.log.error(traceback.format_exc())
+            results[code] = {
+                "executes": trader.lock_step_executes,
+                "poss": code_poss,
+                "opens": trader.buffer_opts,
+                "error": is_error,
+            }
+        trader.buffer_opts = []
+        conn.send(("step", (bt.datas.now_date, prices, results)))
+
+    conn.close()
+    return
@@ -10,6 +10,7 @@ from chanlun.backtesting.base import (
     MarketDatas,
     Trader,
 )
+from chanlun.backtesting.record_history import RecordHistory
 from chanlun.cl_interface import *
 from chanlun.file_db import fdb
 from chanlun.db import db
@@ -75,12 +76,8 @@ class BackTestTrader(Trader):
         # 当前持仓信息
         self.positions: Dict[str, POSITION] = {}
         self.positions_history: Dict[str, List[POSITION]] = {}
-        # 持仓资金历史
-        self.positions_balance_history: Dict[str, Dict[str, float]] = {}
-        # 持仓盈亏记录
-        self.hold_profit_history = {}
-        # 资产历史
-        self.balance_history: Dict[str, float] = {}
+        # 持仓盈亏、资产、持仓资金历史记录（数组形式，字典形式使用 hold_profit_history 等属性获取）
+        self.history: RecordHistory = RecordHistory()
 
         # 代码订单信息
         self.orders = {}
@@ -166,6 +163,38 @@ class BackTestTrader(Trader):
         # 缓冲区的执行操作，用于在特定时间点批量进行开盘检测后，对要执行的开盘信号再次进行过滤筛选
         self.buffer_opts: List[Operation] = []
 
+    def __setstate__(self, state):
+        if "balance_history" in state.keys():
+            # 之前版本保存的对象，历史记录为字典形式，转换为数组形式
+            state["history"] = RecordHistory.from_dicts(
+                state.pop("hold_profit_history"),
+                state.pop("balance_history"),
+                state.pop("positions_balance_history", {}),
+                state.get("record_dt_format", "%Y-%m-%d %H:%M:%S"),
+            )
+        self.__dict__.update(state)
+
+    @property
+    def hold_profit_history(self) -> Dict[str, float]:
+        """
+        持仓盈亏记录 {时间字符串: 持仓盈亏}（每次获取都会从数组转换，回测中请使用 history）
+        """
+        return self.history.to_dicts(self.record_dt_format)[0]
+
+    @property
+    def balance_history(self) -> Dict[str, float]:
+        """
+        资产历史 {时间字符串: 资产}
+        """
+        return self.history.to_dicts(self.record_dt_format)[1]
+
+    @property
+    def positions_balance_history(self) -> Dict[str, Dict[str, float]]:
+        """
+        持仓资金历史 {时间字符串: {代码: 持仓金额, 'Cash': 现金余额}}
+        """
+        return self.history.to_dicts(self.record_dt_format)[2]
+
     def add_times(self, key, ts):
         if key not in self.use_times.keys():
             self.use_times[key] = 0
@@ -203,9 +232,7 @@ class BackTestTrader(Trader):
             "max_pos": self.max_pos,
             "positions": self.positions,
             "positions_history": self.positions_history,
-            "positions_balance_history": self.positions_balance_history,
-            "hold_profit_history": self.hold_profit_history,
-            "balance_history": self.balance_history,
+            "history": self.history,
             "orders": self.orders,
             "results": self.results,
         }
@@ -234,9 +261,15 @@ class BackTestTrader(Trader):
 
         self.positions = save_infos["positions"]
         self.positions_history = save_infos["positions_history"]
-        self.positions_balance_history = save_infos["positions_balance_history"]
-        self.hold_profit_history = save_infos["hold_profit_history"]
-        self.balance_history = save_infos["balance_history"]
+        if "history" in save_infos.keys():
+            self.history = save_infos["history"]
+        else:
+            self.history = RecordHistory.from_dicts(
+                save_infos["hold_profit_history"],
+                save_infos["balance_history"],
+                save_infos["positions_balance_history"],
+                self.record_dt_format,
+            )
         self.orders = save_infos["orders"]
 
         return True
@@ -355,8 +388,6 @@ class BackTestTrader(Trader):
         """
         更新所有持仓的盈亏情况
         """
-        record_dt = self.get_now_datetime().strftime(self.record_dt_format)
-
         total_hold_profit = 0
         total_hold_balance = 0
         for _uid, pos in self.positions.items():
@@ -366,9 +397,6 @@ class BackTestTrader(Trader):
             total_hold_profit += now_profit
             total_hold_balance += hold_balance
 
-        # 记录时间下的总持仓盈亏
-        self.hold_profit_history[record_dt] = total_hold_profit
-
         # 记录当前的持仓金额
         position_balance = {}
         for _uid, pos in self.positions.items():
@@ -382,12 +410,15 @@ class BackTestTrader(Trader):
             if pos.code not in position_balance.keys():
                 position_balance[pos.code] = 0
             position_balance[pos.code] += code_balance
-        position_balance["Cash"] = self.balance
 
-        self.balance_history[record_dt] = (
-            total_hold_profit + total_hold_balance + self.balance
+        # 记录时间下的总持仓盈亏、总资产、现金余额与持仓金额
+        self.history.record(
+            self.get_now_datetime(),
+            total_hold_profit,
+            total_hold_profit + total_hold_balance + self.balance,
+            self.balance,
+            position_balance,
         )
-        self.positions_balance_history[record_dt] = position_balance
 
         return None
 
@@ -1,9 +1,11 @@
+import functools
 from abc import ABC
 
 import MyTT
 import talib
 
 from chanlun.cl_interface import *
+from chanlun.cl_store import IndicatorCache, get_klines_arrays
 from chanlun.cl_utils import cal_zs_macd_infos
 from chanlun.fun import get_logger
 
@@ -239,6 +241,28 @@ class Trader(ABC):
         """
 
 
+class cache_idx:
+    """
+    策略指标方法的装饰器（替代 staticmethod）
+    通过策略对象调用（self.idx_ma(cd, 5)）时，使用策略的指标缓存，相同 K 线与参数的重复调用直接返回缓存结果
+    通过类调用（Strategy.idx_ma(cd, 5)）时，与 staticmethod 一样直接计算
+    """
+
+    def __init__(self, fun):
+        self.fun = fun
+        functools.update_wrapper(self, fun)
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self.fun
+
+        @functools.wraps(self.fun)
+        def _cache_fun(cd, *args, **kwargs):
+            return obj.get_idx_by_cache(self.fun, cd, *args, **kwargs)
+
+        return _cache_fun
+
+
 class Strategy(ABC):
     """
     交易策略基类
@@ -251,6 +275,10 @@ class Strategy(ABC):
         #       字典格式：{'buy': ['a', 'b'0], 'sell' : ['c', 'd']}，表示 buy 只在做多的仓位中允许，sell 只在做空的仓位中允许
         self.allow_close_uid = None
         self.use_times = {}
+        # 次数统计（比如指标缓存命中与未命中的次数）
+        self.use_counts = {}
+        # 指标计算结果的缓存
+        self.idx_cache = IndicatorCache()
         pass
 
     def add_times(self, key: str, use_time: float):
@@ -260,6 +288,35 @@ class Strategy(ABC):
             self.use_times[key] += use_time
         return True
 
+    def add_counts(self, key: str, nums: int = 1):
+        if getattr(self, "use_counts", None) is None:
+            self.use_counts = {}
+        if key not in self.use_counts.keys():
+            self.use_counts[key] = nums
+        else:
+            self.use_counts[key] += nums
+        return True
+
+    def get_idx_by_cache(self, fun, cd: ICL, *args, **kwargs):
+        """
+        使用缓存计算指标，命中与未命中的次数记录在 use_counts 的 idx_cache_hit 与 idx_cache_miss 中
+        缓存返回的是同一个结果对象，不要对返回的指标数据进行修改
+        """
+        if getattr(self, "idx_cache", None) is None:
+            self.idx_cache = IndicatorCache()
+        try:
+            key = self.idx_cache.make_key(cd, fun.__name__, args, kwargs)
+            hash(key)
+        except TypeError:
+            return fun(cd, *args, **kwargs)
+
+        res = self.idx_cache.get(key, cd)
+        if res is not None:
+            self.add_counts("idx_cache_hit")
+            return res
+        self.add_counts("idx_cache_miss")
+        return self.idx_cache.set(key, cd, fun(cd, *args, **kwargs))
+
     def write_log(self, file_name: str, msg: str):
         log = get_logger(file_name)
         log.info(msg)
@@ -322,51 +379,71 @@ class Strategy(ABC):
         """
         pass
 
-    @staticmethod
+    @cache_idx
     def idx_ma(cd: ICL, period=5, is_all_prices=False):
         """
         返回 MA 指标
         """
+        ks = get_klines_arrays(cd)
         if is_all_prices:
-            prices = np.array([k.c for k in cd.get_klines()])
-        else:
-            prices = np.array([k.c for k in cd.get_klines()[-(period + 120) :]])
-        ma = talib.MA(prices, timeperiod=period)
+            # 全部K线的指标，在之前的计算结果上增量计算
+            return ks.ma(period).copy()
+        start, end = ks.window(period + 120)
+        ma = talib.MA(ks.c[start:end], timeperiod=period)
         return ma
 
-    @staticmethod
+    @cache_idx
     def idx_ema(cd: ICL, period=5, is_all_prices=False):
         """
         返回 EMA 指标
         """
+        ks = get_klines_arrays(cd)
         if is_all_prices:
-            prices = np.array([k.c for k in cd.get_klines()])
-        else:
-            prices = np.array([k.c for k in cd.get_klines()[-(period + 120) :]])
-        ma = talib.EMA(prices, timeperiod=period)
+            # 全部K线的指标，在之前的计算结果上增量计算
+            return ks.ema(period).copy()
+        start, end = ks.window(period + 120)
+        ma = talib.EMA(ks.c[start:end], timeperiod=period)
         return ma
 
-    @staticmethod
+    @cache_idx
+    def idx_macd(cd: ICL, fast=12, slow=26, signal=9, is_all_prices=False):
+        """
+        返回 MACD 指标
+        """
+        ks = get_klines_arrays(cd)
+        if is_all_prices:
+            # 全部K线的指标，在之前的计算结果上增量计算
+            dif, dea, hist = ks.macd(fast, slow, signal)
+            return {"dif": dif.copy(), "dea": dea.copy(), "hist": hist.copy()}
+        start, end = ks.window(max(fast, slow) + signal + 120)
+        dif, dea, hist = talib.MACD(
+            ks.c[start:end], fastperiod=fast, slowperiod=slow, signalperiod=signal
+        )
+        return {"dif": dif, "dea": dea, "hist": hist}
+
+    @cache_idx
     def idx_boll(cd: ICL, period=20):
         """
         返回 boll 指标
         """
-        prices = np.array([k.c for k in cd.get_klines()[-(period + 120) :]])
-        boll_up, boll_mid, boll_low = talib.BBANDS(prices, timeperiod=period)
+        ks = get_klines_arrays(cd)
+        start, end = ks.window(period + 120)
+        boll_up, boll_mid, boll_low = talib.BBANDS(ks.c[start:end], timeperiod=period)
         return {"up": boll_up, "mid": boll_mid, "low": boll_low}
 
-    @staticmethod
+    @cache_idx
     def idx_rsi(cd: ICL, period=14):
         # 指标说明：
         # RSI的基本原理是在一个正常的股市中，多空买卖双方的力道必须得到均衡，股价才能稳定；而RSI是对于固定期间内，股价上涨总幅度平均值占总幅度平均值的比例。
         # 1. RSI值于0 - 100 之间呈常态分配，当6日RSI值为80‰以上时，股市呈超买现象，若出现M头，市场风险较大；当6日RSI值在20‰以下时，股市呈超卖现象，若出现W头，市场机会增大。
         # 2. RSI一般选用6日、12日、24日作为参考基期，基期越长越有趋势性(慢速RSI)，基期越短越有敏感性(快速RSI)。当快速RSI由下往上突破慢速RSI时，机会增大；当快速RSI由上而下跌破慢速RSI时，风险增大。
-        prices = np.array([k.c for k in cd.get_klines()[-(period + 120) :]])
-        rsi = talib.RSI(prices, timeperiod=period)
+        ks = get_klines_arrays(cd)
+        start, end = ks.window(period + 120)
+        rsi = talib.RSI(ks.c[start:end], timeperiod=period)
         return rsi
 
-    @staticmethod
-    def idx_atr(cd: ICL, period=14, end_datetime=None):
+    @cache_idx
+    def idx_atr(cd: ICL, period=14, end_datetime=None, is_all_prices=False):
         # 原理：
         # （1）
         #     A=最高价-最低价
@@ -379,44 +456,32 @@ class Strategy(ABC):
         # 用法：
         #     在上升通道中，ATR真实波幅向上时，且TR黄线上穿ATR蓝线，此时K线收阴者可买入。下降通道中不买。
 
-        close_prices = np.array(
-            [
-                k.c
-                for k in cd.get_klines()[-(period + 500) :]
-                if end_datetime is None or k.date <= end_datetime
-            ]
-        )
-        high_prices = np.array(
-            [
-                k.h
-                for k in cd.get_klines()[-(period + 500) :]
-                if end_datetime is None or k.date <= end_datetime
-            ]
-        )
-        low_prices = np.array(
-            [
-                k.l
-                for k in cd.get_klines()[-(period + 500) :]
-                if end_datetime is None or k.date <= end_datetime
-            ]
+        ks = get_klines_arrays(cd)
+        if is_all_prices:
+            # 全部K线的指标，在之前的计算结果上增量计算
+            _, end = ks.window(None, end_datetime)
+            return ks.atr(period)[:end].copy()
+        start, end = ks.window(period + 500, end_datetime)
+        atr = talib.ATR(
+            ks.h[start:end], ks.l[start:end], ks.c[start:end], timeperiod=period
         )
-        atr = talib.ATR(high_prices, low_prices, close_prices, timeperiod=period)
         return atr
 
-    @staticmethod
+    @cache_idx
     def idx_cci(cd: ICL, period=14):
         # 指标说明：
         # 按市场的通行的标准，CCI指标的运行区间可分为三大类：大于﹢100、小于 - 100 和﹢100——-100 之间。
         # 1. 当CCI＞﹢100 时，表明股价已经进入非常态区间——超买区间，股价的异动现象应多加关注。
         # 2. 当CCI＜-100 时，表明股价已经进入另一个非常态区间——超卖区间，投资者可以逢低吸纳股票。
         # 3. 当CCI介于﹢100——-100 之间时表明股价处于窄幅振荡整理的区间——常态区间，投资者应以观望为主。
-        close_prices = np.array([k.c for k in cd.get_klines()[-(period + 120) :]])
-        high_prices = np.array([k.h for k in cd.get_klines()[-(period + 120) :]])
-        low_prices = np.array([k.l for k in cd.get_klines()[-(period + 120) :]])
-        cci = talib.CCI(high_prices, low_prices, close_prices, timeperiod=period)
+        ks = get_klines_arrays(cd)
+        start, end = ks.window(period + 120)
+        cci = talib.CCI(
+            ks.h[start:end], ks.l[start:end], ks.c[start:end], timeperiod=period
+        )
         return cci
 
-    @staticmethod
+    @cache_idx
     def idx_kdj(cd: ICL, period=9, M1=3, M2=3, end_datetime=None):
         # 指标说明：
         # KDJ，其综合动量观念、强弱指标及移动平均线的优点，早年应用在期货投资方面，功能颇为显著，目前为股市中最常被使用的指标之一。买卖原则：
@@ -426,42 +491,24 @@ class Strategy(ABC):
         # 4. KD值于50 % 左右徘徊或交叉时，无意义。
         # 5. 投机性太强的个股不适用。
         # 6. 可观察KD值同股价的背离，以确认高低点。
-        close_prices = np.array(
-            [
-                k.c
-                for k in cd.get_klines()[-(period + 500) :]
-                if end_datetime is None or k.date <= end_datetime
-            ]
-        )
-        high_prices = np.array(
-            [
-                k.h
-                for k in cd.get_klines()[-(period + 500) :]
-                if end_datetime is None or k.date <= end_datetime
-            ]
-        )
-        low_prices = np.array(
-            [
-                k.l
-                for k in cd.get_klines()[-(period + 500) :]
-                if end_datetime is None or k.date <= end_datetime
-            ]
-        )
+        ks = get_klines_arrays(cd)
+        start, end = ks.window(period + 500, end_datetime)
         k, d, j = MyTT.KDJ(
-            close_prices, high_prices, low_prices, N=period, M1=M1, M2=M2
+            ks.c[start:end], ks.h[start:end], ks.l[start:end], N=period, M1=M1, M2=M2
         )
         return {"k": k, "d": d, "j": j}
 
-    @staticmethod
+    @cache_idx
     def idx_mtm(cd: ICL, N=12, M=6):
         # 参数：N 间隔天数，也是求移动平均的天数，一般为6
         # MTM向上突破零，买入信号
         # MTM向下突破零，卖出信号
-        close_prices = np.array([k.c for k in cd.get_klines()[-(N + 120) :]])
-        mtm, mtma = MyTT.MTM(close_prices, N, M)
+        ks = get_klines_arrays(cd)
+        start, end = ks.window(N + 120)
+        mtm, mtma = MyTT.MTM(ks.c[start:end], N, M)
         return {"mtm": mtm, "mtma": mtma}
 
-    @staticmethod
+    @cache_idx
     def idx_psy(cd: ICL, N=12, M=6):
         # 原理：
         #     心理线是一种建立在研究投资人心理趋向基础上，将某段时间内投资者倾向买方还是卖方的心理与事实转化为数值，形成人气指标，做为买卖的参考。
@@ -473,8 +520,9 @@ class Strategy(ABC):
         #     2.PSY<25为超卖，如形成W底时为卖出信号；
         #     3.心理线主要反映市场心理的超买或超卖，因此，当百分比值在常态区域上下移动时，一般应持观望态度；
         #     4.PSY一般不可单独使用，需配合VR指标和逆时针曲线同时使用，可提高准确度。
-        close_prices = np.array([k.c for k in cd.get_klines()[-(N + 120) :]])
-        psy, psya = MyTT.PSY(close_prices, N, M)
+        ks = get_klines_arrays(cd)
+        start, end = ks.window(N + 120)
+        psy, psya = MyTT.PSY(ks.c[start:end], N, M)
         return {"psy": psy, "psya": psya}
 
     @staticmethod
@@ -507,9 +555,11 @@ class Strategy(ABC):
         """
         获取ATR波动率的止损价格
         """
-        close_prices = np.array([k.c for k in cd.get_klines()[-(atr_period + 200) :]])
-        high_prices = np.array([k.h for k in cd.get_klines()[-(atr_period + 200) :]])
-        low_prices = np.array([k.l for k in cd.get_klines()[-(atr_period + 200) :]])
+        ks = get_klines_arrays(cd)
+        start, end = ks.window(atr_period + 200)
+        close_prices = ks.c[start:end]
+        high_prices = ks.h[start:end]
+        low_prices = ks.l[start:end]
         atr_vals = self.idx_atr_by_sma(
             close_prices, high_prices, low_prices, atr_period
         )
@@ -527,9 +577,11 @@ class Strategy(ABC):
         检查是否触发 ATR 移动止损
         收盘价 大于 or 小于 前一个 atr 止损价格
         """
-        close_prices = np.array([k.c for k in cd.get_klines()[-(atr_period + 200) :]])
-        high_prices = np.array([k.h for k in cd.get_klines()[-(atr_period + 200) :]])
-        low_prices = np.array([k.l for k in cd.get_klines()[-(atr_period + 200) :]])
+        ks = get_klines_arrays(cd)
+        start, end = ks.window(atr_period + 200)
+        close_prices = ks.c[start:end]
+        high_prices = ks.h[start:end]
+        low_prices = ks.l[start:end]
         atr_vals = self.idx_atr_by_sma(
             close_prices, high_prices, low_prices, atr_period
         )
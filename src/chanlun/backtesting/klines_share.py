@@ -0,0 +1,165 @@
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+from pandas.core.arrays import DatetimeArray
+
+"""
+回测 K 线数据的共享存储
+
+多进程回测（run_process）与参数优化（run_optimization）的每个子进程，原本都会各自从数据库读取回测区间内所有的K线数据，并在内存中保存一份
+这里在主进程中将每个 代码-周期 的K线数据只读取一次，写入内存映射文件（numpy .npy 格式）：
+    日期保存为 int64 纳秒时间戳（UTC），open/high/low/close/volume 保存为 float64 的二维数组
+子进程以只读的方式映射文件，数据页由操作系统的页缓存在进程间共享，不会访问数据库，也不会每个进程复制一份全量数据
+子进程中的 DataFrame 直接使用映射的数组作为列（不复制），回测时截取需要的部分K线才会复制
+"""
+
+
+class SharedKlines(object):
+    """
+    K线数据的内存映射文件存储
+    """
+
+    columns = ["open", "high", "low", "close", "volume"]
+
+    def __init__(self, path: Union[str, Path]):
+        """
+        :param path: 存储的目录
+        """
+        self.path = Path(path)
+        self._meta: Union[dict, None] = None
+        # 已经映射的数据 key : (时间戳数组, 使用映射数组的 DataFrame)
+        self._frames: Dict[str, Tuple[np.ndarray, pd.DataFrame]] = {}
+
+    def __getstate__(self):
+        # 传递给子进程只需要目录，子进程中按需重新映射
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    @staticmethod
+    def key(code: str, frequency: str) -> str:
+        return f"{code}-{frequency}"
+
+    @property
+    def meta(self) -> dict:
+        if self._meta is None:
+            with open(self.path / "meta.json", "r", encoding="utf-8") as fp:
+                self._meta = json.load(fp)
+        return self._meta
+
+    def has(self, code: str, frequency: str = None) -> bool:
+        """
+        是否保存有代码（周期）的数据
+        """
+        if frequency is None:
+            return code in self.meta["codes"]
+        return self.key(code, frequency) in self.meta["files"].keys()
+
+    def _load(self, code: str, frequency: str, tz) -> Tuple[np.ndarray, pd.DataFrame]:
+        key = self.key(code, frequency)
+        if key not in self._frames.keys():
+            if key not in self.meta["files"].keys():
+                raise Exception(f"共享K线数据中没有 {code} {frequency} 的数据")
+            _file = self.meta["files"][key]
+            ts = np.load(self.path / f"{_file}_ts.npy", mmap_mode="r")
+            values = np.load(self.path / f"{_file}_values.npy", mmap_mode="r")
+            # copy=False 保证日期列与数值列都是映射数组的视图，代码列是步长为 0 的广播数组，也不占用内存
+            dates = DatetimeArray._simple_new(
+                np.asarray(ts).view("M8[ns]"), dtype=pd.DatetimeTZDtype(tz=tz)
+            )
+            codes = np.broadcast_to(np.array([code], dtype=object), (len(ts),))
+            frame = pd.concat(
+                [
+                    pd.DataFrame({"code": codes, "date": dates}, copy=False),
+                    pd.DataFrame(values, columns=self.columns, copy=False),
+                ],
+                axis=1,
+                copy=False,
+            )
+            self._frames[key] = (ts, frame)
+        return self._frames[key]
+
+    def dates_ts(self, code: str, frequency: str, tz) -> np.ndarray:
+        """
+        获取全部K线的时间戳数组（纳秒，只读）
+        """
+        return self._load(code, frequency, tz)[0]
+
+    def klines(self, code: str, frequency: str, tz) -> pd.DataFrame:
+        """
+        获取全部K线数据（只读，列与 ExchangeDB.klines 返回的相同），使用时截取需要的部分
+        """
+        return self._load(code, frequency, tz)[1]
+
+    def has_loop(self, code: str, frequency: str) -> bool:
+        """
+        是否保存有代码周期的回测循环日期
+        """
+        return self.key(code, frequency) in self.meta["loop_starts"].keys()
+
+    def loop_dates(self, code: str, frequency: str, tz) -> List[pd.Timestamp]:
+        """
+        获取回测循环的日期列表（回测开始时间之后的K线日期）
+        """
+        key = self.key(code, frequency)
+        if key not in self.meta["loop_starts"].keys():
+            raise Exception(f"共享K线数据中没有 {code} {frequency} 的循环日期")
+        dates = self.klines(code, frequency, tz)["date"]
+        return dates.iloc[self.meta["loop_starts"][key] :].to_list()
+
+    def write(self, code: str, frequency: str, klines: pd.DataFrame, loop_start=None):
+        """
+        写入一个 代码-周期 的K线数据（构建时使用）
+        :param klines: 按时间排序的K线数据
+        :param loop_start: 回测循环日期在K线中的开始位置，None 则不作为循环日期使用
+        """
+        key = self.key(code, frequency)
+        _file = str(len(self._meta["files"]))
+        if len(klines) == 0:
+            ts = np.array([], dtype=np.int64)
+            values = np.zeros((0, len(self.columns)), dtype=np.float64)
+        else:
+            ts = pd.to_datetime(klines["date"]).values.view(np.int64)
+            values = klines[self.columns].to_numpy(dtype=np.float64)
+        np.save(self.path / f"{_file}_ts.npy", ts)
+        np.save(self.path / f"{_file}_values.npy", values)
+        self._meta["files"][key] = _file
+        if code not in self._meta["codes"]:
+            self._meta["codes"].append(code)
+        if loop_start is not None:
+            self._meta["loop_starts"][key] = int(loop_start)
+        return True
+
+    def write_meta(self):
+        with open(self.path / "meta.json", "w", encoding="utf-8") as fp:
+            json.dump(self._meta, fp, ensure_ascii=False)
+        return True
+
+    def remove(self):
+        """
+        删除存储的文件（已经映射的进程在关闭前仍然可以读取）
+        """
+        self._frames = {}
+        self._meta = None
+        if self.path.is_dir():
+            shutil.rmtree(self.path, ignore_errors=True)
+        return True
+
+    @classmethod
+    def create(cls, path: Union[str, Path]) -> "SharedKlines":
+        """
+        创建新的存储目录，存在则先删除
+        """
+        path = Path(path)
+        if path.is_dir():
+            shutil.rmtree(path)
+        os.makedirs(path)
+        shared = cls(path)
+        shared._meta = {"codes": [], "files": {}, "loop_starts": {}}
+        return shared
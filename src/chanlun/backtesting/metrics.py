@@ -0,0 +1,194 @@
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from chanlun.backtesting.record_history import RecordHistory
+
+"""
+回测结果的指标计算
+
+资产历史使用 RecordHistory 中的时间与资产数组，买卖点的统计使用 trader.results，都使用数组一次计算，不需要遍历与解析时间字符串
+BackTest.result 输出的指标，与参数优化的评价指标（BackTest.metrics）都使用这里的方法，
+从结果存储加载的回测，只需要读取资产历史表与统计信息，不需要加载历史持仓
+"""
+
+# 买卖点的名称
+MMD_NAMES = {
+    "1buy": "一类买点",
+    "2buy": "二类买点",
+    "l2buy": "类二类买点",
+    "3buy": "三类买点",
+    "l3buy": "类三类买点",
+    "down_bi_bc_buy": "下跌笔背驰",
+    "down_xd_bc_buy": "下跌线段背驰",
+    "down_pz_bc_buy": "下跌盘整背驰",
+    "down_qs_bc_buy": "下跌趋势背驰",
+    "1sell": "一类卖点",
+    "2sell": "二类卖点",
+    "l2sell": "类二类卖点",
+    "3sell": "三类卖点",
+    "l3sell": "类三类卖点",
+    "up_bi_bc_sell": "上涨笔背驰",
+    "up_xd_bc_sell": "上涨线段背驰",
+    "up_pz_bc_sell": "上涨盘整背驰",
+    "up_qs_bc_sell": "上涨趋势背驰",
+}
+
+
+def day_balances(history: RecordHistory) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    按照日期聚合资产历史，每日最后的资产
+    :return: 日期数组（datetime64[D]），资产数组
+    """
+    days = history.dts.astype("M8[D]")
+    if len(days) == 0:
+        return days, history.balances
+    last_idx = np.append(np.flatnonzero(days[1:] != days[:-1]), len(days) - 1)
+    return days[last_idx], history.balances[last_idx]
+
+
+def balance_metrics(
+    history: RecordHistory,
+    init_balance: float,
+    annual_days: int = 365,
+    risk_free: float = 0.03,
+) -> dict:
+    """
+    根据资产历史计算交易模式的指标（日收益率、回撤、Sharpe 等）
+    :param history: 资产历史记录
+    :param init_balance: 初始资金
+    :param annual_days: 每年交易日
+    :param risk_free: 无风险收益率
+    """
+    days, balances = day_balances(history)
+    total_days = len(days)
+    if total_days == 0:
+        return {}
+
+    pre_balances = np.empty(total_days, dtype=np.float64)
+    pre_balances[0] = init_balance
+    pre_balances[1:] = balances[:-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = balances / pre_balances
+        x[x <= 0] = np.nan
+        returns = np.log(x)
+    returns[np.isnan(returns)] = 0
+
+    high_levels = np.maximum.accumulate(balances)
+    drawdowns = balances - high_levels
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ddpercents = drawdowns / high_levels * 100
+
+    max_drawdown_end = int(np.argmin(drawdowns))
+    max_drawdown_start = int(np.argmax(balances[: max_drawdown_end + 1]))
+    max_drawdown_duration = int(
+        (days[max_drawdown_end] - days[max_drawdown_start]).astype(np.int64)
+    )
+
+    end_balance = balances[-1]
+    total_return = (end_balance / init_balance - 1) * 100
+    annual_return = total_return / total_days * annual_days
+    daily_return = returns.mean() * 100
+    return_std = (
+        returns.std(ddof=1) * 100 if total_days > 1 else np.float64(np.nan)
+    )
+    if return_std:
+        daily_risk_free = risk_free / np.sqrt(annual_days)
+        sharpe_ratio = (
+            (daily_return - daily_risk_free) / return_std * np.sqrt(annual_days)
+        )
+    else:
+        sharpe_ratio = 0
+    max_ddpercent = np.nanmin(ddpercents)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return_drawdown_ratio = -total_return / max_ddpercent
+
+    tz = "Asia/Shanghai"
+    return {
+        "start_date": pd.Timestamp(days[0]).tz_localize(tz),
+        "end_date": pd.Timestamp(days[-1]).tz_localize(tz),
+        "total_days": total_days,
+        "end_balance": end_balance,
+        "total_return": total_return,
+        "annual_return": annual_return,
+        "max_drawdown": drawdowns.min(),
+        "max_ddpercent": max_ddpercent,
+        "max_drawdown_duration": max_drawdown_duration,
+        "daily_return": daily_return,
+        "return_std": return_std,
+        "sharpe_ratio": sharpe_ratio,
+        "return_drawdown_ratio": return_drawdown_ratio,
+    }
+
+
+def mmd_metrics(results: Dict[str, dict]) -> pd.DataFrame:
+    """
+    根据 trader.results 计算每个买卖点与汇总的统计（胜率、盈亏比等）
+    :return: 索引为买卖点（汇总为 total）的 DataFrame
+    """
+    mmds = list(results.keys()) + ["total"]
+    win_nums = np.array([results[_m]["win_num"] for _m in results], dtype=np.int64)
+    loss_nums = np.array(
+        [results[_m]["loss_num"] for _m in results], dtype=np.int64
+    )
+    win_balances = np.array(
+        [results[_m]["win_balance"] for _m in results], dtype=np.float64
+    )
+    loss_balances = np.array(
+        [results[_m]["loss_balance"] for _m in results], dtype=np.float64
+    )
+    # 汇总按照买卖点的顺序累加
+    win_nums = np.append(win_nums, win_nums.sum())
+    loss_nums = np.append(loss_nums, loss_nums.sum())
+    win_balances = np.append(
+        win_balances, np.cumsum(np.append(0.0, win_balances))[-1]
+    )
+    loss_balances = np.append(
+        loss_balances, np.cumsum(np.append(0.0, loss_balances))[-1]
+    )
+
+    def _div(a, b, mul=1):
+        # 除数为 0 的结果为 0
+        out = np.zeros(len(a), dtype=np.float64)
+        np.divide(a, b, out=out, where=b != 0)
+        return out * mul
+
+    trade_nums = win_nums + loss_nums
+    win_means = _div(win_balances, win_nums)
+    loss_means = _div(loss_balances, loss_nums)
+    return pd.DataFrame(
+        {
+            "win_num": win_nums,
+            "loss_num": loss_nums,
+            "trade_num": trade_nums,
+            "win_rate": _div(win_nums, trade_nums, 100),
+            "win_balance": win_balances,
+            "loss_balance": loss_balances,
+            "net_balance": win_balances - loss_balances,
+            "back_rate": _div(loss_balances, win_balances, 100),
+            "win_mean_balance": win_means,
+            "loss_mean_balance": loss_means,
+            "ykb": np.where(win_means != 0, _div(win_means, loss_means), 0),
+        },
+        index=mmds,
+    )
+
+
+def backtest_metrics(
+    mode: str,
+    history: RecordHistory,
+    results: Dict[str, dict],
+    init_balance: float,
+    fee_total: float = 0,
+    annual_days: int = 365,
+) -> dict:
+    """
+    回测的所有指标（交易模式的资产指标 + 买卖点汇总统计），用于参数优化的评价
+    """
+    metrics = {"total_fee": fee_total}
+    if mode == "trade":
+        metrics.update(balance_metrics(history, init_balance, annual_days))
+    df = mmd_metrics(results)
+    metrics.update({_c: df[_c].iloc[-1].item() for _c in df.columns})
+    return metrics
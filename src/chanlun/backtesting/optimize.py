@@ -1,34 +1,394 @@
-"""
-策略参数优化
-"""
-from itertools import product
-from typing import List
-
-
-class OptimizationSetting:
-    """
-    策略参数优化设置
-    """
-
-    def __init__(self):
-        # 缠论配置的参数优化配置
-        self.cl_config_params = {}
-
-    def add_cl_parameter(self, name: str, values: list):
-        """
-        添加缠论的参数配置
-        """
-        self.cl_config_params[name] = values
-
-    def generate_cl_settings(self) -> List[dict]:
-        """"""
-        keys = self.cl_config_params.keys()
-        values = self.cl_config_params.values()
-        products = list(product(*values))
-
-        settings = []
-        for p in products:
-            setting = dict(zip(keys, p))
-            settings.append(setting)
-
-        return settings
+"""
+策略参数优化
+"""
+import math
+import random
+from itertools import product
+from typing import Dict, List, Union
+
+
+class OptimizationSetting:
+    """
+    策略参数优化设置
+    """
+
+    def __init__(self):
+        # 缠论配置的参数优化配置
+        self.cl_config_params = {}
+
+    def add_cl_parameter(self, name: str, values: list):
+        """
+        添加缠论的参数配置
+        """
+        self.cl_config_params[name] = values
+
+    def generate_cl_settings(self) -> List[dict]:
+        """"""
+        keys = self.cl_config_params.keys()
+        values = self.cl_config_params.values()
+        products = list(product(*values))
+
+        settings = []
+        for p in products:
+            setting = dict(zip(keys, p))
+            settings.append(setting)
+
+        return settings
+
+    def cl_settings_nums(self) -> int:
+        """
+        参数组合的总数量
+        """
+        return math.prod([len(_v) for _v in self.cl_config_params.values()])
+
+    def get_cl_setting(self, idx: int) -> dict:
+        """
+        获取指定序号的参数组合（与 generate_cl_settings 返回的顺序相同），不需要生成所有的组合
+        """
+        setting = {}
+        for _k, _v in reversed(list(self.cl_config_params.items())):
+            idx, _i = divmod(idx, len(_v))
+            setting[_k] = _v[_i]
+        return {_k: setting[_k] for _k in self.cl_config_params.keys()}
+
+    def generate_random_cl_settings(self, nums: int, seed: int = None) -> List[dict]:
+        """
+        随机抽取不重复的参数组合
+        """
+        total = self.cl_settings_nums()
+        rd = random.Random(seed)
+        idxs = rd.sample(range(total), min(nums, total))
+        return [self.get_cl_setting(_i) for _i in idxs]
+
+
+class EarlyStopping:
+    """
+    参数优化的提前停止，作为回测的循环回调方法使用
+
+    每隔 check_interval 次循环，记录当前的资金（trader.history 中的最新资产），
+    回测进度超过 min_progress 后，与相同回测区间已完成回测中最终资金最高的参考记录，在相同时间进行比较，
+    资金落后参考记录超过 基准资金 * tolerance，认为已经明显较差，停止这个参数的回测
+    相同回测区间还没有完成的回测，则使用较短回测区间的参考记录（开始时间相同，是当前回测区间的前一部分）
+    参考记录在每个回测完成后立即更新（run_optimization 中），之后开始的回测使用最新的参考记录
+    基准资金：trade 模式为初始资金，signal 模式为每个持仓的固定金额 100000
+    """
+
+    def __init__(
+        self, tolerance: float = 0.1, min_progress: float = 0.3, check_interval: int = 50
+    ):
+        """
+        :param tolerance: 落后参考记录的资金，超过基准资金的比例，则停止
+        :param min_progress: 回测进度超过这个比例后才进行判断
+        :param check_interval: 每隔多少次循环记录并判断一次
+        """
+        self.tolerance = tolerance
+        self.min_progress = min_progress
+        self.check_interval = check_interval
+
+        # 每个回测区间的参考记录 区间比例 : {时间: 资金}
+        self.references: Dict[float, Dict[str, float]] = {}
+
+        # 当前回测的状态
+        self.reference: Union[Dict[str, float], None] = None
+        self.curve: Dict[str, float] = {}
+        self.stopped = False
+        self._loop_nums = 0
+        self._total_nums = None
+
+    def reference_for(self, window: float) -> Union[Dict[str, float], None]:
+        """
+        回测区间的参考记录，没有则使用较短回测区间中最长区间的参考记录（例如连续减半搜索上一轮最好的资金记录）
+        """
+        if window in self.references.keys():
+            return self.references[window]
+        shorter_windows = [_w for _w in self.references.keys() if _w < window]
+        if len(shorter_windows) == 0:
+            return None
+        return self.references[max(shorter_windows)]
+
+    def start(self, window: float):
+        """
+        开始一个新的回测，使用回测区间的参考记录
+        """
+        self.reference = self.reference_for(window)
+        self.curve = {}
+        self.stopped = False
+        self._loop_nums = 0
+        self._total_nums = None
+
+    def update(self, window: float, results: List[dict]):
+        """
+        根据完成的回测结果，更新回测区间的参考记录
+        """
+        for _r in results:
+            if _r.get("stopped") or not _r.get("curve"):
+                continue
+            ref = self.references.get(window)
+            if ref is None or list(_r["curve"].values())[-1] > list(ref.values())[-1]:
+                self.references[window] = _r["curve"]
+
+    def __call__(self, bt) -> bool:
+        """
+        回测循环的回调方法，返回 False 则停止回测
+        """
+        self._loop_nums += 1
+        if self._total_nums is None:
+            self._total_nums = self._loop_nums + len(
+                bt.datas.loop_datetime_list[bt.next_frequency]
+            )
+        if self._loop_nums % self.check_interval != 0:
+            return True
+        if bt.trader.history.size == 0:
+            return True
+
+        dt = bt.datas.now_date.strftime("%Y-%m-%d %H:%M:%S")
+        self.curve[dt] = float(bt.trader.history.balances[-1])
+        if (
+            self.reference is None
+            or dt not in self.reference.keys()
+            or self._loop_nums / self._total_nums < self.min_progress
+        ):
+            return True
+
+        base_balance = bt.init_balance if bt.mode == "trade" else 100000
+        if self.reference[dt] - self.curve[dt] > base_balance * self.tolerance:
+            self.stopped = True
+            return False
+        return True
+
+
+class OptimizationSearch:
+    """
+    参数优化的搜索策略基类
+
+    run_optimization 循环调用 ask 获取需要回测的参数，回测完成后调用 tell 传入结果，直到 ask 返回空列表
+    每个回测项 {'params': 参数, 'window': 回测区间的比例（从开始时间起，1 为完整的回测区间）}
+    回测结果在回测项的基础上增加 end_balance（评价指标）、save_file、stopped（是否提前停止）、curve（资金记录）
+    """
+
+    def __init__(self, setting: OptimizationSetting):
+        self.setting = setting
+        # 完整回测区间（并且没有提前停止）的回测结果
+        self.results: List[dict] = []
+
+    def ask(self) -> List[dict]:
+        raise NotImplementedError
+
+    def tell(self, results: List[dict]):
+        for _r in results:
+            if _r["window"] >= 1 and not _r.get("stopped"):
+                self.results.append(_r)
+
+
+class GridSearch(OptimizationSearch):
+    """
+    穷举所有的参数组合
+    """
+
+    def __init__(self, setting: OptimizationSetting):
+        super().__init__(setting)
+        self._asked = False
+
+    def ask(self) -> List[dict]:
+        if self._asked:
+            return []
+        self._asked = True
+        return [
+            {"params": _s, "window": 1} for _s in self.setting.generate_cl_settings()
+        ]
+
+
+class RandomSearch(OptimizationSearch):
+    """
+    随机抽取指定数量的参数组合
+    """
+
+    def __init__(self, setting: OptimizationSetting, nums: int, seed: int = None):
+        super().__init__(setting)
+        self.nums = nums
+        self.seed = seed
+        self._asked = False
+
+    def ask(self) -> List[dict]:
+        if self._asked:
+            return []
+        self._asked = True
+        return [
+            {"params": _s, "window": 1}
+            for _s in self.setting.generate_random_cl_settings(self.nums, self.seed)
+        ]
+
+
+class SuccessiveHalvingSearch(OptimizationSearch):
+    """
+    连续减半搜索
+
+    随机抽取 nums 个参数组合，先在较短的回测区间（从开始时间起）中回测，
+    保留结果最好的 1/eta 参数，在 eta 倍长度的回测区间中继续回测，直到完整的回测区间
+    """
+
+    def __init__(
+        self,
+        setting: OptimizationSetting,
+        nums: int = 81,
+        eta: int = 3,
+        rounds: int = None,
+        seed: int = None,
+    ):
+        """
+        :param nums: 第一轮回测的参数数量
+        :param eta: 每轮保留的比例 1/eta，回测区间增长 eta 倍
+        :param rounds: 回测的轮数，默认根据 nums 与 eta 计算，最后一轮至少保留一个参数
+        :param seed: 随机种子
+        """
+        super().__init__(setting)
+        self.nums = min(nums, setting.cl_settings_nums())
+        self.eta = eta
+        if rounds is None:
+            rounds = 1
+            while self.nums // (eta**rounds) >= 1:
+                rounds += 1
+        self.rounds = rounds
+        self.seed = seed
+        # 每一轮的回测区间比例
+        self.windows = [float(eta ** (_r - rounds + 1)) for _r in range(rounds)]
+
+        self._round = 0
+        self._asked = False
+        self._round_results: List[dict] = []
+
+    def ask(self) -> List[dict]:
+        if self._round >= self.rounds or self._asked:
+            return []
+        self._asked = True
+        window = self.windows[self._round]
+        if self._round == 0:
+            settings = self.setting.generate_random_cl_settings(self.nums, self.seed)
+        else:
+            keep_nums = max(1, math.ceil(len(self._round_results) / self.eta))
+            # 提前停止的参数排在最后
+            ranked = sorted(
+                self._round_results,
+                key=lambda _r: (not _r.get("stopped"), _r["end_balance"]),
+                reverse=True,
+            )
+            settings = [_r["params"] for _r in ranked[:keep_nums]]
+        return [{"params": _s, "window": window} for _s in settings]
+
+    def tell(self, results: List[dict]):
+        super().tell(results)
+        self._round_results = results
+        self._round += 1
+        self._asked = False
+
+
+class TPESearch(OptimizationSearch):
+    """
+    TPE（Tree-structured Parzen Estimator）贝叶斯优化
+
+    先随机回测 startup_nums 个参数，之后按照评价指标，将已回测的参数分为较好（前 gamma 比例）与较差两组，
+    每个参数按照两组中各个取值出现的次数（加一平滑）估计分布 l(x) 与 g(x)，
+    从 l(x) 中抽取 candidate_nums 个候选参数，选择 l(x)/g(x) 最大且未回测过的参数，每批回测 batch_nums 个
+    """
+
+    def __init__(
+        self,
+        setting: OptimizationSetting,
+        nums: int = 100,
+        startup_nums: int = 20,
+        batch_nums: int = 8,
+        gamma: float = 0.25,
+        candidate_nums: int = 24,
+        seed: int = None,
+    ):
+        """
+        :param nums: 回测的参数总数量
+        :param startup_nums: 开始时随机回测的参数数量
+        :param batch_nums: 每批回测的参数数量（建议与进程数量相同）
+        :param gamma: 较好参数的比例
+        :param candidate_nums: 每次选择参数时抽取的候选数量
+        :param seed: 随机种子
+        """
+        super().__init__(setting)
+        self.nums = min(nums, setting.cl_settings_nums())
+        self.startup_nums = min(startup_nums, self.nums)
+        self.batch_nums = batch_nums
+        self.gamma = gamma
+        self.candidate_nums = candidate_nums
+        self.rd = random.Random(seed)
+
+        self._tried: Dict[str, dict] = {}
+        self._observed: List[dict] = []
+
+    @staticmethod
+    def _key(params: dict) -> str:
+        return str(sorted(params.items(), key=lambda _i: _i[0]))
+
+    def _random_setting(self) -> dict:
+        return self.setting.get_cl_setting(
+            self.rd.randrange(self.setting.cl_settings_nums())
+        )
+
+    def _suggest(self) -> dict:
+        ranked = sorted(
+            self._observed,
+            key=lambda _r: (not _r.get("stopped"), _r["end_balance"]),
+            reverse=True,
+        )
+        good_nums = max(1, int(math.ceil(len(ranked) * self.gamma)))
+        goods = ranked[:good_nums]
+        bads = ranked[good_nums:]
+
+        # 每个参数的取值分布（加一平滑）
+        l_weights = {}
+        g_weights = {}
+        for _k, _values in self.setting.cl_config_params.items():
+            l_counts = [1.0] * len(_values)
+            g_counts = [1.0] * len(_values)
+            for _r in goods:
+                l_counts[_values.index(_r["params"][_k])] += 1
+            for _r in bads:
+                g_counts[_values.index(_r["params"][_k])] += 1
+            l_weights[_k] = [_c / sum(l_counts) for _c in l_counts]
+            g_weights[_k] = [_c / sum(g_counts) for _c in g_counts]
+
+        best_score = None
+        best_setting = None
+        for _ in range(self.candidate_nums):
+            setting = {}
+            score = 1.0
+            for _k, _values in self.setting.cl_config_params.items():
+                _i = self.rd.choices(range(len(_values)), weights=l_weights[_k])[0]
+                setting[_k] = _values[_i]
+                score *= l_weights[_k][_i] / g_weights[_k][_i]
+            if self._key(setting) in self._tried.keys():
+                continue
+            if best_score is None or score > best_score:
+                best_score = score
+                best_setting = setting
+        return best_setting
+
+    def ask(self) -> List[dict]:
+        settings = []
+        while (
+            len(self._tried) < self.nums
+            and len(settings) < self.batch_nums
+            and len(self._tried) < self.setting.cl_settings_nums()
+        ):
+            if len(self._tried) < self.startup_nums:
+                setting = self._random_setting()
+            else:
+                # 候选参数都已经回测过，随机选择一个
+                setting = self._suggest() or self._random_setting()
+            if self._key(setting) in self._tried.keys():
+                continue
+            self._tried[self._key(setting)] = setting
+            settings.append(setting)
+            if len(self._tried) == self.startup_nums:
+                # 随机阶段结束，等待结果后再进行估计
+                break
+        return [{"params": _s, "window": 1} for _s in settings]
+
+    def tell(self, results: List[dict]):
+        super().tell(results)
+        self._observed.extend(results)
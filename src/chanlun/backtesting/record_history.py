@@ -0,0 +1,327 @@
+import calendar
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+"""
+回测交易的持仓盈亏、资产、持仓资金历史记录
+
+BackTestTrader.update_position_record 每次循环都会记录一次，原来使用格式化的时间字符串作为 key 保存在三个字典中，
+持仓资金历史每次还会保存一个代码的字典，长时间的小周期回测会产生大量的小对象
+这里使用预先分配的 numpy 数组记录（容量不足时按倍数扩展）：
+    时间（本地时间，精确到秒）、总持仓盈亏、总资产、现金余额，每次记录一行
+    每个代码的持仓金额，按照稀疏的 (记录序号, 代码序号, 金额) 三元组记录，只记录有持仓的代码
+回测结果的统计与图表直接使用数组，不需要解析时间字符串
+"""
+
+
+def _wall_ns(dt) -> int:
+    # 时间的本地时间（带时区的时间使用其时区的时间），精确到秒，转换为纳秒
+    if isinstance(dt, pd.Timestamp):
+        ns = dt.value
+        if dt.tzinfo is not None:
+            ns += int(dt.tzinfo.utcoffset(dt).total_seconds()) * 1000000000
+        return ns - ns % 1000000000
+    return calendar.timegm(dt.timetuple()) * 1000000000
+
+
+def _grow(arr: np.ndarray, size: int) -> np.ndarray:
+    new_arr = np.empty(max(size, len(arr) * 2), dtype=arr.dtype)
+    new_arr[: len(arr)] = arr
+    return new_arr
+
+
+class RecordHistory(object):
+    """
+    持仓盈亏、资产、持仓资金历史的数组记录
+    """
+
+    def __init__(self, capacity: int = 1024):
+        """
+        :param capacity: 预先分配的记录数量
+        """
+        self.size = 0
+        self._dts = np.empty(capacity, dtype=np.int64)
+        self._hold_profits = np.empty(capacity, dtype=np.float64)
+        self._balances = np.empty(capacity, dtype=np.float64)
+        self._cashs = np.empty(capacity, dtype=np.float64)
+
+        # 代码的持仓金额记录
+        self.codes: List[str] = []
+        self._code_ids: Dict[str, int] = {}
+        self.pos_size = 0
+        self._pos_steps = np.empty(capacity, dtype=np.int64)
+        self._pos_code_ids = np.empty(capacity, dtype=np.int32)
+        self._pos_values = np.empty(capacity, dtype=np.float64)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def dts(self) -> np.ndarray:
+        """
+        记录时间（本地时间的 datetime64[ns]）
+        """
+        return self._dts[: self.size].view("M8[ns]")
+
+    @property
+    def hold_profits(self) -> np.ndarray:
+        return self._hold_profits[: self.size]
+
+    @property
+    def balances(self) -> np.ndarray:
+        return self._balances[: self.size]
+
+    @property
+    def cashs(self) -> np.ndarray:
+        return self._cashs[: self.size]
+
+    @property
+    def pos_steps(self) -> np.ndarray:
+        return self._pos_steps[: self.pos_size]
+
+    @property
+    def pos_code_ids(self) -> np.ndarray:
+        return self._pos_code_ids[: self.pos_size]
+
+    @property
+    def pos_values(self) -> np.ndarray:
+        return self._pos_values[: self.pos_size]
+
+    def code_id(self, code: str) -> int:
+        if code not in self._code_ids.keys():
+            self._code_ids[code] = len(self.codes)
+            self.codes.append(code)
+        return self._code_ids[code]
+
+    def record(
+        self,
+        dt,
+        hold_profit: float,
+        balance: float,
+        cash: float,
+        position_balance: Dict[str, float],
+    ):
+        """
+        记录一次
+        :param dt: 记录时间，与上一次记录的时间（精确到秒）相同，则覆盖上一次的记录
+        :param hold_profit: 总持仓盈亏
+        :param balance: 总资产
+        :param cash: 现金余额
+        :param position_balance: 代码的持仓金额
+        """
+        ts = _wall_ns(dt)
+        if self.size > 0 and self._dts[self.size - 1] == ts:
+            step = self.size - 1
+            while self.pos_size > 0 and self._pos_steps[self.pos_size - 1] == step:
+                self.pos_size -= 1
+        else:
+            if self.size == len(self._dts):
+                self._dts = _grow(self._dts, self.size + 1)
+                self._hold_profits = _grow(self._hold_profits, self.size + 1)
+                self._balances = _grow(self._balances, self.size + 1)
+                self._cashs = _grow(self._cashs, self.size + 1)
+            step = self.size
+            self.size += 1
+        self._dts[step] = ts
+        self._hold_profits[step] = hold_profit
+        self._balances[step] = balance
+        self._cashs[step] = cash
+
+        if self.pos_size + len(position_balance) > len(self._pos_steps):
+            _size = self.pos_size + len(position_balance)
+            self._pos_steps = _grow(self._pos_steps, _size)
+            self._pos_code_ids = _grow(self._pos_code_ids, _size)
+            self._pos_values = _grow(self._pos_values, _size)
+        for _code, _b in position_balance.items():
+            self._pos_steps[self.pos_size] = step
+            self._pos_code_ids[self.pos_size] = self.code_id(_code)
+            self._pos_values[self.pos_size] = _b
+            self.pos_size += 1
+        return True
+
+    def balance_series(self) -> pd.Series:
+        """
+        资产历史（时间索引）
+        """
+        return pd.Series(self.balances, index=pd.DatetimeIndex(self.dts))
+
+    def hold_profit_series(self) -> pd.Series:
+        """
+        持仓盈亏历史（时间索引）
+        """
+        return pd.Series(self.hold_profits, index=pd.DatetimeIndex(self.dts))
+
+    def positions_frame(self) -> pd.DataFrame:
+        """
+        持仓资金历史 (dt, code, balance)，每次记录的现金余额代码为 Cash
+        """
+        steps = np.concatenate([self.pos_steps, np.arange(self.size)])
+        codes = np.array(self.codes + ["Cash"], dtype=object)
+        code_ids = np.concatenate(
+            [self.pos_code_ids, np.full(self.size, len(self.codes), dtype=np.int32)]
+        )
+        values = np.concatenate([self.pos_values, self.cashs])
+        order = np.argsort(steps, kind="stable")
+        return pd.DataFrame(
+            {
+                "dt": self.dts[steps[order]],
+                "code": codes[code_ids[order]],
+                "balance": values[order],
+            }
+        )
+
+    def dt_strs(self, fmt: str) -> List[str]:
+        return pd.DatetimeIndex(self.dts).strftime(fmt).to_list()
+
+    def to_dicts(self, fmt: str) -> tuple:
+        """
+        转换为之前的字典形式 (持仓盈亏历史, 资产历史, 持仓资金历史)，key 为格式化的时间字符串
+        """
+        dts = self.dt_strs(fmt)
+        hold_profit_history = dict(zip(dts, self.hold_profits.tolist()))
+        balance_history = dict(zip(dts, self.balances.tolist()))
+        positions_balance_history = {_dt: {} for _dt in dts}
+        for _s, _c, _v in zip(
+            self.pos_steps.tolist(), self.pos_code_ids.tolist(), self.pos_values.tolist()
+        ):
+            positions_balance_history[dts[_s]][self.codes[_c]] = _v
+        for _dt, _cash in zip(dts, self.cashs.tolist()):
+            positions_balance_history[_dt]["Cash"] = _cash
+        return hold_profit_history, balance_history, positions_balance_history
+
+    @classmethod
+    def from_dicts(
+        cls,
+        hold_profit_history: dict,
+        balance_history,
+        positions_balance_history: dict,
+        fmt: str = "%Y-%m-%d %H:%M:%S",
+    ) -> "RecordHistory":
+        """
+        从之前的字典形式转换（资产历史也可以是多进程回测合并后的 pd.Series）
+        """
+        dts = list(balance_history.keys())
+        history = cls(max(len(dts), 1))
+        if len(dts) == 0:
+            return history
+        ts = pd.to_datetime(dts, format=fmt).values.view(np.int64)
+        for _i, _dt in enumerate(dts):
+            position_balance = dict(positions_balance_history.get(_dt, {}))
+            cash = position_balance.pop("Cash", 0)
+            history.record(
+                pd.Timestamp(ts[_i]),
+                hold_profit_history.get(_dt, 0),
+                balance_history[_dt],
+                cash,
+                position_balance,
+            )
+        return history
+
+    @classmethod
+    def from_frames(
+        cls, history_df: pd.DataFrame, positions_df: pd.DataFrame
+    ) -> "RecordHistory":
+        """
+        从保存的表格中恢复
+        :param history_df: (dt, hold_profit, balance, cash)
+        :param positions_df: (step, code, balance)
+        """
+        history = cls(max(len(history_df), 1))
+        if len(history_df) == 0:
+            return history
+        history.size = len(history_df)
+        history._dts = (
+            history_df["dt"].to_numpy(dtype="M8[ns]").view(np.int64).copy()
+        )
+        history._hold_profits = history_df["hold_profit"].to_numpy(dtype=np.float64)
+        history._balances = history_df["balance"].to_numpy(dtype=np.float64)
+        history._cashs = history_df["cash"].to_numpy(dtype=np.float64)
+        if len(positions_df) > 0:
+            codes, code_ids = np.unique(
+                positions_df["code"].to_numpy(dtype=object), return_inverse=True
+            )
+            history.codes = codes.tolist()
+            history._code_ids = {_c: _i for _i, _c in enumerate(history.codes)}
+            history.pos_size = len(positions_df)
+            history._pos_steps = positions_df["step"].to_numpy(dtype=np.int64)
+            history._pos_code_ids = code_ids.astype(np.int32)
+            history._pos_values = positions_df["balance"].to_numpy(dtype=np.float64)
+        return history
+
+    def to_frames(self) -> tuple:
+        """
+        转换为保存的表格 (dt, hold_profit, balance, cash), (step, code, balance)
+        """
+        history_df = pd.DataFrame(
+            {
+                "dt": self.dts,
+                "hold_profit": self.hold_profits,
+                "balance": self.balances,
+                "cash": self.cashs,
+            }
+        )
+        positions_df = pd.DataFrame(
+            {
+                "step": self.pos_steps,
+                "code": np.array(self.codes, dtype=object)[self.pos_code_ids],
+                "balance": self.pos_values,
+            }
+        )
+        return history_df, positions_df
+
+    @classmethod
+    def merge(cls, histories: List["RecordHistory"]) -> "RecordHistory":
+        """
+        合并多个记录（多进程回测每个代码的记录）
+        时间取并集，持仓盈亏按时间求和，资产与现金余额按时间对齐（向前填充）后求和，代码的持仓金额合并
+        """
+        histories = [_h for _h in histories if _h.size > 0]
+        merged = cls(max(sum([_h.size for _h in histories]), 1))
+        if len(histories) == 0:
+            return merged
+        dts = np.unique(np.concatenate([_h._dts[: _h.size] for _h in histories]))
+        merged.size = len(dts)
+        merged._dts = dts
+
+        # 按照顺序累加（与逐个合并字典的结果一致）
+        hold_profits = np.zeros(len(dts), dtype=np.float64)
+        steps_map = []
+        for _h in histories:
+            _idx = np.searchsorted(dts, _h._dts[: _h.size])
+            hold_profits[_idx] += _h.hold_profits
+            steps_map.append(_idx)
+        merged._hold_profits = hold_profits
+
+        index = pd.DatetimeIndex(dts.view("M8[ns]"))
+        for _attr, _name in [("_balances", "balances"), ("_cashs", "cashs")]:
+            df = pd.DataFrame(
+                {
+                    _i: pd.Series(getattr(_h, _name), index=pd.DatetimeIndex(_h.dts))
+                    for _i, _h in enumerate(histories)
+                }
+            )
+            df = df.reindex(index).sort_index().ffill().fillna(0)
+            setattr(merged, _attr, df.sum(axis=1).to_numpy(dtype=np.float64))
+
+        steps = []
+        code_ids = []
+        values = []
+        for _h, _idx in zip(histories, steps_map):
+            steps.append(_idx[_h.pos_steps])
+            code_ids.append(
+                np.array(
+                    [merged.code_id(_c) for _c in _h.codes], dtype=np.int32
+                )[_h.pos_code_ids]
+                if len(_h.codes) > 0
+                else np.array([], dtype=np.int32)
+            )
+            values.append(_h.pos_values)
+        steps = np.concatenate(steps)
+        order = np.argsort(steps, kind="stable")
+        merged.pos_size = len(steps)
+        merged._pos_steps = steps[order]
+        merged._pos_code_ids = np.concatenate(code_ids)[order]
+        merged._pos_values = np.concatenate(values)[order]
+        return merged
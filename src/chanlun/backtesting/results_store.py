@@ -0,0 +1,403 @@
+import json
+import os
+import pickle
+import shutil
+from pathlib import Path
+from typing import Dict, List, Union
+
+import pandas as pd
+
+from chanlun.backtesting.backtest_trader import BackTestTrader
+from chanlun.backtesting.base import POSITION
+from chanlun.backtesting.record_history import RecordHistory
+
+"""
+回测结果的列式存储
+
+原来 BackTest.save 将整个 trader 对象 pickle 保存，每个持仓对象的开平仓记录、资金历史字典等都需要一起序列化与加载
+这里将回测结果按照表格保存在一个目录中（保存文件 xxx.pkl 对应目录 xxx.bt）：
+    meta.json                   回测配置与 trader 的统计信息（小文件，加载时只读取这个文件）
+    state.pkl                   策略对象与结束时的当前持仓
+    positions                   历史持仓表，每个持仓一行，开平仓记录等嵌套信息 pickle 后保存在 extras 列
+    orders                      订单表，每个订单一行
+    history                     持仓盈亏、资产、现金余额历史表 (dt, hold_profit, balance, cash)
+    positions_balance           代码持仓金额历史表 (step, code, balance)，step 为 history 表中的序号
+表格在安装有 pyarrow 时保存为 Parquet 格式，否则使用 pandas 的 pickle 格式保存 DataFrame
+表格在第一次使用时才读取，多个回测结果（多进程回测每个代码一个）可以直接按表格拼接合并
+"""
+
+try:
+    import pyarrow  # noqa: F401
+
+    _table_suffix = "parquet"
+except ImportError:
+    _table_suffix = "pkl"
+
+# 历史持仓表中直接保存的持仓属性，其他的属性保存在 extras 列
+POSITION_COLUMNS = [
+    "mmd",
+    "type",
+    "balance",
+    "price",
+    "amount",
+    "loss_price",
+    "open_date",
+    "open_datetime",
+    "close_datetime",
+    "profit",
+    "profit_rate",
+    "max_profit_rate",
+    "max_loss_rate",
+    "open_msg",
+    "close_msg",
+    "open_uid",
+    "now_pos_rate",
+]
+
+TABLES = [
+    "positions",
+    "orders",
+    "history",
+    "positions_balance",
+]
+
+
+def results_path(save_file: str) -> Path:
+    """
+    回测保存文件对应的结果存储目录
+    """
+    save_file = str(save_file)
+    if save_file.endswith(".pkl"):
+        save_file = save_file[: -len(".pkl")]
+    return Path(f"{save_file}.bt")
+
+
+def results_exists(save_file: str) -> bool:
+    """
+    回测结果是否存在（结果存储目录，或者之前版本保存的 pkl 文件）
+    """
+    return (results_path(save_file) / "meta.json").is_file() or os.path.isfile(
+        save_file
+    )
+
+
+def _none(v):
+    # 表格中的空值（NaN/NaT）还原为 None
+    if v is None or (not isinstance(v, (str, bytes, dict, list)) and pd.isna(v)):
+        return None
+    return v
+
+
+class BackTestResults(object):
+    """
+    回测结果的列式存储
+    """
+
+    def __init__(self, path: Union[str, Path] = None):
+        """
+        :param path: 存储的目录，None 则为内存中的结果（from_trader/merge 生成，调用 save 后保存）
+        """
+        self.path = Path(path) if path is not None else None
+        self._meta: Union[dict, None] = None
+        self._state: Union[dict, None] = None
+        self._tables: Dict[str, pd.DataFrame] = {}
+
+    @property
+    def meta(self) -> dict:
+        if self._meta is None:
+            with open(self.path / "meta.json", "r", encoding="utf-8") as fp:
+                self._meta = json.load(fp)
+        return self._meta
+
+    @property
+    def state(self) -> dict:
+        if self._state is None:
+            with open(self.path / "state.pkl", "rb") as fp:
+                self._state = pickle.load(fp)
+        return self._state
+
+    def table(self, name: str) -> pd.DataFrame:
+        """
+        获取表格数据，第一次使用时从文件读取
+        """
+        if name not in self._tables.keys():
+            df = None
+            if self.path is not None:
+                for _suffix in ["parquet", "pkl"]:
+                    _file = self.path / f"{name}.{_suffix}"
+                    if _file.is_file():
+                        df = (
+                            pd.read_parquet(_file)
+                            if _suffix == "parquet"
+                            else pd.read_pickle(_file)
+                        )
+                        break
+            self._tables[name] = df if df is not None else pd.DataFrame([])
+        return self._tables[name]
+
+    @staticmethod
+    def positions_table(positions_history: Dict[str, List[POSITION]]) -> pd.DataFrame:
+        rows = []
+        for _code, _poss in positions_history.items():
+            for _p in _poss:
+                row = {"code": _code}
+                extras = {}
+                for _k, _v in _p.__dict__.items():
+                    if _k in POSITION_COLUMNS:
+                        row[_k] = _v
+                    else:
+                        extras[_k] = _v
+                row["extras"] = pickle.dumps(extras)
+                rows.append(row)
+        return pd.DataFrame(rows)
+
+    @staticmethod
+    def orders_table(orders: Dict[str, List[dict]]) -> pd.DataFrame:
+        rows = []
+        for _code, _orders in orders.items():
+            for _o in _orders:
+                rows.append({"code": _code, **_o})
+        return pd.DataFrame(rows)
+
+    @classmethod
+    def from_trader(
+        cls, trader: BackTestTrader, config: dict, strategy=None
+    ) -> "BackTestResults":
+        """
+        根据回测的 trader 对象生成结果（在内存中，调用 save 保存）
+        如果 trader 是从结果存储中加载的，并且表格数据没有使用过，直接使用存储中的表格
+        """
+        res = cls()
+        res._meta = {
+            "config": config,
+            "trader": {
+                "name": trader.name,
+                "mode": trader.mode,
+                "is_stock": trader.is_stock,
+                "is_futures": trader.is_futures,
+                "allow_mmds": trader.allow_mmds,
+                "balance": trader.balance,
+                "fee_rate": trader.fee_rate,
+                "fee_total": trader.fee_total,
+                "max_pos": trader.max_pos,
+                "results": trader.results,
+            },
+        }
+        res._state = {"strategy": strategy, "positions": trader.positions}
+        lazy = isinstance(trader, ResultsTrader)
+        for _name, _attr, _fun in [
+            ("positions", "positions_history", cls.positions_table),
+            ("orders", "orders", cls.orders_table),
+        ]:
+            if lazy and trader.is_loaded(_attr) is False:
+                res._tables[_name] = trader.results_store.table(_name)
+            else:
+                res._tables[_name] = _fun(getattr(trader, _attr))
+        if lazy and trader.is_loaded("history") is False:
+            res._tables["history"] = trader.results_store.table("history")
+            res._tables["positions_balance"] = trader.results_store.table(
+                "positions_balance"
+            )
+        else:
+            res.set_history(trader.history)
+        return res
+
+    @classmethod
+    def load(cls, save_file: str) -> "BackTestResults":
+        """
+        加载回测结果，存储目录不存在，则读取之前版本保存的 pkl 文件并转换
+        """
+        path = results_path(save_file)
+        if (path / "meta.json").is_file():
+            return cls(path)
+        with open(save_file, "rb") as fp:
+            config_dict = pickle.load(fp)
+        trader = config_dict.pop("trader")
+        strategy = config_dict.pop("strategy")
+        return cls.from_trader(trader, config_dict, strategy)
+
+    def save(self, save_file: str):
+        """
+        保存到回测保存文件对应的存储目录中（先写入临时目录再替换）
+        """
+        path = results_path(save_file)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        if tmp_path.is_dir():
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for _name in TABLES:
+            df = self.table(_name)
+            if _table_suffix == "parquet":
+                df.to_parquet(tmp_path / f"{_name}.parquet", index=False)
+            else:
+                df.to_pickle(tmp_path / f"{_name}.pkl")
+        with open(tmp_path / "state.pkl", "wb") as fp:
+            pickle.dump(self.state, fp)
+        with open(tmp_path / "meta.json", "w", encoding="utf-8") as fp:
+            json.dump(self.meta, fp, ensure_ascii=False, default=str)
+        if path.is_dir():
+            shutil.rmtree(path)
+        os.replace(tmp_path, path)
+        self.path = path
+        return True
+
+    @classmethod
+    def merge(
+        cls,
+        parts: List["BackTestResults"],
+        trader: BackTestTrader,
+        config: dict,
+        strategy=None,
+    ) -> "BackTestResults":
+        """
+        合并多个回测结果（多进程回测中每个代码的结果）
+        持仓、订单表直接拼接，历史记录见 RecordHistory.merge，统计结果与手续费求和
+        :param trader: 合并结果使用的 trader 对象（主进程的 trader，统计结果在此基础上累加）
+        """
+        res = cls.from_trader(trader, config, strategy)
+        meta_trader = res.meta["trader"]
+        for _part in parts:
+            for mmd, _r in _part.meta["trader"]["results"].items():
+                for _k, _v in _r.items():
+                    meta_trader["results"][mmd][_k] += _v
+            meta_trader["fee_total"] += _part.meta["trader"]["fee_total"]
+
+        def concat(name: str, base: pd.DataFrame = None) -> pd.DataFrame:
+            dfs = [base] if base is not None and len(base) > 0 else []
+            dfs += [_p.table(name) for _p in parts if len(_p.table(name)) > 0]
+            return pd.concat(dfs, ignore_index=True) if len(dfs) > 0 else pd.DataFrame([])
+
+        res._tables["positions"] = concat("positions", res.table("positions"))
+        res._tables["orders"] = concat("orders", res.table("orders"))
+        res.set_history(
+            RecordHistory.merge([res.history()] + [_p.history() for _p in parts])
+        )
+        return res
+
+    def positions_history(self) -> Dict[str, List[POSITION]]:
+        positions_history = {}
+        df = self.table("positions")
+        if len(df) == 0:
+            return positions_history
+        columns = [_c for _c in df.columns if _c in POSITION_COLUMNS]
+        for row in df.to_dict("records"):
+            pos = POSITION.__new__(POSITION)
+            pos.code = row["code"]
+            for _c in columns:
+                setattr(pos, _c, _none(row[_c]))
+            pos.__dict__.update(pickle.loads(row["extras"]))
+            positions_history.setdefault(row["code"], []).append(pos)
+        return positions_history
+
+    def orders(self) -> Dict[str, List[dict]]:
+        orders = {}
+        df = self.table("orders")
+        if len(df) == 0:
+            return orders
+        for row in df.to_dict("records"):
+            _code = row.pop("code")
+            orders.setdefault(_code, []).append(
+                {_k: _none(_v) for _k, _v in row.items()}
+            )
+        return orders
+
+    def history(self) -> RecordHistory:
+        return RecordHistory.from_frames(
+            self.table("history"), self.table("positions_balance")
+        )
+
+    def set_history(self, history: RecordHistory):
+        self._tables["history"], self._tables["positions_balance"] = (
+            history.to_frames()
+        )
+
+    def positions_frame(self, code: str = None, add_columns: List[str] = None):
+        """
+        直接从历史持仓表生成 BackTest.positions 的结果，不创建持仓对象
+        """
+        df = self.table("positions")
+        if len(df) == 0:
+            return pd.DataFrame([])
+        if code is not None:
+            df = df[df["code"] == code]
+        df = df[
+            [
+                "code",
+                "mmd",
+                "open_datetime",
+                "close_datetime",
+                "type",
+                "price",
+                "amount",
+                "loss_price",
+                "profit_rate",
+                "max_profit_rate",
+                "max_loss_rate",
+                "open_msg",
+                "close_msg",
+                "open_uid",
+            ]
+            + (["extras"] if add_columns is not None else [])
+        ].reset_index(drop=True)
+        if add_columns is not None:
+            infos = [pickle.loads(_e)["info"] or {} for _e in df.pop("extras")]
+            for _col in add_columns:
+                df[_col] = [_i[_col] if _col in _i.keys() else "--" for _i in infos]
+        return df
+
+    def orders_frame(self, code: str = None):
+        """
+        直接从订单表生成 BackTest.orders 的结果
+        """
+        df = self.table("orders")
+        if len(df) == 0:
+            return pd.DataFrame([])
+        if code is not None:
+            df = df[df["code"] == code]
+        return df.drop(columns=["code"]).reset_index(drop=True)
+
+
+class ResultsTrader(BackTestTrader):
+    """
+    从回测结果存储中加载的 trader 对象
+    历史持仓、订单、资金历史等在第一次使用时，才从存储的表格中读取并转换为原来的数据结构
+    """
+
+    lazy_attrs = [
+        "positions_history",
+        "orders",
+        "history",
+    ]
+
+    def __init__(self, results: BackTestResults):
+        meta = results.meta["trader"]
+        super().__init__(
+            meta["name"],
+            meta["mode"],
+            is_stock=meta["is_stock"],
+            is_futures=meta["is_futures"],
+            fee_rate=meta["fee_rate"],
+            max_pos=meta["max_pos"],
+        )
+        self.allow_mmds = meta["allow_mmds"]
+        self.balance = meta["balance"]
+        self.fee_total = meta["fee_total"]
+        self.results = meta["results"]
+        self.positions = results.state["positions"]
+        for _attr in self.lazy_attrs:
+            del self.__dict__[_attr]
+        self.results_store = results
+
+    def __getattr__(self, name):
+        # 只有在属性不存在时才会调用，延迟加载的属性第一次使用时读取
+        if name in ResultsTrader.lazy_attrs and "results_store" in self.__dict__:
+            value = getattr(self.results_store, name)()
+            self.__dict__[name] = value
+            return value
+        raise AttributeError(name)
+
+    def is_loaded(self, name: str) -> bool:
+        """
+        延迟加载的属性是否已经读取（读取后可能有修改，需要使用对象中的数据）
+        """
+        return name in self.__dict__.keys()
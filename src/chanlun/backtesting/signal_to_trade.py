@@ -66,6 +66,8 @@ class SignalToTrade(BackTestTrader):
 
         # 缓存K线
         self.cache_klines: Dict[str, pd.DataFrame] = {}
+        # 缓存K线的时间戳与价格数组，以及当前时间在K线中的位置（回放的时间递增，位置只需要向后移动）
+        self.cache_prices: Dict[str, dict] = {}
 
         self.market: str = None
         self.ex: ExchangeDB = None
@@ -85,29 +87,43 @@ class SignalToTrade(BackTestTrader):
                 self.add_times("st_cache_klines", time.time() - s_time)
 
             s_time = time.time()
-
-            if self.market in ["us"]:
-                kline = self.cache_klines[code][
-                    self.cache_klines[code]["date"] < self.now_datetime
-                ]
-            elif self.market in ["currency", "futures"]:
-                end_date = self.now_datetime
-                kline = self.cache_klines[code][
-                    self.cache_klines[code]["date"] < end_date
-                ]
-            else:
-                kline = self.cache_klines[code][
-                    self.cache_klines[code]["date"] <= self.now_datetime
-                ]
-            # tqdm.write(f"{self.now_datetime} {code} {kline.iloc[-1]['close']}")
+            if code not in self.cache_prices.keys():
+                klines = self.cache_klines[code]
+                self.cache_prices[code] = {
+                    "ts": pd.DatetimeIndex(klines["date"]).asi8,
+                    "date": klines["date"].to_list(),
+                    "open": klines["open"].to_numpy(dtype=float),
+                    "close": klines["close"].to_numpy(dtype=float),
+                    "high": klines["high"].to_numpy(dtype=float),
+                    "low": klines["low"].to_numpy(dtype=float),
+                    "cursor": 0,
+                }
+            prices = self.cache_prices[code]
+
+            # us、currency、futures 使用当前时间之前的K线，其他市场包括当前时间的K线
+            include_now = self.market not in ["us", "currency", "futures"]
+            now = pd.Timestamp(self.now_datetime).value
+            ts = prices["ts"]
+            i = prices["cursor"]
+            if i > 0 and (ts[i - 1] > now or (ts[i - 1] == now and not include_now)):
+                # 时间回退，重新查找位置
+                i = int(
+                    np.searchsorted(ts, now, side="right" if include_now else "left")
+                )
+            while i < len(ts) and (ts[i] < now or (include_now and ts[i] == now)):
+                i += 1
+            prices["cursor"] = i
+            if i == 0:
+                raise Exception("当前时间之前没有K线数据")
+            # tqdm.write(f"{self.now_datetime} {code} {prices['close'][i - 1]}")
             self.add_times("st_get_price", time.time() - s_time)
 
             return {
-                "date": kline.iloc[-1]["date"],
-                "open": float(kline.iloc[-1]["open"]),
-                "close": float(kline.iloc[-1]["close"]),
-                "high": float(kline.iloc[-1]["high"]),
-                "low": float(kline.iloc[-1]["low"]),
+                "date": prices["date"][i - 1],
+                "open": float(prices["open"][i - 1]),
+                "close": float(prices["close"][i - 1]),
+                "high": float(prices["high"][i - 1]),
+                "low": float(prices["low"][i - 1]),
             }
         except Exception as e:
             print(code, self.now_datetime, e)
@@ -115,6 +131,28 @@ class SignalToTrade(BackTestTrader):
     def get_now_datetime(self):
         return self.now_datetime
 
+    @staticmethod
+    def position_events(
+        pos_df: pd.DataFrame,
+    ) -> Tuple[Dict[int, List[dict]], Dict[int, List[dict]]]:
+        """
+        按照开仓时间与平仓时间，对历史持仓进行分组（时间使用纳秒时间戳，组内保持持仓的顺序）
+        回放时直接获取当前时间的开平仓持仓，不需要每次查询全部的持仓
+        :return: 开仓事件 {时间: [持仓]}，平仓事件 {时间: [持仓]}
+        """
+        open_events: Dict[int, List[dict]] = {}
+        close_events: Dict[int, List[dict]] = {}
+        for _pos in pos_df.to_dict(orient="records"):
+            if not pd.isna(_pos["open_datetime"]):
+                open_events.setdefault(
+                    pd.Timestamp(_pos["open_datetime"]).value, []
+                ).append(_pos)
+            if not pd.isna(_pos["close_datetime"]):
+                close_events.setdefault(
+                    pd.Timestamp(_pos["close_datetime"]).value, []
+                ).append(_pos)
+        return open_events, close_events
+
     def run_bt(self, bt_file: str):
         BT = BackTest()
         BT.save_file = bt_file
@@ -185,9 +223,13 @@ class SignalToTrade(BackTestTrader):
             )
         )
 
+        # 按照开平仓时间建立索引
+        open_events, close_events = self.position_events(pos_df)
+
         for _d in tqdm(base_dates, desc="交易进度"):
             self.now_datetime = _d
             self.datas.now_date = _d
+            _d_key = pd.Timestamp(_d).value
 
             trade_pos_codes = self.position_codes()
 
@@ -195,20 +237,16 @@ class SignalToTrade(BackTestTrader):
             close_poss: List[Dict] = []
             if len(trade_pos_codes) > 0:
                 s_time = time.time()
-                close_poss: pd.DataFrame = pos_df.query(
-                    "code in @trade_pos_codes and close_datetime == @_d"
-                )
-                if len(close_poss) == 0:
-                    close_poss = []
-                else:
-                    close_poss = close_poss.to_dict(orient="records")
+                close_poss = [
+                    _p
+                    for _p in close_events.get(_d_key, [])
+                    if _p["code"] in trade_pos_codes
+                ]
                 self.add_times("st_query_close_poss", time.time() - s_time)
 
             # 查询当前要开仓的仓位
             s_time = time.time()
-            open_poss: List[Dict] = pos_df.query("open_datetime == @_d").to_dict(
-                orient="records"
-            )
+            open_poss: List[Dict] = open_events.get(_d_key, [])
             self.add_times("st_query_open_poss", time.time() - s_time)
 
             # 优先进行平仓操作
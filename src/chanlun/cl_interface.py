@@ -1200,52 +1200,17 @@ def query_macd_ld(cd: ICL, start_fx: FX, end_fx: FX):
     实际比较力度是根据 hist 的 up_sum 和 down_sum 进行比较
     向上线段，比较 up_sum 红柱子总和
     向下线段，比较 down_sum 绿柱子总和
+    区间的和与最值，使用缠论数据对应的 MacdStore（前缀和与稀疏表）查询，不复制指标数据
     """
+    from chanlun.cl_store import get_macd_store
+
     if start_fx.index > end_fx.index:
         raise Exception(
             "%s - %s - %s 计算力度，开始分型不可以大于结束分型"
             % (cd.get_code(), cd.get_frequency(), cd.get_klines()[-1].date)
         )
 
-    dea = np.array(
-        cd.get_idx()["macd"]["dea"][start_fx.k.k_index : end_fx.k.k_index + 1]
-    )
-    dif = np.array(
-        cd.get_idx()["macd"]["dif"][start_fx.k.k_index : end_fx.k.k_index + 1]
-    )
-    hist = np.array(
-        cd.get_idx()["macd"]["hist"][start_fx.k.k_index : end_fx.k.k_index + 1]
-    )
-    if len(hist) == 0:
-        hist = np.array([0])
-    if len(dea) == 0:
-        dea = np.array([0])
-    if len(dif) == 0:
-        dif = np.array([0])
-
-    hist_abs = abs(hist)
-    hist_up = np.array([_i for _i in hist if _i > 0])
-    hist_down = np.array([_i for _i in hist if _i < 0])
-    hist_max = np.max(hist)
-    hist_min = np.min(hist)
-    hist_sum = hist_abs.sum()
-    hist_up_sum = hist_up.sum()
-    hist_down_sum = abs(hist_down.sum())
-    end_dea = dea[-1]
-    end_dif = dif[-1]
-    end_hist = hist[-1]
-    return {
-        "dea": {"end": end_dea, "max": np.max(dea), "min": np.min(dea)},
-        "dif": {"end": end_dif, "max": np.max(dif), "min": np.min(dif)},
-        "hist": {
-            "sum": hist_sum,
-            "up_sum": hist_up_sum,
-            "down_sum": hist_down_sum,
-            "max": hist_max,
-            "min": hist_min,
-            "end": end_hist,
-        },
-    }
+    return get_macd_store(cd).range_ld(start_fx.k.k_index, end_fx.k.k_index + 1)
 
 
 def compare_ld_beichi(one_ld: dict, two_ld: dict, line_direction: str):
@@ -0,0 +1,687 @@
+import bisect
+import weakref
+from collections import OrderedDict
+
+from chanlun.cl_interface import *
+
+
+class KlinesArrays:
+    """
+    缠论数据 K 线的列数组（OHLCV 按列存储）
+    数组容量按倍数增长，只追加新的 K 线，并刷新最后一根（最后一根 K 线会随行情更新）
+    每次同步会抽样检查已同步 K 线的日期与收盘价，有变化（比如复权数据刷新，中间的 K 线被重新计算）则全部重新同步
+    o/h/l/c/a/ts 返回的是内部数组的视图，不会复制数据；数据同步后视图内容可能会变，需要保留的话自行 copy
+    增量指标的计算顺序与 talib 相同，talib 在支持 FMA 指令的 CPU 上会使用融合乘加，EMA/MACD/ATR 会有 1e-15 左右的相对误差
+    """
+
+    # 每次同步时，抽样检查的已同步 K 线数量
+    check_samples: int = 16
+
+    def __init__(self, capacity: int = 1024):
+        self.size: int = 0
+        self.first_ts: Union[int, None] = None
+        # 全部重新同步的次数，已同步的 K 线有变化时增加，可用来判断之前基于 K 线的计算结果是否失效
+        self.generation: int = 0
+        # 抽样检查的 K 线位置，已同步的数量变化时重新计算
+        self._check_idxs: Union[np.ndarray, None] = None
+        # 基于 K 线增量计算的指标序列，key 为指标名称与参数，value 为 [指标数组, 已计算的数量]
+        self._series: Dict[tuple, list] = {}
+        self._ts = np.empty(capacity, dtype=np.int64)  # 时间戳（纳秒）
+        self._o = np.empty(capacity, dtype=np.float64)
+        self._h = np.empty(capacity, dtype=np.float64)
+        self._l = np.empty(capacity, dtype=np.float64)
+        self._c = np.empty(capacity, dtype=np.float64)
+        self._a = np.empty(capacity, dtype=np.float64)
+
+    @staticmethod
+    def date_to_ts(date: datetime.datetime) -> int:
+        """
+        日期转换成纳秒时间戳
+        """
+        return pd.Timestamp(date).value
+
+    def _reserve(self, size: int):
+        """
+        容量不足时，按照两倍进行扩容
+        """
+        capacity = len(self._ts)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for _name in ["_ts", "_o", "_h", "_l", "_c", "_a"]:
+            _old = getattr(self, _name)
+            _new = np.empty(capacity, dtype=_old.dtype)
+            _new[: self.size] = _old[: self.size]
+            setattr(self, _name, _new)
+
+    def _synced_changed(self, klines: List[Kline]) -> bool:
+        """
+        抽样检查已同步的 K 线（不包括最后一根）是否有变化
+        检查第一根到最后一根之前的一根，均匀分布的 K 线收盘价，以及最后一根之前的一根的日期
+        """
+        nums = self.size - 1
+        if nums <= 0:
+            return False
+        if self._check_idxs is None or self._check_idxs[-1] != nums - 1:
+            self._check_idxs = np.unique(
+                np.linspace(0, nums - 1, min(self.check_samples, nums)).astype(np.int64)
+            )
+        closes = [klines[i].c for i in self._check_idxs.tolist()]
+        if self._c[self._check_idxs].tolist() != closes:
+            return True
+        return self._ts[nums - 1] != self.date_to_ts(klines[nums - 1].date)
+
+    def sync(self, klines: List[Kline]) -> "KlinesArrays":
+        """
+        与缠论数据的 K 线列表同步
+        """
+        nums = len(klines)
+        if nums == 0:
+            if self.size > 0:
+                self.generation += 1
+            self.size = 0
+            self.first_ts = None
+            return self
+
+        # 从最后一根已同步的 K 线开始更新；K 线变少或已同步的 K 线有变化，说明数据重新计算了，全部重新同步
+        start = max(self.size - 1, 0)
+        first_ts = self.date_to_ts(klines[0].date)
+        if (
+            nums < self.size
+            or first_ts != self.first_ts
+            or self._synced_changed(klines)
+        ):
+            if self.size > 0:
+                self.generation += 1
+            start = 0
+
+        self._reserve(nums)
+        for i in range(start, nums):
+            k = klines[i]
+            self._ts[i] = self.date_to_ts(k.date)
+            self._o[i] = k.o
+            self._h[i] = k.h
+            self._l[i] = k.l
+            self._c[i] = k.c
+            self._a[i] = k.a
+        self.size = nums
+        self.first_ts = first_ts
+        # 从 start 开始的 K 线有变化，增量指标需要从这里重新计算
+        for _s in self._series.values():
+            _s[1] = min(_s[1], start)
+        return self
+
+    @property
+    def fingerprint(self) -> tuple:
+        """
+        K 线数据的指纹：全部重新同步的次数、K 线数量以及最后一根 K 线，有变化则之前基于 K 线的计算结果失效
+        """
+        last = None
+        if self.size > 0:
+            i = self.size - 1
+            last = (
+                int(self._ts[i]),
+                self._o[i],
+                self._h[i],
+                self._l[i],
+                self._c[i],
+                self._a[i],
+            )
+        return self.generation, self.size, last
+
+    @property
+    def ts(self) -> np.ndarray:
+        return self._ts[: self.size]
+
+    @property
+    def o(self) -> np.ndarray:
+        return self._o[: self.size]
+
+    @property
+    def h(self) -> np.ndarray:
+        return self._h[: self.size]
+
+    @property
+    def l(self) -> np.ndarray:
+        return self._l[: self.size]
+
+    @property
+    def c(self) -> np.ndarray:
+        return self._c[: self.size]
+
+    @property
+    def a(self) -> np.ndarray:
+        return self._a[: self.size]
+
+    def _series_buffer(self, key: tuple) -> list:
+        """
+        获取增量指标的缓存数组，容量不足则扩容
+        """
+        if key not in self._series:
+            self._series[key] = [np.empty(len(self._ts), dtype=np.float64), 0]
+        s = self._series[key]
+        if len(s[0]) < len(self._ts):
+            _new = np.empty(len(self._ts), dtype=np.float64)
+            _new[: s[1]] = s[0][: s[1]]
+            s[0] = _new
+        return s
+
+    def ma(self, period: int) -> np.ndarray:
+        """
+        全部收盘价的 MA 指标（与 talib.MA 结果一致），只计算新增及变化的 K 线
+        与 talib 一样使用滚动累加的收盘价之和计算
+        """
+        s = self._series_buffer(("ma", period))
+        totals = self._series_buffer(("ma_total", period))
+        vals, done = s
+        c = self.c
+        done = min(done, totals[1])
+        for i in range(done, self.size):
+            if i < period - 1:
+                vals[i] = totals[0][i] = np.nan
+                continue
+            if i == period - 1:
+                total = 0.0
+                for _c in c[:period].tolist():
+                    total += _c
+            else:
+                total = totals[0][i - 1] - c[i - period] + c[i]
+            totals[0][i] = total
+            vals[i] = total / period
+        s[1] = totals[1] = self.size
+        return vals[: self.size]
+
+    def ema(self, period: int) -> np.ndarray:
+        """
+        全部收盘价的 EMA 指标（与 talib.EMA 一致），只计算新增及变化的 K 线
+        第 period 根 K 线的值为之前收盘价的均值，之后每根 K 线在前一个值的基础上递推
+        """
+        s = self._series_buffer(("ema", period))
+        vals, done = s
+        c = self.c
+        k = 2.0 / (period + 1)
+        for i in range(done, self.size):
+            if i < period - 1:
+                vals[i] = np.nan
+            elif i == period - 1:
+                vals[i] = self._mean(c[:period])
+            else:
+                vals[i] = (c[i] - vals[i - 1]) * k + vals[i - 1]
+        s[1] = self.size
+        return vals[: self.size]
+
+    def macd(self, fast: int = 12, slow: int = 26, signal: int = 9):
+        """
+        全部收盘价的 MACD 指标（与 talib.MACD 一致），只计算新增及变化的 K 线
+        快慢 EMA 在第 slow 根 K 线开始计算（初始值为之前收盘价的均值），DEA 为 DIF 的 EMA，在第 slow + signal - 1 根开始计算
+        :return: dif, dea, hist 数组，之前的值为 nan
+        """
+        if slow < fast:
+            fast, slow = slow, fast
+        bufs = [
+            self._series_buffer(("macd", fast, slow, signal, _n))
+            for _n in ["fast", "slow", "dif", "dea", "hist"]
+        ]
+        ema_fast, ema_slow, dif, dea, hist = [_b[0] for _b in bufs]
+        done = min([_b[1] for _b in bufs])
+        c = self.c
+        k_fast = 2.0 / (fast + 1)
+        k_slow = 2.0 / (slow + 1)
+        k_signal = 2.0 / (signal + 1)
+        dif_start = slow - 1
+        dea_start = slow + signal - 2
+        for i in range(done, self.size):
+            if i < dif_start:
+                ema_fast[i] = ema_slow[i] = np.nan
+            elif i == dif_start:
+                ema_fast[i] = self._mean(c[slow - fast : slow])
+                ema_slow[i] = self._mean(c[:slow])
+            else:
+                ema_fast[i] = (c[i] - ema_fast[i - 1]) * k_fast + ema_fast[i - 1]
+                ema_slow[i] = (c[i] - ema_slow[i - 1]) * k_slow + ema_slow[i - 1]
+
+            if i < dea_start:
+                dif[i] = dea[i] = hist[i] = np.nan
+                continue
+            dif[i] = ema_fast[i] - ema_slow[i]
+            if i == dea_start:
+                dea[i] = self._mean(
+                    ema_fast[dif_start : i + 1] - ema_slow[dif_start : i + 1]
+                )
+            else:
+                dea[i] = (dif[i] - dea[i - 1]) * k_signal + dea[i - 1]
+            hist[i] = dif[i] - dea[i]
+        for _b in bufs:
+            _b[1] = self.size
+        return dif[: self.size], dea[: self.size], hist[: self.size]
+
+    def atr(self, period: int = 14) -> np.ndarray:
+        """
+        全部 K 线的 ATR 指标（与 talib.ATR 一致），只计算新增及变化的 K 线
+        第 period 根之后的 K 线，值为之前 period 根真实波幅的均值，之后每根 K 线在前一个值的基础上递推
+        """
+        s = self._series_buffer(("atr", period))
+        vals, done = s
+        k_pre = (period - 1) / period
+        k_tr = 1.0 - k_pre
+        for i in range(done, self.size):
+            if i == 0 or i < period:
+                vals[i] = np.nan
+            elif period <= 1:
+                vals[i] = self._true_range(i)
+            elif i == period:
+                total = 0.0
+                for j in range(1, period + 1):
+                    total += self._true_range(j)
+                vals[i] = total / period
+            else:
+                vals[i] = vals[i - 1] * k_pre + self._true_range(i) * k_tr
+        s[1] = self.size
+        return vals[: self.size]
+
+    def _true_range(self, i: int) -> float:
+        """
+        第 i 根 K 线的真实波幅（最高最低价之差，与前一根收盘价差值的绝对值，取最大的）
+        """
+        h, l, pre_c = self._h[i], self._l[i], self._c[i - 1]
+        return max(h - l, abs(pre_c - h), abs(l - pre_c))
+
+    @staticmethod
+    def _mean(vals: np.ndarray) -> float:
+        """
+        按顺序累加求均值（与 talib 计算初始值的方式一致）
+        """
+        total = 0.0
+        for _v in vals.tolist():
+            total += _v
+        return total / len(vals)
+
+    def window(self, nums: int = None, end_datetime: datetime.datetime = None):
+        """
+        获取最后 nums 根 K 线的区间 (start, end)，end_datetime 不为空，则去除区间内时间大于 end_datetime 的 K 线
+        :param nums: 获取的数量，None 则获取全部
+        :param end_datetime: 结束时间（包含）
+        :return: 数组的开始与结束索引，使用 arr[start:end] 获取
+        """
+        start = 0 if nums is None else max(self.size - nums, 0)
+        end = self.size
+        if end_datetime is not None:
+            end = int(
+                np.searchsorted(self.ts, self.date_to_ts(end_datetime), side="right")
+            )
+            end = max(start, end)
+        return start, end
+
+
+# 每个缠论数据对象对应的 K 线数组，缠论对象释放后自动删除
+_klines_arrays: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_klines_arrays(cd: ICL) -> KlinesArrays:
+    """
+    获取缠论数据 K 线（cd.get_klines()）的列数组，每次获取会增量同步最新的 K 线
+    """
+    try:
+        arrays = _klines_arrays.get(cd)
+    except TypeError:
+        # 不支持弱引用的对象，不进行缓存
+        return KlinesArrays(max(len(cd.get_klines()), 1)).sync(cd.get_klines())
+    if arrays is None:
+        arrays = KlinesArrays(max(len(cd.get_klines()), 1024))
+        _klines_arrays[cd] = arrays
+    return arrays.sync(cd.get_klines())
+
+
+class IndicatorCache:
+    """
+    指标计算结果的 LRU 缓存
+    key 包含缠论数据对象、指标名称、参数以及 K 线数据的指纹（KlinesArrays.fingerprint），K 线有更新或重新同步则不会命中缓存
+    缓存中会保存缠论数据对象的弱引用，用于确认命中的是同一个对象（id 可能被复用）
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict = OrderedDict()
+
+    @staticmethod
+    def make_key(cd: ICL, name: str, args: tuple, kwargs: dict) -> tuple:
+        ks = get_klines_arrays(cd)
+        return (id(cd), name, args, tuple(sorted(kwargs.items())), ks.fingerprint)
+
+    def get(self, key: tuple, cd: ICL):
+        """
+        获取缓存的结果，未命中返回 None
+        """
+        item = self._items.get(key)
+        if item is None or item[0]() is not cd:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key: tuple, cd: ICL, value):
+        try:
+            ref = weakref.ref(cd)
+        except TypeError:
+            return value
+        self._items[key] = (ref, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+        return value
+
+    def clear(self):
+        self._items.clear()
+
+    def __getstate__(self):
+        # 弱引用不能 pickle，缓存内容不需要保存
+        return {"maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+    def __setstate__(self, state):
+        self.__init__(state["maxsize"])
+        self.hits = state["hits"]
+        self.misses = state["misses"]
+
+
+class MacdStore:
+    """
+    缠论数据 MACD 指标（cd.get_idx()['macd']）的区间查询结构
+    hist 的正值、负值、绝对值保存前缀和，dea/dif/hist 使用稀疏表保存区间最大最小值，任意 K 线区间的力度查询都是 O(1)
+    同时记录 dif/dea 穿越零轴、金叉死叉发生的位置（有序），区间内的穿越次数通过二分查找获取
+    数据按照倍数扩容，新增或最后变化的 K 线，只增量更新受影响的位置
+    """
+
+    names = ["dea", "dif", "hist"]
+    cross_names = ["dif_up", "dif_down", "dea_up", "dea_down", "gold", "die"]
+
+    def __init__(self, capacity: int = 1024):
+        self.size: int = 0
+        self._alloc(capacity)
+
+    def _alloc(self, capacity: int):
+        self._cap = capacity
+        self._vals = {_n: np.empty(capacity, dtype=np.float64) for _n in self.names}
+        # 前缀和，区间 [s, e) 的和为 cum[e] - cum[s]
+        self._cum = {
+            _n: np.zeros(capacity + 1, dtype=np.float64) for _n in ["up", "down", "abs"]
+        }
+        # 前缀中 nan 的数量，区间中有 nan 时，结果与 numpy 直接计算一致（返回 nan）
+        self._cum_nan = {
+            _n: np.zeros(capacity + 1, dtype=np.int64) for _n in self.names
+        }
+        # 稀疏表，tables[name][j][i] 为区间 [i, i + 2^j) 的最值，第 0 层就是指标值
+        self._max_tables = {_n: [self._vals[_n]] for _n in self.names}
+        self._min_tables = {_n: [self._vals[_n]] for _n in self.names}
+        # 穿越发生的位置（当前与前一根比较）
+        self.crosses: Dict[str, List[int]] = {_n: [] for _n in self.cross_names}
+
+    def _reserve(self, size: int):
+        """
+        容量不足时，按照两倍进行扩容
+        """
+        if size <= self._cap:
+            return
+        capacity = self._cap
+        while capacity < size:
+            capacity *= 2
+        old_vals, old_cum, old_cum_nan = self._vals, self._cum, self._cum_nan
+        old_max, old_min, old_crosses = self._max_tables, self._min_tables, self.crosses
+        self._alloc(capacity)
+        for _n in self.names:
+            self._vals[_n][: self.size] = old_vals[_n][: self.size]
+            self._cum_nan[_n][: self.size + 1] = old_cum_nan[_n][: self.size + 1]
+            for _new, _old in [(self._max_tables, old_max), (self._min_tables, old_min)]:
+                for j in range(1, len(_old[_n])):
+                    _t = np.empty(capacity, dtype=np.float64)
+                    _t[: len(_old[_n][j])] = _old[_n][j]
+                    _new[_n].append(_t)
+        for _n in self._cum.keys():
+            self._cum[_n][: self.size + 1] = old_cum[_n][: self.size + 1]
+        self.crosses = old_crosses
+
+    @property
+    def dea(self) -> np.ndarray:
+        return self._vals["dea"][: self.size]
+
+    @property
+    def dif(self) -> np.ndarray:
+        return self._vals["dif"][: self.size]
+
+    @property
+    def hist(self) -> np.ndarray:
+        return self._vals["hist"][: self.size]
+
+    def _set(self, p: int, dea: float, dif: float, hist: float):
+        """
+        设置第 p 个位置的值（p 之前的数据不变，p 之后的数据丢弃），更新前缀和、稀疏表与穿越位置
+        """
+        self._reserve(p + 1)
+        for _n, _v in [("dea", dea), ("dif", dif), ("hist", hist)]:
+            self._vals[_n][p] = _v
+            self._cum_nan[_n][p + 1] = self._cum_nan[_n][p] + (1 if _v != _v else 0)
+            for tables, fun in [(self._max_tables, max), (self._min_tables, min)]:
+                table = tables[_n]
+                j = 1
+                while (1 << j) <= p + 1:
+                    if j == len(table):
+                        table.append(np.empty(self._cap, dtype=np.float64))
+                    # 包含位置 p 的区间 [k, p]
+                    k = p - (1 << j) + 1
+                    table[j][k] = self._fm(fun, table[j - 1][k], table[j - 1][k + (1 << (j - 1))])
+                    j += 1
+        h = 0.0 if hist != hist else hist
+        self._cum["up"][p + 1] = self._cum["up"][p] + (h if h > 0 else 0)
+        self._cum["down"][p + 1] = self._cum["down"][p] + (h if h < 0 else 0)
+        self._cum["abs"][p + 1] = self._cum["abs"][p] + abs(h)
+
+        for _n in self.cross_names:
+            while len(self.crosses[_n]) > 0 and self.crosses[_n][-1] >= p:
+                self.crosses[_n].pop()
+        if p >= 1:
+            pre_dea, pre_dif = self._vals["dea"][p - 1], self._vals["dif"][p - 1]
+            if pre_dif < 0 < dif:
+                self.crosses["dif_up"].append(p)
+            if pre_dif > 0 > dif:
+                self.crosses["dif_down"].append(p)
+            if pre_dea < 0 < dea:
+                self.crosses["dea_up"].append(p)
+            if pre_dea > 0 > dea:
+                self.crosses["dea_down"].append(p)
+            if pre_dif < pre_dea and dif > dea:
+                self.crosses["gold"].append(p)
+            if pre_dif > pre_dea and dif < dea:
+                self.crosses["die"].append(p)
+        self.size = p + 1
+
+    @staticmethod
+    def _fm(fun, a: float, b: float) -> float:
+        """
+        忽略 nan 的最值（与 np.fmax/np.fmin 一致）
+        """
+        if a != a:
+            return b
+        if b != b:
+            return a
+        return fun(a, b)
+
+    @staticmethod
+    def _build_table(vals: np.ndarray, fun, capacity: int) -> List[np.ndarray]:
+        table = []
+        prev = vals
+        j = 1
+        while (1 << j) <= len(vals):
+            half = 1 << (j - 1)
+            cur = fun(prev[: len(prev) - half], prev[half:])
+            _t = np.empty(capacity, dtype=np.float64)
+            _t[: len(cur)] = cur
+            table.append(_t)
+            prev = cur
+            j += 1
+        return table
+
+    def _rebuild(self, dea: np.ndarray, dif: np.ndarray, hist: np.ndarray):
+        """
+        使用 numpy 向量化重新构建全部数据
+        """
+        nums = len(hist)
+        capacity = 1024
+        while capacity < nums:
+            capacity *= 2
+        self._alloc(capacity)
+        self.size = nums
+        vals = {"dea": dea, "dif": dif, "hist": hist}
+        for _n in self.names:
+            self._vals[_n][:nums] = vals[_n]
+            self._cum_nan[_n][1 : nums + 1] = np.cumsum(np.isnan(vals[_n]))
+            self._max_tables[_n] += self._build_table(vals[_n], np.fmax, capacity)
+            self._min_tables[_n] += self._build_table(vals[_n], np.fmin, capacity)
+        hist_0 = np.nan_to_num(hist, nan=0.0)
+        self._cum["up"][1 : nums + 1] = np.cumsum(np.where(hist_0 > 0, hist_0, 0))
+        self._cum["down"][1 : nums + 1] = np.cumsum(np.where(hist_0 < 0, hist_0, 0))
+        self._cum["abs"][1 : nums + 1] = np.cumsum(np.abs(hist_0))
+
+        def cross_positions(cond: np.ndarray) -> List[int]:
+            return (np.nonzero(cond)[0] + 1).tolist()
+
+        with np.errstate(invalid="ignore"):
+            self.crosses = {
+                "dif_up": cross_positions((dif[:-1] < 0) & (dif[1:] > 0)),
+                "dif_down": cross_positions((dif[:-1] > 0) & (dif[1:] < 0)),
+                "dea_up": cross_positions((dea[:-1] < 0) & (dea[1:] > 0)),
+                "dea_down": cross_positions((dea[:-1] > 0) & (dea[1:] < 0)),
+                "gold": cross_positions((dif[:-1] < dea[:-1]) & (dif[1:] > dea[1:])),
+                "die": cross_positions((dif[:-1] > dea[:-1]) & (dif[1:] < dea[1:])),
+            }
+
+    def sync(self, macd: dict) -> "MacdStore":
+        """
+        与缠论数据的 MACD 指标同步
+        第一个与最后同步的前一个值没有变化，认为之前的数据不变，从最后同步的位置增量更新；其他情况重新构建
+        """
+        nums = len(macd["hist"])
+        start = 0
+        if (
+            0 < self.size <= nums
+            and self._same(macd["hist"][0], self._vals["hist"][0])
+            and (
+                self.size == 1
+                or self._same(macd["hist"][self.size - 2], self._vals["hist"][self.size - 2])
+            )
+        ):
+            start = self.size - 1
+        if start == 0 or nums - start > 64:
+            self._rebuild(
+                np.array(macd["dea"], dtype=np.float64),
+                np.array(macd["dif"], dtype=np.float64),
+                np.array(macd["hist"], dtype=np.float64),
+            )
+            return self
+        for p in range(start, nums):
+            dea, dif, hist = macd["dea"][p], macd["dif"][p], macd["hist"][p]
+            if (
+                p < self.size
+                and self._same(dea, self._vals["dea"][p])
+                and self._same(dif, self._vals["dif"][p])
+                and self._same(hist, self._vals["hist"][p])
+            ):
+                continue
+            self._set(p, dea, dif, hist)
+        self.size = nums
+        return self
+
+    @staticmethod
+    def _same(a: float, b: float) -> bool:
+        # nan 与 nan 认为是相同的
+        return a == b or (a != a and b != b)
+
+    def _range_value(self, name: str, s: int, e: int, is_max: bool):
+        """
+        稀疏表查询区间 [s, e) 的最大或最小值，使用两个有重叠的 2^j 区间覆盖整个区间
+        """
+        if self._cum_nan[name][e] - self._cum_nan[name][s] > 0:
+            return np.float64(np.nan)
+        j = (e - s).bit_length() - 1
+        if is_max:
+            table = self._max_tables[name][j]
+            return max(table[s], table[e - (1 << j)])
+        table = self._min_tables[name][j]
+        return min(table[s], table[e - (1 << j)])
+
+    def range_ld(self, start: int, end: int) -> dict:
+        """
+        计算 K 线索引区间 [start, end) 的 MACD 力度，返回值与 query_macd_ld 一致
+        """
+        s, e, _ = slice(start, end).indices(self.size)
+        if e <= s:
+            zero = np.float64(0)
+            return {
+                "dea": {"end": zero, "max": zero, "min": zero},
+                "dif": {"end": zero, "max": zero, "min": zero},
+                "hist": {
+                    "sum": zero,
+                    "up_sum": zero,
+                    "down_sum": zero,
+                    "max": zero,
+                    "min": zero,
+                    "end": zero,
+                },
+            }
+        hist_nan = self._cum_nan["hist"][e] - self._cum_nan["hist"][s] > 0
+        return {
+            "dea": {
+                "end": self._vals["dea"][e - 1],
+                "max": self._range_value("dea", s, e, True),
+                "min": self._range_value("dea", s, e, False),
+            },
+            "dif": {
+                "end": self._vals["dif"][e - 1],
+                "max": self._range_value("dif", s, e, True),
+                "min": self._range_value("dif", s, e, False),
+            },
+            "hist": {
+                "sum": (
+                    np.float64(np.nan)
+                    if hist_nan
+                    else self._cum["abs"][e] - self._cum["abs"][s]
+                ),
+                "up_sum": self._cum["up"][e] - self._cum["up"][s],
+                "down_sum": abs(self._cum["down"][e] - self._cum["down"][s]),
+                "max": self._range_value("hist", s, e, True),
+                "min": self._range_value("hist", s, e, False),
+                "end": self._vals["hist"][e - 1],
+            },
+        }
+
+    def cross_nums(self, name: str, start: int, end: int) -> int:
+        """
+        K 线索引区间 [start, end) 内发生穿越的次数（与区间内第一根比较的不算，同 cl_utils.up_cross/down_cross）
+        :param name: dif_up dif_down dea_up dea_down gold die
+        """
+        s, e, _ = slice(start, end).indices(self.size)
+        if e - s < 2:
+            return 0
+        positions = self.crosses[name]
+        return bisect.bisect_left(positions, e) - bisect.bisect_left(positions, s + 1)
+
+
+# 每个缠论数据对象对应的 MACD 区间查询结构
+_macd_stores: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_macd_store(cd: ICL) -> MacdStore:
+    """
+    获取缠论数据 MACD 指标的区间查询结构，每次获取会同步最新的指标数据
+    """
+    macd = cd.get_idx()["macd"]
+    try:
+        store = _macd_stores.get(cd)
+    except TypeError:
+        return MacdStore().sync(macd)
+    if store is None:
+        store = MacdStore()
+        _macd_stores[cd] = store
+    return store.sync(macd)
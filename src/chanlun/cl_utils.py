@@ -1,13 +1,20 @@
 import time
+import weakref
+
 from chanlun import fun
 from chanlun.cl_interface import *
+from chanlun.cl_store import get_macd_store
 from chanlun.exchange import exchange
-from chanlun.file_db import FileCacheDB
+from chanlun.file_db import fdb, web_cl_cache
 from chanlun.db import db
 
 
 def web_batch_get_cl_datas(
-    market: str, code: str, klines: Dict[str, pd.DataFrame], cl_config: dict = None
+    market: str,
+    code: str,
+    klines: Dict[str, pd.DataFrame],
+    cl_config: dict = None,
+    use_mem_cache: bool = False,
 ) -> List[ICL]:
     """
     WEB端批量计算并获取 缠论 数据
@@ -16,12 +23,13 @@ def web_batch_get_cl_datas(
     :param code: 计算的标的
     :param klines: 计算的 k线 数据，每个周期对应一个 k线DataFrame，例如 ：{'30m': klines_30m, '5m': klines_5m}
     :param cl_config: 缠论配置
+    :param use_mem_cache: 是否使用进程内的缠论对象缓存（常驻进程使用，比如 web 图表服务），返回缓存对象的副本，否则每次读写文件缓存
     :return: 返回计算好的缠论数据对象，List 列表格式，按照传入的 klines.keys 顺序返回 如上调用：[0] 返回 30m 周期数据 [1] 返回 5m 数据
     """
     cls = []
-    fdb = FileCacheDB()
+    cache = web_cl_cache if use_mem_cache else fdb
     for f, k in klines.items():
-        cls.append(fdb.get_web_cl_data(market, code, f, cl_config, k))
+        cls.append(cache.get_web_cl_data(market, code, f, cl_config, k))
     return cls
 
 
@@ -29,47 +37,45 @@ def cal_klines_macd_infos(start_k: Kline, end_k: Kline, cd: ICL) -> MACD_INFOS:
     """
     计算线中macd信息
     """
+    return cal_range_macd_infos(cd, start_k.index, end_k.index)
+
+
+def cal_range_macd_infos(cd: ICL, start_index: int, end_index: int) -> MACD_INFOS:
+    """
+    计算 K 线索引区间 [start_index, end_index] 的 macd 信息
+    穿越次数从缠论数据对应的 MacdStore 中记录的穿越位置查询，不需要复制指标数据
+    """
     infos = MACD_INFOS()
 
-    idx = cd.get_idx()
-    dea = np.array(idx["macd"]["dea"][start_k.index : end_k.index + 1])
-    dif = np.array(idx["macd"]["dif"][start_k.index : end_k.index + 1])
-    if len(dea) < 2 or len(dif) < 2:
+    store = get_macd_store(cd)
+    end = min(end_index + 1, store.size)
+    if end - start_index < 2:
         return infos
-    zero = np.zeros(len(dea))
-
-    infos.dif_up_cross_num = len(up_cross(dif, zero))
-    infos.dif_down_cross_num = len(down_cross(dif, zero))
-    infos.dea_up_cross_num = len(up_cross(dea, zero))
-    infos.dea_down_cross_num = len(down_cross(dea, zero))
-    infos.gold_cross_num = len(up_cross(dif, dea))
-    infos.die_cross_num = len(down_cross(dif, dea))
-    infos.last_dif = dif[-1]
-    infos.last_dea = dea[-1]
+
+    infos.dif_up_cross_num = store.cross_nums("dif_up", start_index, end)
+    infos.dif_down_cross_num = store.cross_nums("dif_down", start_index, end)
+    infos.dea_up_cross_num = store.cross_nums("dea_up", start_index, end)
+    infos.dea_down_cross_num = store.cross_nums("dea_down", start_index, end)
+    infos.gold_cross_num = store.cross_nums("gold", start_index, end)
+    infos.die_cross_num = store.cross_nums("die", start_index, end)
+    infos.last_dif = store.dif[end - 1]
+    infos.last_dea = store.dea[end - 1]
     return infos
 
 
 def cal_line_macd_infos(line: LINE, cd: ICL) -> MACD_INFOS:
     """
     计算线中macd信息
+    已完成的线（并且不包含最后一根K线），计算结果不会再变化，缓存在线对象中
     """
-    infos = MACD_INFOS()
-
-    idx = cd.get_idx()
-    dea = np.array(idx["macd"]["dea"][line.start.k.k_index : line.end.k.k_index + 1])
-    dif = np.array(idx["macd"]["dif"][line.start.k.k_index : line.end.k.k_index + 1])
-    if len(dea) < 2 or len(dif) < 2:
-        return infos
-    zero = np.zeros(len(dea))
-
-    infos.dif_up_cross_num = len(up_cross(dif, zero))
-    infos.dif_down_cross_num = len(down_cross(dif, zero))
-    infos.dea_up_cross_num = len(up_cross(dea, zero))
-    infos.dea_down_cross_num = len(down_cross(dea, zero))
-    infos.gold_cross_num = len(up_cross(dif, dea))
-    infos.die_cross_num = len(down_cross(dif, dea))
-    infos.last_dif = dif[-1]
-    infos.last_dea = dea[-1]
+    key = (line.start.k.k_index, line.end.k.k_index)
+    cache = getattr(line, "_macd_infos", None)
+    if cache is not None and cache[0] == key:
+        return cache[1]
+
+    infos = cal_range_macd_infos(cd, line.start.k.k_index, line.end.k.k_index)
+    if line.is_done() and line.end.k.k_index < len(cd.get_idx()["macd"]["hist"]) - 1:
+        line._macd_infos = (key, infos)
     return infos
 
 
@@ -252,26 +258,7 @@ def cal_zs_macd_infos(zs: ZS, cd: ICL) -> MACD_INFOS:
     """
     计算中枢的macd信息
     """
-    infos = MACD_INFOS()
-    dea = np.array(
-        cd.get_idx()["macd"]["dea"][zs.start.k.k_index : zs.end.k.k_index + 1]
-    )
-    dif = np.array(
-        cd.get_idx()["macd"]["dif"][zs.start.k.k_index : zs.end.k.k_index + 1]
-    )
-    if len(dea) < 2 or len(dif) < 2:
-        return infos
-    zero = np.zeros(len(dea))
-
-    infos.dif_up_cross_num = len(up_cross(dif, zero))
-    infos.dif_down_cross_num = len(down_cross(dif, zero))
-    infos.dea_up_cross_num = len(up_cross(dea, zero))
-    infos.dea_down_cross_num = len(down_cross(dea, zero))
-    infos.gold_cross_num = len(up_cross(dif, dea))
-    infos.die_cross_num = len(down_cross(dif, dea))
-    infos.last_dif = dif[-1]
-    infos.last_dea = dea[-1]
-    return infos
+    return cal_range_macd_infos(cd, zs.start.k.k_index, zs.end.k.k_index)
 
 
 def query_cl_chart_config(market: str, code: str) -> Dict[str, object]:
@@ -616,11 +603,14 @@ def prices_jiaodu(prices):
     return j if prices[-1] > prices[0] else -j
 
 
-def cl_data_to_tv_chart(cd: ICL, config: dict, to_frequency: str = None):
+# 图表转换周期后的K线，缠论对象释放后自动删除，再次刷新时只重新合并最后未完成的k线
+_tv_chart_period_klines: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def cl_klines_to_pd(cd: ICL, klines: List[Kline] = None) -> pd.DataFrame:
     """
-    将缠论数据，转换成 tv 画图的坐标数据
+    将缠论数据的 K 线转换成 DataFrame
     """
-    # K线
     klines = [
         {
             "date": k.date,
@@ -630,22 +620,79 @@ def cl_data_to_tv_chart(cd: ICL, config: dict, to_frequency: str = None):
             "close": k.c,
             "volume": k.a,
         }
-        for k in cd.get_klines()
+        for k in (cd.get_klines() if klines is None else klines)
     ]
     klines = pd.DataFrame(klines)
     klines.loc[:, "code"] = cd.get_code()
+    return klines
+
+
+def cl_klines_convert_frequency(cd: ICL, to_frequency: str) -> pd.DataFrame:
+    """
+    将缠论数据的 K 线转换成指定的周期，保存转换结果，之后刷新只重新合并最后未完成的k线
+    :param cd: 缠论数据
+    :param to_frequency: 转换的周期，格式 market:frequency，例如 a:w
+    :return:
+    """
+    market = to_frequency.split(":")[0]
+    frequency = to_frequency.split(":")[1]
+    if market == "a":
+        convert_fun = exchange.convert_stock_kline_frequency
+    elif market == "futures":
+        convert_fun = exchange.convert_futures_kline_frequency
+    elif market == "currency":
+        convert_fun = exchange.convert_currency_kline_frequency
+    else:
+        raise Exception(f"图表周期数据转换，不支持的市场 {market}")
+
+    cd_klines = cd.get_klines()
+    try:
+        caches = _tv_chart_period_klines.setdefault(cd, {})
+    except TypeError:
+        # 不支持弱引用的对象，不进行缓存
+        caches = {}
+    period_klines = caches.get(to_frequency)
+    start_idx = 0
+    if period_klines is not None and len(period_klines) >= 2 and len(cd_klines) > 0:
+        # 从最后一根大周期k线的开始位置重新合并，之前的k线需要未变化（第一根与最后一根未完成k线之前的一根）
+        last_first_date = period_klines["first_date"].iloc[-1]
+        start_idx = len(cd_klines) - 1
+        while start_idx > 0 and cd_klines[start_idx].date > last_first_date:
+            start_idx -= 1
+        if (
+            start_idx == 0
+            or cd_klines[start_idx].date != last_first_date
+            or cd_klines[start_idx - 1].c != period_klines["close"].iloc[-2]
+            or cd_klines[0].date != period_klines["first_date"].iloc[0]
+            or cd_klines[0].o != period_klines["open"].iloc[0]
+        ):
+            start_idx = 0
+
+    if start_idx == 0:
+        period_klines = exchange.convert_kline_frequency_incremental(
+            convert_fun, cl_klines_to_pd(cd, cd_klines), frequency
+        )
+    else:
+        period_klines = exchange.convert_kline_frequency_incremental(
+            convert_fun,
+            cl_klines_to_pd(cd, cd_klines[start_idx:]),
+            frequency,
+            period_klines,
+        )
+    caches[to_frequency] = period_klines
+    return period_klines
+
+
+def cl_data_to_tv_chart(cd: ICL, config: dict, to_frequency: str = None):
+    """
+    将缠论数据，转换成 tv 画图的坐标数据
+    """
+    # K线
     if to_frequency is not None:
         # 将数据转换成指定的周期数据
-        market = to_frequency.split(":")[0]
-        frequency = to_frequency.split(":")[1]
-        if market == "a":
-            klines = exchange.convert_stock_kline_frequency(klines, frequency)
-        elif market == "futures":
-            klines = exchange.convert_futures_kline_frequency(klines, frequency)
-        elif market == "currency":
-            klines = exchange.convert_currency_kline_frequency(klines, frequency)
-        else:
-            raise Exception(f"图表周期数据转换，不支持的市场 {market}")
+        klines = cl_klines_convert_frequency(cd, to_frequency)
+    else:
+        klines = cl_klines_to_pd(cd)
     # K 线数据
     kline_ts = klines["date"].map(fun.datetime_to_int).tolist()
     kline_cs = klines["close"].tolist()
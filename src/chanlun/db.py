@@ -4,7 +4,9 @@ import time
 from typing import List, Union
 import numpy as np
 import pandas as pd
+import pytz
 import warnings
+from dateutil import tz
 
 from sqlalchemy import (
     UniqueConstraint,
@@ -16,8 +18,11 @@ from sqlalchemy import (
     DateTime,
     Text,
     func,
+    select,
+    event,
 )
 from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import QueuePool
@@ -170,6 +175,17 @@ class DB(object):
                 max_overflow=20,
                 pool_timeout=10,
             )
+
+            @event.listens_for(self.engine, "connect")
+            def _sqlite_pragma(dbapi_connection, connection_record):
+                # WAL 模式，读写不互相阻塞，并减少每次提交时的磁盘同步
+                cursor = dbapi_connection.cursor()
+                cursor.execute("PRAGMA journal_mode=WAL")
+                cursor.execute("PRAGMA synchronous=NORMAL")
+                cursor.execute("PRAGMA cache_size=-65536")
+                cursor.execute("PRAGMA temp_store=MEMORY")
+                cursor.close()
+
         elif config.DB_TYPE == "mysql":
             self.engine = create_engine(
                 f"mysql+pymysql://{config.DB_USER}:{config.DB_PWD}@{config.DB_HOST}:{config.DB_PORT}/{config.DB_DATABASE}?charset=utf8",
@@ -272,6 +288,49 @@ class DB(object):
                 query = query.limit(limit)
             return query.all()
 
+    def klines_query_columns(
+        self,
+        market: str,
+        code: str,
+        frequency: str,
+        start_date: datetime.datetime = None,
+        end_date: datetime.datetime = None,
+        limit: int = 5000,
+        order: str = "desc",
+    ) -> pd.DataFrame:
+        """
+        按列获取k线数据，只查询需要的字段，不创建 ORM 对象，直接返回 DataFrame
+        返回列：date open high low close volume （date 为数据库中原始的时间，没有时区信息）
+        :param market:
+        :param code:
+        :param frequency:
+        :param start_date:
+        :param end_date:
+        :param limit:
+        :param order:
+        :return:
+        """
+        table = self.klines_tables(market, code)
+        query = select(table.dt, table.o, table.h, table.l, table.c, table.v).where(
+            table.code == code, table.f == frequency
+        )
+        if start_date is not None:
+            query = query.where(table.dt >= start_date)
+        if end_date is not None:
+            query = query.where(table.dt <= end_date)
+        if order == "desc":
+            query = query.order_by(table.dt.desc())
+        else:
+            query = query.order_by(table.dt.asc())
+        if limit is not None:
+            query = query.limit(limit)
+        with self.engine.connect() as conn:
+            rows = conn.execute(query).fetchall()
+        return pd.DataFrame(
+            [tuple(_r) for _r in rows],
+            columns=["date", "open", "high", "low", "close", "volume"],
+        )
+
     def klines_last_datetime(self, market, code, frequency):
         """
         查询k线表中最后一条记录的日期
@@ -307,64 +366,28 @@ class DB(object):
         :param klines:
         :return:
         """
-        with self.Session() as session:
-            table = self.klines_tables(market, code)
+        table = self.klines_tables(market, code)
+        insert_klines = self._klines_to_rows(code, frequency, klines)
+        if len(insert_klines) == 0:
+            return True
 
-            # 如果是 sqlite ，则慢慢更新吧
+        update_keys = ["o", "c", "h", "l", "v"]
+        with self.Session() as session:
             if config.DB_TYPE == "sqlite":
-                for _, _k in klines.iterrows():
-                    _in_k = {
-                        "code": code,
-                        "f": frequency,
-                        "dt": fun.str_to_datetime(fun.datetime_to_str(_k["date"])),
-                        "o": _k["open"],
-                        "c": _k["close"],
-                        "h": _k["high"],
-                        "l": _k["low"],
-                        "v": _k["volume"],
-                    }
-                    db_k = (
-                        session.query(table)
-                        .filter(
-                            table.code == code,
-                            table.f == frequency,
-                            table.dt == _in_k["dt"],
-                        )
-                        .first()
-                    )
-                    if db_k is None:
-                        session.add(table(**_in_k))
-                    else:
-                        session.query(table).filter(
-                            table.code == code,
-                            table.f == frequency,
-                            table.dt == _in_k["dt"],
-                        ).update(_in_k)
+                # sqlite 使用 INSERT ... ON CONFLICT DO UPDATE 分批 executemany，在一个事务中提交
+                insert_stmt = sqlite_insert(table)
+                upsert_stmt = insert_stmt.on_conflict_do_update(
+                    index_elements=["code", "dt", "f"],
+                    set_={_k: insert_stmt.excluded[_k] for _k in update_keys},
+                )
+                for i in range(0, len(insert_klines), 5000):
+                    session.execute(upsert_stmt, insert_klines[i : i + 5000])
                 session.commit()
                 return True
 
             # 将 klines 数据拆分为每 500 条一组，批量插入
-            group = np.arange(len(klines)) // 500
-            groups = [
-                group.reset_index(drop=True) for _, group in klines.groupby(group)
-            ]
-            for g_klines in groups:
-                insert_klines = []
-                for _, _k in g_klines.iterrows():
-                    insert_klines.append(
-                        {
-                            "code": code,
-                            "dt": fun.str_to_datetime(fun.datetime_to_str(_k["date"])),
-                            "f": frequency,
-                            "o": _k["open"],
-                            "c": _k["close"],
-                            "h": _k["high"],
-                            "l": _k["low"],
-                            "v": _k["volume"],
-                        }
-                    )
-                insert_stmt = insert(table).values(insert_klines)
-                update_keys = ["o", "c", "h", "l", "v"]
+            for i in range(0, len(insert_klines), 500):
+                insert_stmt = insert(table).values(insert_klines[i : i + 500])
                 update_columns = {
                     x.name: x for x in insert_stmt.inserted if x.name in update_keys
                 }
@@ -374,6 +397,46 @@ class DB(object):
 
         return True
 
+    @staticmethod
+    def _klines_to_rows(code: str, frequency: str, klines: pd.DataFrame) -> List[dict]:
+        """
+        将 k线 DataFrame 转换成数据库插入的字典列表
+        """
+        # 与 fun.str_to_datetime(fun.datetime_to_str(dt)) 结果一致：取K线时间的字面时间，按本地时区解析，再转换到上海时区
+        dates = pd.to_datetime(klines["date"])
+        if dates.dt.tz is not None:
+            dates = dates.dt.tz_localize(None)
+        dates = (
+            dates.dt.floor("s")
+            .dt.tz_localize(
+                tz.tzlocal(),
+                ambiguous=np.ones(len(dates), dtype=bool),
+                nonexistent="shift_forward",
+            )
+            .dt.tz_convert(pytz.timezone("Asia/Shanghai"))
+            .dt.to_pydatetime()
+        )
+        return [
+            {
+                "code": code,
+                "dt": _d,
+                "f": frequency,
+                "o": _o,
+                "c": _c,
+                "h": _h,
+                "l": _l,
+                "v": _v,
+            }
+            for _d, _o, _c, _h, _l, _v in zip(
+                dates,
+                klines["open"].tolist(),
+                klines["close"].tolist(),
+                klines["high"].tolist(),
+                klines["low"].tolist(),
+                klines["volume"].tolist(),
+            )
+        ]
+
     def klines_delete(
         self,
         market: str,
@@ -1,3 +1,6 @@
+import threading
+import time
+
 from chanlun.base import Market
 from chanlun import config
 
@@ -18,6 +21,85 @@ from chanlun.exchange.exchange_tdx_us import ExchangeTDXUS
 # 全局保存交易所对象，避免创建多个交易所对象
 g_exchange_obj = {}
 
+# K 线请求结果的缓存秒数，周期越小缓存时间越短，不在其中的周期使用默认的缓存秒数
+klines_cache_seconds = {"10s": 1, "30s": 1, "1m": 1, "2m": 2, "3m": 2, "5m": 3}
+klines_cache_default_seconds = 5
+
+
+class KlinesSingleFlight(object):
+    """
+    交易所 klines 请求合并
+    并发的相同请求（代码、周期、开始结束时间、参数都相同）只执行一次，其他请求等待并共用这次的结果
+    请求的结果，按照周期缓存很短的时间，期间相同的请求直接返回缓存结果
+    """
+
+    def __init__(self, klines_fun):
+        self.klines_fun = klines_fun
+        self._lock = threading.Lock()
+        # 正在执行中的请求
+        self._calls = {}
+        # 请求结果缓存，value 为 (过期时间, 结果)
+        self._cache = {}
+
+    @staticmethod
+    def _copy(klines):
+        return klines.copy() if klines is not None else None
+
+    def __call__(
+        self,
+        code: str,
+        frequency: str,
+        start_date: str = None,
+        end_date: str = None,
+        args=None,
+    ):
+        key = (
+            code,
+            frequency,
+            str(start_date),
+            str(end_date),
+            repr(sorted(args.items())) if args else None,
+        )
+        with self._lock:
+            cache = self._cache.get(key)
+            if cache is not None and cache[0] > time.time():
+                return self._copy(cache[1])
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+
+        if is_leader is False:
+            # 等待正在执行的相同请求
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return self._copy(call["result"])
+
+        try:
+            call["result"] = self.klines_fun(code, frequency, start_date, end_date, args)
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+                now = time.time()
+                if call["error"] is None and call["result"] is not None:
+                    self._cache[key] = (
+                        now
+                        + klines_cache_seconds.get(
+                            frequency, klines_cache_default_seconds
+                        ),
+                        call["result"],
+                    )
+                # 清理过期的缓存
+                for _k in [_k for _k, _v in self._cache.items() if _v[0] <= now]:
+                    del self._cache[_k]
+            call["event"].set()
+        return self._copy(call["result"])
+
 
 def get_exchange(market: Market) -> Exchange:
     """
@@ -105,4 +187,8 @@ def get_exchange(market: Market) -> Exchange:
         else:
             raise Exception(f"不支持的美股交易所 {config.EXCHANGE_US}")
 
-    return g_exchange_obj[market.value]
+    # 合并并发的相同 K 线请求
+    ex = g_exchange_obj[market.value]
+    ex.klines = KlinesSingleFlight(ex.klines)
+
+    return ex
@@ -0,0 +1,191 @@
+import datetime
+import os
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+import pandas as pd
+
+from chanlun import fun
+from chanlun.config import get_data_path
+from chanlun.file_db import FileCacheDB
+
+"""
+复权数据的存储与复权计算
+
+之前每次获取K线都会重新读取代码的除权除息文件（或复权因子 csv），并将除权除息信息与K线合并、向前填充后，在整个K线上计算前收盘价与复权系数
+这里每个代码的复权数据只保存需要的部分：
+    A股：除权除息事件（category == 1）的时间戳与 分红、配股、配股价、送转股
+    港股、美股：复权因子序列的时间戳与复权因子
+在进程内缓存，每天最多从接口检查一次，数据没有变化不重新写入文件
+复权计算使用时间戳数组查找每根K线对应的事件（asof），累乘后对价格数组直接相乘
+"""
+
+
+class AdjFactorStore(object):
+    """
+    代码复权数据的文件存储
+    """
+
+    def __init__(self, name: str):
+        """
+        :param name: 存储名称（市场），文件保存在 {数据目录}/adj_factor/{name}_{code}.pkl
+        """
+        self.name = name
+        self.path = get_data_path() / "adj_factor"
+        if self.path.is_dir() is False:
+            self.path.mkdir(parents=True)
+        # 代码 : (检查日期, 复权数据)
+        self._cache: Dict[str, Tuple[str, pd.DataFrame]] = {}
+
+    def filename(self, code: str):
+        return self.path / f"{self.name}_{code.replace('.', '_')}.pkl"
+
+    def get(self, code: str, fetch_fun: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        """
+        获取代码的复权数据，当天没有检查过，则调用 fetch_fun 获取，有变化才写入文件
+        :param code: 代码
+        :param fetch_fun: 从接口获取复权数据的方法
+        """
+        now_day = fun.datetime_to_str(datetime.datetime.now(), "%Y-%m-%d")
+        cache = self._cache.get(code)
+        if cache is not None and cache[0] == now_day:
+            return cache[1]
+
+        file = self.filename(code)
+        data = cache[1] if cache is not None else None
+        if data is None and file.is_file():
+            data = pd.read_pickle(file)
+            if fun.timeint_to_str(int(file.stat().st_mtime), "%Y-%m-%d") == now_day:
+                self._cache[code] = (now_day, data)
+                return data
+
+        new_data = fetch_fun()
+        if new_data is not None and (data is None or not new_data.equals(data)):
+            FileCacheDB.write_pkl_file(file, new_data)
+            data = new_data
+        elif file.is_file():
+            # 没有变化，只更新文件的修改时间作为检查日期
+            os.utime(file)
+        if data is None:
+            data = pd.DataFrame([])
+        self._cache[code] = (now_day, data)
+        return data
+
+
+def xdxr_events(xdxr_data: pd.DataFrame, tz) -> pd.DataFrame:
+    """
+    通达信除权除息信息中的除权除息事件
+    :param xdxr_data: get_xdxr_info 的数据（包括 date 列）
+    :param tz: 时区
+    :return: (ts 时间戳, fenhong, peigu, peigujia, songzhuangu)
+    """
+    columns = ["fenhong", "peigu", "peigujia", "songzhuangu"]
+    if len(xdxr_data) == 0:
+        return pd.DataFrame([], columns=["ts"] + columns)
+    info = xdxr_data[xdxr_data["category"] == 1]
+    events = pd.DataFrame(
+        {"ts": pd.DatetimeIndex(info["date"]).tz_localize(tz).asi8}
+    )
+    for _c in columns:
+        events[_c] = info[_c].fillna(0).to_numpy(dtype=np.float64)
+    return events.sort_values("ts", kind="stable").reset_index(drop=True)
+
+
+def xdxr_fq(klines: pd.DataFrame, events: pd.DataFrame, fq_type: str) -> pd.DataFrame:
+    """
+    使用除权除息事件对K线进行复权，结果与之前合并事件后逐行计算的方式完全一致
+    K线与时间范围内的事件按时间合并（与K线时间相同的事件在K线上，其他事件插入，收盘价使用前一根K线的），
+    每行的前收盘价 = (上一行收盘价 * 10 - 分红 + 配股 * 配股价) / (10 + 配股 + 送转股)
+    前复权：每行的比例 = 下一行的前收盘价 / 收盘价，从后向前累乘；后复权：比例的倒数从前向后累乘，不包括当前行
+    没有事件的行比例接近 1（乘除 10 有浮点误差），也需要按照顺序累乘，否则价格保留两位小数时可能相差 0.01
+    :param klines: 按时间排序的K线
+    :param events: xdxr_events 返回的除权除息事件
+    :param fq_type: qfq 前复权 / hfq 后复权
+    """
+    if len(events) == 0 or len(klines) == 0:
+        return klines
+    ts = pd.DatetimeIndex(klines["date"]).asi8
+    e_ts = events["ts"].to_numpy(dtype=np.int64)
+    in_range = (e_ts >= ts[0]) & (e_ts <= ts[-1])
+    e_ts = e_ts[in_range]
+
+    # 合并后K线与事件所在的行，插入的事件在之后的第一根K线之前
+    k_idx = np.searchsorted(ts, e_ts, side="left")
+    is_insert = ts[k_idx] != e_ts
+    k_pos = np.arange(len(ts)) + np.searchsorted(e_ts[is_insert], ts, side="left")
+    e_pos = np.where(is_insert, k_idx + np.cumsum(is_insert) - 1, k_pos[k_idx])
+    rows = len(ts) + int(is_insert.sum())
+
+    close = klines["close"].to_numpy(dtype=np.float64)
+    m_close = np.empty(rows, dtype=np.float64)
+    m_close[k_pos] = close
+    # 插入的事件行，收盘价使用前一根K线的收盘价
+    m_close[e_pos[is_insert]] = close[k_idx[is_insert] - 1]
+    fenhong, peigu, peigujia, songzhuangu = [np.zeros(rows) for _ in range(4)]
+    for _arr, _c in zip(
+        [fenhong, peigu, peigujia, songzhuangu],
+        ["fenhong", "peigu", "peigujia", "songzhuangu"],
+    ):
+        _arr[e_pos] = events[_c].to_numpy(dtype=np.float64)[in_range]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        preclose = (m_close[:-1] * 10 - fenhong[1:] + peigu[1:] * peigujia[1:]) / (
+            10 + peigu[1:] + songzhuangu[1:]
+        )
+        if fq_type == "qfq":
+            ratio = np.append(preclose / m_close[:-1], 1.0)
+            ratio[np.isnan(ratio)] = 1.0
+            adj = np.cumprod(ratio[::-1])[::-1][k_pos]
+        elif fq_type == "hfq":
+            ratio = m_close[:-1] / preclose
+            is_nan = np.isnan(ratio)
+            adj = np.cumprod(np.where(is_nan, 1.0, ratio))
+            adj = np.append(1.0, np.where(is_nan, 1.0, adj))[k_pos]
+        else:
+            adj = None
+
+    klines = klines.copy()
+    if adj is not None:
+        for col in ["open", "high", "low", "close"]:
+            values = klines[col].to_numpy(dtype=np.float64)
+            values = values * adj if fq_type == "qfq" else values / adj
+            klines[col] = np.round(values, 2)
+
+    klines = klines[klines["open"] != 0]
+    return klines[["code", "date", "open", "close", "high", "low", "volume"]]
+
+
+def qfq_factors(factor_data: pd.DataFrame, tz) -> pd.DataFrame:
+    """
+    akshare 的复权因子数据（date, qfq_factor）
+    :return: (ts 时间戳, qfq_factor)，按时间排序
+    """
+    if factor_data is None or len(factor_data) == 0:
+        return pd.DataFrame([], columns=["ts", "qfq_factor"])
+    factors = pd.DataFrame(
+        {
+            "ts": pd.DatetimeIndex(pd.to_datetime(factor_data["date"]))
+            .tz_localize(tz)
+            .asi8,
+            "qfq_factor": factor_data["qfq_factor"].astype(float).to_numpy(),
+        }
+    )
+    return factors.sort_values("ts", kind="stable").reset_index(drop=True)
+
+
+def factor_qfq(klines: pd.DataFrame, factors: pd.DataFrame) -> pd.DataFrame:
+    """
+    使用复权因子序列进行前复权，每根K线乘以时间不晚于K线的最后一个复权因子，之前没有复权因子的K线删除
+    :param klines: 按时间排序的K线
+    :param factors: qfq_factors 返回的复权因子
+    """
+    if len(factors) == 0:
+        return klines
+    ts = pd.DatetimeIndex(klines["date"]).asi8
+    idx = np.searchsorted(factors["ts"].to_numpy(dtype=np.int64), ts, side="right") - 1
+    klines = klines[idx >= 0].copy()
+    adj = factors["qfq_factor"].to_numpy(dtype=np.float64)[idx[idx >= 0]]
+    for col in ["open", "high", "low", "close"]:
+        klines[col] = klines[col].to_numpy() * adj
+    klines = klines.dropna().reset_index(drop=True)
+    return klines[["code", "date", "open", "high", "low", "close", "volume"]]
@@ -1,8 +1,11 @@
 import datetime
+import threading
+import time
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import List, Dict
+from typing import Callable, List, Dict, Tuple
 
+import numpy as np
 import pandas as pd
 import pytz
 
@@ -13,6 +16,7 @@ from chanlun.fun import (
     str_to_datetime,
     timeint_to_datetime,
 )
+from chanlun.exchange.symbol_registry import SymbolRegistry
 
 # 统一时区设置
 __tz = pytz.timezone("Asia/Shanghai")
@@ -31,6 +35,54 @@ class Tick:
     rate: float = 0
 
 
+class TicksCache(object):
+    """
+    行情的短时缓存
+    同一进程中的交易与 web 使用同一个交易所对象，有效期内的行情直接返回，只请求没有缓存或者已过期的代码
+    """
+
+    def __init__(self, ttl: float = 3):
+        """
+        :param ttl: 行情的有效期（秒）
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._ticks: Dict[str, Tuple[float, Tick]] = {}
+
+    def ticks(
+        self, codes: List[str], query_fun: Callable[[List[str]], Dict[str, Tick]]
+    ) -> Dict[str, Tick]:
+        """
+        获取代码的行情
+        :param codes: 代码列表
+        :param query_fun: 请求行情的方法，传入没有缓存的代码列表
+        """
+        ticks = {}
+        query_codes = []
+        now = time.time()
+        with self._lock:
+            for _c in codes:
+                _cache = self._ticks.get(_c)
+                if _cache is not None and now - _cache[0] <= self.ttl:
+                    ticks[_c] = _cache[1]
+                elif _c not in ticks.keys():
+                    ticks[_c] = None
+                    query_codes.append(_c)
+        if len(query_codes) > 0:
+            query_ticks = query_fun(query_codes)
+            now = time.time()
+            with self._lock:
+                for _c, _t in query_ticks.items():
+                    self._ticks[_c] = (now, _t)
+            ticks.update(query_ticks)
+        return {_c: _t for _c, _t in ticks.items() if _t is not None}
+
+    def clear(self):
+        with self._lock:
+            self._ticks = {}
+        return True
+
+
 class Exchange(ABC):
     """
     交易所类
@@ -58,6 +110,19 @@ class Exchange(ABC):
         :return:
         """
 
+    def symbols(self) -> SymbolRegistry:
+        """
+        代码注册表，根据 all_stocks 建立的代码索引，股票列表变化后重新建立
+        """
+        stocks = self.all_stocks()
+        registry: SymbolRegistry = self.__dict__.get("_symbols")
+        if registry is None or registry.stocks is not stocks or registry.size != len(
+            stocks
+        ):
+            registry = SymbolRegistry(stocks)
+            self._symbols = registry
+        return registry
+
     @abstractmethod
     def now_trading(self):
         """
@@ -148,6 +213,255 @@ class Exchange(ABC):
         """
 
 
+# A股 60m、120m 周期的交易时段表，key 为合并后的时间，value 为时段的开始与结束时间（包含）
+STOCK_SESSION_MAPS = {
+    "60m": {
+        "10:30:00": ["09:00:00", "10:30:00"],
+        "11:30:00": ["10:30:01", "11:30:00"],
+        "14:00:00": ["13:00:00", "14:00:00"],
+        "15:00:00": ["14:00:01", "15:00:00"],
+    },
+    "120m": {
+        "11:30:00": ["09:00:00", "11:30:00"],
+        "15:00:00": ["13:00:00", "15:00:00"],
+    },
+}
+
+# 期货 30m、60m 周期的交易时段表，按照配置的顺序匹配，第一个匹配的时段生效
+FUTURES_SESSION_MAPS = {
+    "gm": {
+        # 掘金的处理逻辑，凑够符合分钟数的数据 (有夜盘交易的还是有差异，暂时不考虑)
+        "30m": {
+            "09:00:00": ["09:00:00", "09:29:59"],
+            "09:30:00": ["09:30:00", "09:59:59"],
+            "10:00:00": ["10:00:00", "10:44:59"],
+            "10:45:00": ["10:45:00", "11:14:59"],
+            "11:15:00": ["11:15:00", "13:44:59"],
+            "13:45:00": ["13:45:00", "14:14:59"],
+            "14:15:00": ["14:15:00", "14:44:59"],
+            "14:45:00": ["14:45:00", "14:59:59"],
+            "21:00:00": ["21:00:00", "21:29:59"],
+            "21:30:00": ["21:30:00", "21:59:59"],
+            "22:00:00": ["21:00:00", "22:29:59"],
+            "22:30:00": ["21:30:00", "22:59:59"],
+            "23:00:00": ["23:00:00", "23:29:59"],
+            "23:30:00": ["23:30:00", "23:59:59"],
+            "00:00:00": ["00:00:00", "00:29:59"],
+            "00:30:00": ["00:30:00", "00:59:59"],
+            "01:00:00": ["01:00:00", "01:29:59"],
+            "01:30:00": ["01:30:00", "01:59:59"],
+            "02:00:00": ["02:00:00", "02:29:59"],
+            "02:30:00": ["02:30:00", "02:59:59"],
+        },
+        "60m": {
+            "09:00:00": ["09:00:00", "09:59:59"],
+            "10:00:00": ["10:00:00", "11:14:59"],
+            "11:15:00": ["11:15:00", "14:14:59"],
+            "14:15:00": ["14:15:00", "14:59:59"],
+            "21:00:00": ["21:00:00", "21:59:59"],
+            "22:00:00": ["21:00:00", "22:59:59"],
+            "23:00:00": ["23:00:00", "23:59:59"],
+            "00:00:00": ["00:00:00", "00:59:59"],
+            "01:00:00": ["01:00:00", "01:59:59"],
+            "02:00:00": ["02:00:00", "02:59:59"],
+        },
+    },
+    "tq": {
+        # 天勤的处理逻辑，直接按照整数处理，前对其
+        "30m": {
+            "09:00:00": ["09:00:00", "09:29:59"],
+            "09:30:00": ["09:30:00", "09:59:59"],
+            "10:00:00": ["10:00:00", "10:29:59"],
+            "10:30:00": ["10:30:00", "10:59:59"],
+            "11:00:00": ["11:00:00", "11:29:59"],
+            "11:30:00": ["11:30:00", "11:59:59"],
+            "13:00:00": ["13:00:00", "13:29:59"],
+            "13:30:00": ["13:30:00", "13:59:59"],
+            "14:00:00": ["14:00:00", "14:29:59"],
+            "14:30:00": ["14:30:00", "14:59:59"],
+            "21:00:00": ["21:00:00", "21:29:59"],
+            "21:30:00": ["21:30:00", "21:59:59"],
+            "22:00:00": ["21:00:00", "22:29:59"],
+            "22:30:00": ["21:30:00", "22:59:59"],
+            "23:00:00": ["23:00:00", "23:29:59"],
+            "23:30:00": ["23:30:00", "23:59:59"],
+            "00:00:00": ["00:00:00", "00:29:59"],
+            "00:30:00": ["00:30:00", "00:59:59"],
+            "01:00:00": ["01:00:00", "01:29:59"],
+            "01:30:00": ["01:30:00", "01:59:59"],
+            "02:00:00": ["02:00:00", "02:29:59"],
+            "02:30:00": ["02:30:00", "02:59:59"],
+        },
+        "60m": {
+            "09:00:00": ["09:00:00", "09:59:59"],
+            "10:00:00": ["10:00:00", "10:59:59"],
+            "11:00:00": ["11:00:00", "11:59:59"],
+            "13:00:00": ["13:00:00", "13:59:59"],
+            "21:00:00": ["21:00:00", "21:59:59"],
+            "22:00:00": ["21:00:00", "22:59:59"],
+            "23:00:00": ["23:00:00", "23:59:59"],
+            "00:00:00": ["00:00:00", "00:59:59"],
+            "01:00:00": ["01:00:00", "01:59:59"],
+            "02:00:00": ["02:00:00", "02:59:59"],
+        },
+    },
+}
+
+# 交易时段表的数组缓存
+_session_tables: Dict[tuple, np.ndarray] = {}
+
+
+def get_session_table(market: str, to_f: str, config: dict) -> np.ndarray:
+    """
+    将交易时段配置转换成数组 [[开始秒数, 结束秒数, 合并后时间秒数], ...]，秒数为当日的秒数，每个市场周期只计算一次
+    :param market: 交易时段表的名称
+    :param to_f:
+    :param config: 交易时段配置
+    :return:
+    """
+    key = (market, to_f)
+    if key not in _session_tables.keys():
+
+        def time_to_seconds(t: str) -> int:
+            h, m, s = t.split(":")
+            return int(h) * 3600 + int(m) * 60 + int(s)
+
+        _session_tables[key] = np.array(
+            [
+                [time_to_seconds(_r[0]), time_to_seconds(_r[1]), time_to_seconds(_t)]
+                for _t, _r in config.items()
+            ],
+            dtype=np.int64,
+        )
+    return _session_tables[key]
+
+
+def convert_session_kline_frequency(
+    klines: pd.DataFrame, to_f: str, session_table: np.ndarray
+) -> pd.DataFrame:
+    """
+    按照交易时段表合并 k 线（向量化处理）
+    每根 k 线按照所在日期与当日时间，找到所属的时段，相同时段的 k 线合并为一根
+    :param klines:
+    :param to_f:
+    :param session_table: get_session_table 返回的时段数组
+    :return:
+    """
+    columns = ["code", "date", "open", "close", "high", "low", "volume"]
+    if len(klines) == 0:
+        return pd.DataFrame([], columns=columns)
+
+    dates = pd.to_datetime(klines["date"])
+    # 使用 k 线的字面日期时间进行匹配
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_localize(None)
+    days = dates.dt.normalize()
+    seconds = ((dates - days) // pd.Timedelta(seconds=1)).to_numpy()
+
+    # 倒序赋值，重叠的时段以配置中靠前的为准
+    new_seconds = np.full(len(seconds), -1, dtype=np.int64)
+    for range_start, range_end, new_time in session_table[::-1]:
+        new_seconds[(seconds >= range_start) & (seconds <= range_end)] = new_time
+    if (new_seconds == -1).any():
+        error_dt = klines["date"].iloc[int(np.argmax(new_seconds == -1))]
+        raise Exception(f"转换时间错误：{to_f}, {error_dt}")
+
+    new_dates = (days + pd.to_timedelta(new_seconds, unit="s")).dt.tz_localize(__tz)
+
+    # 按照出现的顺序分组，记录每组的第一根与最后一根 k 线位置
+    group_ids, group_dates = pd.factorize(new_dates, sort=False)
+    positions = np.arange(len(group_ids))
+    first_idx = np.full(len(group_dates), len(group_ids), dtype=np.int64)
+    np.minimum.at(first_idx, group_ids, positions)
+    last_idx = np.full(len(group_dates), -1, dtype=np.int64)
+    np.maximum.at(last_idx, group_ids, positions)
+
+    volume = pd.to_numeric(klines["volume"]).astype(float).fillna(0)
+    kline_pd = pd.DataFrame(
+        {
+            "code": klines["code"].to_numpy()[first_idx],
+            "date": group_dates,
+            "open": klines["open"].to_numpy()[first_idx],
+            "close": klines["close"].to_numpy()[last_idx],
+            "high": klines["high"].groupby(group_ids).max().to_numpy(),
+            "low": klines["low"].groupby(group_ids).min().to_numpy(),
+            "volume": volume.groupby(group_ids).sum().to_numpy(),
+        }
+    )
+    return kline_pd[columns]
+
+
+def convert_kline_frequency_incremental(
+    convert_fun: Callable,
+    klines: pd.DataFrame,
+    to_f: str,
+    period_klines: pd.DataFrame = None,
+    **kwargs,
+) -> pd.DataFrame:
+    """
+    增量转换 k 线周期，只重新合并最后一根（未完成的）大周期 k 线所包含的小周期 k 线及之后新增的 k 线，之前已完成的大周期 k 线直接复用
+
+    转换结果增加 first_date 列，记录每根大周期 k 线包含的第一根小周期 k 线时间，下次转换时作为 period_klines 传入
+    转换时将 open/close 替换为 k 线的位置，合并后即可得到每根大周期 k 线包含的第一根与最后一根小周期 k 线，再取回实际的 open/close
+
+    :param convert_fun: 转换方法，例如 convert_stock_kline_frequency
+    :param klines: 小周期的 k 线数据（按时间排序），最后一根大周期 k 线之前的数据需要与上次转换时一致
+    :param to_f: 转换的周期
+    :param period_klines: 上一次本方法返回的转换结果，为空或者 klines 中找不到其最后一根 k 线的开始时间，则进行全量转换
+    :param kwargs: convert_fun 的其他参数
+    :return: 返回的结果与 convert_fun 全量转换一致（period_klines 之前的数据会保留）
+    """
+    start_idx = 0
+    incremental = False
+    if period_klines is not None and len(period_klines) > 0 and len(klines) > 0:
+        last_first_date = period_klines["first_date"].iloc[-1]
+        start_idx = int(klines["date"].searchsorted(last_first_date, side="left"))
+        incremental = (
+            start_idx < len(klines)
+            and klines["date"].iloc[start_idx] == last_first_date
+        )
+        if not incremental:
+            start_idx = 0
+
+    update_klines = klines.iloc[start_idx:]
+    positions = np.arange(len(update_klines), dtype=np.float64)
+    new_klines = convert_fun(
+        update_klines.assign(open=positions, close=positions), to_f, **kwargs
+    )
+    if new_klines is None:
+        return None
+    first_idx = new_klines["open"].to_numpy().astype(np.int64)
+    last_idx = new_klines["close"].to_numpy().astype(np.int64)
+    new_klines = new_klines.assign(
+        open=update_klines["open"].to_numpy()[first_idx],
+        close=update_klines["close"].to_numpy()[last_idx],
+        first_date=update_klines["date"].array[first_idx],
+    )
+    if not incremental:
+        return new_klines
+
+    return pd.concat([period_klines.iloc[:-1], new_klines], ignore_index=True)
+
+
+def resample_klines(
+    klines: pd.DataFrame, period_type: str, label: str, closed: str, how: str
+) -> pd.DataFrame:
+    """
+    使用 resample 一次性合并所有列，open/close/high/low/volume 按照 first/last/max/min/sum 合并，其他列（code、date等）按照 how 合并
+    :param klines: 以时间为索引的 k 线数据
+    :param period_type: resample 的周期
+    :param label:
+    :param closed:
+    :param how: 其他列的合并方式 first or last
+    :return:
+    """
+    agg = {_c: how for _c in klines.columns}
+    agg.update(
+        {"open": "first", "close": "last", "high": "max", "low": "min", "volume": "sum"}
+    )
+    return klines.resample(period_type, label=label, closed=closed).agg(agg)
+
+
 def convert_stock_kline_frequency(klines: pd.DataFrame, to_f: str) -> pd.DataFrame:
     """
     转换股票 k 线到指定的周期
@@ -174,29 +488,12 @@ def convert_stock_kline_frequency(klines: pd.DataFrame, to_f: str) -> pd.DataFra
         period_type = period_maps[to_f]
 
         # 通达信的时间对其方式，日线及以下是后对其，周与月是前对其（周、月的第一个交易日）
-        if to_f in ["w", "m"]:
-            period_klines = klines.resample(
-                period_type, label="left", closed="right"
-            ).first()
-        else:
-            period_klines = klines.resample(
-                period_type, label="left", closed="right"
-            ).last()
-
-        period_klines["open"] = (
-            klines["open"].resample(period_type, label="left", closed="right").first()
-        )
-        period_klines["close"] = (
-            klines["close"].resample(period_type, label="left", closed="right").last()
-        )
-        period_klines["high"] = (
-            klines["high"].resample(period_type, label="left", closed="right").max()
-        )
-        period_klines["low"] = (
-            klines["low"].resample(period_type, label="left", closed="right").min()
-        )
-        period_klines["volume"] = (
-            klines["volume"].resample(period_type, label="left", closed="right").sum()
+        period_klines = resample_klines(
+            klines,
+            period_type,
+            label="left",
+            closed="right",
+            how="first" if to_f in ["w", "m"] else "last",
         )
         period_klines.dropna(inplace=True)
         period_klines.reset_index(inplace=True)
@@ -209,72 +506,20 @@ def convert_stock_kline_frequency(klines: pd.DataFrame, to_f: str) -> pd.DataFra
             )
 
         if to_f in ["5m", "10m", "15m", "30m"]:
-
-            def lts_time(d: datetime.datetime):
-                dt_int = datetime_to_int(d)
-                seconds = int(to_f.replace("m", "")) * 60
-                if dt_int % seconds == 0:
-                    return d
-                return timeint_to_datetime(dt_int - (dt_int % seconds) + seconds)
-
-            period_klines["date"] = period_klines["date"].map(lts_time)
-            period_klines["date"] = pd.to_datetime(period_klines["date"])
+            # 时间向后对齐到周期的整数倍
+            seconds = int(to_f.replace("m", "")) * 60
+            period_klines["date"] = pd.to_datetime(period_klines["date"]).dt.ceil(
+                f"{seconds}s"
+            )
         return period_klines[["code", "date", "open", "close", "high", "low", "volume"]]
 
     # 60m 周期特殊，9:30-10:30/10:30-11:30
-    freq_config_maps = {
-        "60m": {
-            "10:30:00": ["09:00:00", "10:30:00"],
-            "11:30:00": ["10:30:01", "11:30:00"],
-            "14:00:00": ["13:00:00", "14:00:00"],
-            "15:00:00": ["14:00:01", "15:00:00"],
-        },
-        "120m": {
-            "11:30:00": ["09:00:00", "11:30:00"],
-            "15:00:00": ["13:00:00", "15:00:00"],
-        },
-    }
-    if to_f not in freq_config_maps.keys():
+    if to_f not in STOCK_SESSION_MAPS.keys():
         raise Exception(f"不支持的转换周期：{to_f}")
 
-    def dt_to_new_dt(config: dict, dt: datetime.datetime):
-        """
-        将时间转换成合并后的时间值
-        """
-        date_str = datetime_to_str(dt, "%Y-%m-%d")
-        for new_time, range_time in config.items():
-            range_start = str_to_timeint(f"{date_str} {range_time[0]}")
-            range_end = str_to_timeint(f"{date_str} {range_time[1]}")
-            if range_start <= datetime_to_int(dt) <= range_end:
-                return str_to_datetime(f"{date_str} {new_time}")
-        return None
-
-    new_kline = {}
-    for _, k in klines.iterrows():
-        dt: datetime.datetime = k["date"].to_pydatetime()
-        new_dt = dt_to_new_dt(freq_config_maps[to_f], dt)
-        if new_dt is None:
-            raise Exception(f"转换时间错误：{to_f}, {dt}")
-        if new_dt in new_kline.keys():
-            n_k = new_kline[new_dt]
-            n_k["high"] = max(n_k["high"], k["high"])
-            n_k["low"] = min(n_k["low"], k["low"])
-            n_k["close"] = k["close"]
-            n_k["volume"] += float(k["volume"]) if k["volume"] is not None else 0
-            new_kline[new_dt] = n_k
-        else:
-            new_kline[new_dt] = {
-                "code": k["code"],
-                "date": new_dt,
-                "open": k["open"],
-                "close": k["close"],
-                "high": k["high"],
-                "low": k["low"],
-                "volume": float(k["volume"]) if k["volume"] is not None else 0,
-            }
-    kline_pd = pd.DataFrame(new_kline.values())
-    kline_pd["date"] = pd.to_datetime(kline_pd["date"])
-    return kline_pd[["code", "date", "open", "close", "high", "low", "volume"]]
+    return convert_session_kline_frequency(
+        klines, to_f, get_session_table("stock", to_f, STOCK_SESSION_MAPS[to_f])
+    )
 
 
 def convert_currency_kline_frequency(klines: pd.DataFrame, to_f: str) -> pd.DataFrame:
@@ -309,21 +554,8 @@ def convert_currency_kline_frequency(klines: pd.DataFrame, to_f: str) -> pd.Data
     klines.set_index("date_index", inplace=True)
     period_type = period_maps[to_f]
 
-    period_klines = klines.resample(period_type, label="right", closed="left").first()
-    period_klines["open"] = (
-        klines["open"].resample(period_type, label="right", closed="left").first()
-    )
-    period_klines["close"] = (
-        klines["close"].resample(period_type, label="right", closed="left").last()
-    )
-    period_klines["high"] = (
-        klines["high"].resample(period_type, label="right", closed="left").max()
-    )
-    period_klines["low"] = (
-        klines["low"].resample(period_type, label="right", closed="left").min()
-    )
-    period_klines["volume"] = (
-        klines["volume"].resample(period_type, label="right", closed="left").sum()
+    period_klines = resample_klines(
+        klines, period_type, label="right", closed="left", how="first"
     )
     period_klines.dropna(inplace=True)
     period_klines.reset_index(inplace=True)
@@ -370,160 +602,29 @@ def convert_futures_kline_frequency(
         klines.set_index("date_index", inplace=True)
         period_type = period_maps[to_f]
         # 前对其
-        period_klines = klines.resample(
-            period_type, label="right", closed="left"
-        ).first()
-        period_klines["open"] = (
-            klines["open"].resample(period_type, label="right", closed="left").first()
-        )
-        period_klines["close"] = (
-            klines["close"].resample(period_type, label="right", closed="left").last()
-        )
-        period_klines["high"] = (
-            klines["high"].resample(period_type, label="right", closed="left").max()
-        )
-        period_klines["low"] = (
-            klines["low"].resample(period_type, label="right", closed="left").min()
-        )
-        period_klines["volume"] = (
-            klines["volume"].resample(period_type, label="right", closed="left").sum()
+        period_klines = resample_klines(
+            klines, period_type, label="right", closed="left", how="first"
         )
         period_klines.dropna(inplace=True)
         period_klines.reset_index(inplace=True)
         period_klines.drop("date_index", axis=1, inplace=True)
         if to_f in ["1m", "3m", "5m", "6m", "10m", "15m"]:
-
-            def bts_time(d: datetime.datetime):
-                dt_int = datetime_to_int(d)
-                seconds = int(to_f.replace("m", "")) * 60
-                if dt_int % seconds == 0:
-                    return d
-                return timeint_to_datetime(dt_int - (dt_int % seconds))
-
-            period_klines["date"] = period_klines["date"].map(bts_time)
+            # 时间向前对齐到周期的整数倍
+            seconds = int(to_f.replace("m", "")) * 60
+            period_klines["date"] = pd.to_datetime(period_klines["date"]).dt.floor(
+                f"{seconds}s"
+            )
         return period_klines[["code", "date", "open", "close", "high", "low", "volume"]]
 
     # 因为 10:15 10:30 休息 15分钟， 这一部分 掘金和天勤上的处理逻辑是不一样的，在合成 30m，60m 数据时时有差异的
-    if process_exchange_type == "gm":
-        freq_config_maps = {
-            # 掘金的处理逻辑，凑够符合分钟数的数据 (有夜盘交易的还是有差异，暂时不考虑)
-            "30m": {
-                "09:00:00": ["09:00:00", "09:29:59"],
-                "09:30:00": ["09:30:00", "09:59:59"],
-                "10:00:00": ["10:00:00", "10:44:59"],
-                "10:45:00": ["10:45:00", "11:14:59"],
-                "11:15:00": ["11:15:00", "13:44:59"],
-                "13:45:00": ["13:45:00", "14:14:59"],
-                "14:15:00": ["14:15:00", "14:44:59"],
-                "14:45:00": ["14:45:00", "14:59:59"],
-                "21:00:00": ["21:00:00", "21:29:59"],
-                "21:30:00": ["21:30:00", "21:59:59"],
-                "22:00:00": ["21:00:00", "22:29:59"],
-                "22:30:00": ["21:30:00", "22:59:59"],
-                "23:00:00": ["23:00:00", "23:29:59"],
-                "23:30:00": ["23:30:00", "23:59:59"],
-                "00:00:00": ["00:00:00", "00:29:59"],
-                "00:30:00": ["00:30:00", "00:59:59"],
-                "01:00:00": ["01:00:00", "01:29:59"],
-                "01:30:00": ["01:30:00", "01:59:59"],
-                "02:00:00": ["02:00:00", "02:29:59"],
-                "02:30:00": ["02:30:00", "02:59:59"],
-            },
-            "60m": {
-                "09:00:00": ["09:00:00", "09:59:59"],
-                "10:00:00": ["10:00:00", "11:14:59"],
-                "11:15:00": ["11:15:00", "14:14:59"],
-                "14:15:00": ["14:15:00", "14:59:59"],
-                "21:00:00": ["21:00:00", "21:59:59"],
-                "22:00:00": ["21:00:00", "22:59:59"],
-                "23:00:00": ["23:00:00", "23:59:59"],
-                "00:00:00": ["00:00:00", "00:59:59"],
-                "01:00:00": ["01:00:00", "01:59:59"],
-                "02:00:00": ["02:00:00", "02:59:59"],
-            },
-        }
-    else:
-        freq_config_maps = {
-            # 天勤的处理逻辑，直接按照整数处理，前对其
-            "30m": {
-                "09:00:00": ["09:00:00", "09:29:59"],
-                "09:30:00": ["09:30:00", "09:59:59"],
-                "10:00:00": ["10:00:00", "10:29:59"],
-                "10:30:00": ["10:30:00", "10:59:59"],
-                "11:00:00": ["11:00:00", "11:29:59"],
-                "11:30:00": ["11:30:00", "11:59:59"],
-                "13:00:00": ["13:00:00", "13:29:59"],
-                "13:30:00": ["13:30:00", "13:59:59"],
-                "14:00:00": ["14:00:00", "14:29:59"],
-                "14:30:00": ["14:30:00", "14:59:59"],
-                "21:00:00": ["21:00:00", "21:29:59"],
-                "21:30:00": ["21:30:00", "21:59:59"],
-                "22:00:00": ["21:00:00", "22:29:59"],
-                "22:30:00": ["21:30:00", "22:59:59"],
-                "23:00:00": ["23:00:00", "23:29:59"],
-                "23:30:00": ["23:30:00", "23:59:59"],
-                "00:00:00": ["00:00:00", "00:29:59"],
-                "00:30:00": ["00:30:00", "00:59:59"],
-                "01:00:00": ["01:00:00", "01:29:59"],
-                "01:30:00": ["01:30:00", "01:59:59"],
-                "02:00:00": ["02:00:00", "02:29:59"],
-                "02:30:00": ["02:30:00", "02:59:59"],
-            },
-            "60m": {
-                "09:00:00": ["09:00:00", "09:59:59"],
-                "10:00:00": ["10:00:00", "10:59:59"],
-                "11:00:00": ["11:00:00", "11:59:59"],
-                "13:00:00": ["13:00:00", "13:59:59"],
-                "21:00:00": ["21:00:00", "21:59:59"],
-                "22:00:00": ["21:00:00", "22:59:59"],
-                "23:00:00": ["23:00:00", "23:59:59"],
-                "00:00:00": ["00:00:00", "00:59:59"],
-                "01:00:00": ["01:00:00", "01:59:59"],
-                "02:00:00": ["02:00:00", "02:59:59"],
-            },
-        }
-
-    if to_f not in freq_config_maps.keys():
+    session_maps = FUTURES_SESSION_MAPS["gm" if process_exchange_type == "gm" else "tq"]
+    if to_f not in session_maps.keys():
         raise Exception(f"不支持的转换周期：{to_f}")
 
-    def dt_to_new_dt(config: dict, dt: datetime.datetime):
-        """
-        将时间转换成合并后的时间值
-        """
-        date_str = datetime_to_str(dt, "%Y-%m-%d")
-        for new_time, range_time in config.items():
-            range_start = str_to_timeint(f"{date_str} {range_time[0]}")
-            range_end = str_to_timeint(f"{date_str} {range_time[1]}")
-            if range_start <= datetime_to_int(dt) <= range_end:
-                return str_to_datetime(f"{date_str} {new_time}")
-        return None
-
-    new_kline = {}
-    for _, k in klines.iterrows():
-        dt: datetime.datetime = k["date"].to_pydatetime()
-        new_dt = dt_to_new_dt(freq_config_maps[to_f], dt)
-        if new_dt is None:
-            raise Exception(f"转换时间错误：{to_f}, {dt}")
-        if new_dt in new_kline.keys():
-            n_k = new_kline[new_dt]
-            n_k["high"] = max(n_k["high"], k["high"])
-            n_k["low"] = min(n_k["low"], k["low"])
-            n_k["close"] = k["close"]
-            n_k["volume"] += float(k["volume"]) if k["volume"] is not None else 0
-            new_kline[new_dt] = n_k
-        else:
-            new_kline[new_dt] = {
-                "code": k["code"],
-                "date": new_dt,
-                "open": k["open"],
-                "close": k["close"],
-                "high": k["high"],
-                "low": k["low"],
-                "volume": float(k["volume"]) if k["volume"] is not None else 0,
-            }
-    kline_pd = pd.DataFrame(new_kline.values())
-    kline_pd["date"] = pd.to_datetime(kline_pd["date"]).dt.tz_convert(__tz)
-    return kline_pd[["code", "date", "open", "close", "high", "low", "volume"]]
+    session_key = "futures_gm" if process_exchange_type == "gm" else "futures_tq"
+    return convert_session_kline_frequency(
+        klines, to_f, get_session_table(session_key, to_f, session_maps[to_f])
+    )
 
 
 def convert_us_kline_frequency(klines: pd.DataFrame, to_f: str) -> pd.DataFrame:
@@ -549,28 +650,13 @@ def convert_us_kline_frequency(klines: pd.DataFrame, to_f: str) -> pd.DataFrame:
     klines.set_index("date_index", inplace=True)
     period_type = period_maps[to_f]
 
-    if to_f in ["w"]:  # 周线是末尾的时间
-        period_klines = klines.resample(
-            period_type, label="right", closed="left"
-        ).last()
-    else:
-        period_klines = klines.resample(
-            period_type, label="right", closed="left"
-        ).first()
-    period_klines["open"] = (
-        klines["open"].resample(period_type, label="right", closed="left").first()
-    )
-    period_klines["close"] = (
-        klines["close"].resample(period_type, label="right", closed="left").last()
-    )
-    period_klines["high"] = (
-        klines["high"].resample(period_type, label="right", closed="left").max()
-    )
-    period_klines["low"] = (
-        klines["low"].resample(period_type, label="right", closed="left").min()
-    )
-    period_klines["volume"] = (
-        klines["volume"].resample(period_type, label="right", closed="left").sum()
+    # 周线是末尾的时间
+    period_klines = resample_klines(
+        klines,
+        period_type,
+        label="right",
+        closed="left",
+        how="last" if to_f in ["w"] else "first",
     )
     period_klines.dropna(inplace=True)
     period_klines.reset_index(inplace=True)
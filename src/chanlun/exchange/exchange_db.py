@@ -13,6 +13,7 @@ from chanlun.exchange.exchange import (
     convert_stock_kline_frequency,
     convert_us_kline_frequency,
     convert_currency_kline_frequency,
+    convert_kline_frequency_incremental,
     Tick,
 )
 
@@ -187,74 +188,75 @@ class ExchangeDB(Exchange):
             start_date = fun.str_to_datetime(start_date)
         if end_date is not None:
             end_date = fun.str_to_datetime(end_date)
-        klines = db.klines_query(
+        kline_pd = db.klines_query_columns(
             self.market, code, frequency, start_date, end_date, limit, order
         )
-        kline_pd = []
-        for _k in klines:
-            kline_pd.append(
-                {
-                    "code": _k.code,
-                    "date": _k.dt,
-                    "open": _k.o,
-                    "high": _k.h,
-                    "low": _k.l,
-                    "close": _k.c,
-                    "volume": _k.v,
-                }
-            )
         if len(kline_pd) == 0:
             kline_pd = pd.DataFrame(
                 [], columns=["date", "code", "high", "low", "open", "close", "volume"]
             )
             return kline_pd
 
-        kline_pd = pd.DataFrame(kline_pd)
-        kline_pd["code"] = code
-        kline_pd["date"] = pd.to_datetime(kline_pd["date"]).dt.tz_localize(
-            self.tz
-        )  # .map(lambda d: d.to_pydatetime())
-        kline_pd["date"] = kline_pd["date"].apply(self.__convert_date)
+        kline_pd.insert(0, "code", code)
+        kline_pd["date"] = self.__convert_dates(pd.to_datetime(kline_pd["date"]))
         kline_pd.sort_values(by="date", inplace=True)
         kline_pd = kline_pd.reset_index(drop=True)
 
         return kline_pd
 
-    def __convert_date(self, dt: datetime.datetime):
+    def __convert_dates(self, dates: pd.Series) -> pd.Series:
         """
-        统一各个市场的时间格式
+        统一各个市场的时间格式（按列处理，dates 为数据库中没有时区的时间）
         TODO 需要根据自己数据源的数据格式进行调整
         TODO 将日及以上周期（大多数这类的时间都是 0点0分），修改为交易日结束或开始时间（根据日期是前对其还是后对其来决定是开盘时间还是收盘时间）
         """
-        if self.market == Market.A.value:
-            if dt.hour == 0 and dt.minute == 0:
-                return dt.replace(hour=15, minute=0)
-        if self.market == Market.HK.value:
-            if dt.hour == 0 and dt.minute == 0:
-                return dt.replace(hour=16, minute=0)
-        if self.market == Market.FUTURES.value:
-            if dt.hour == 0 and dt.minute == 0:
-                return dt.replace(hour=9, minute=0)
-        if self.market == Market.US.value:
-            if dt.hour == 0 and dt.minute == 0:
-                return dt.replace(hour=9, minute=30)
-        return dt
+        # 0点0分的K线，需要替换成的交易时间
+        market_day_times = {
+            Market.A.value: pd.Timedelta(hours=15),
+            Market.HK.value: pd.Timedelta(hours=16),
+            Market.FUTURES.value: pd.Timedelta(hours=9),
+            Market.US.value: pd.Timedelta(hours=9, minutes=30),
+        }
+        if self.market in market_day_times.keys():
+            is_day = (dates.dt.hour == 0) & (dates.dt.minute == 0)
+            dates = dates.mask(is_day, dates + market_day_times[self.market])
+        return dates.dt.tz_localize(self.tz)
 
     def convert_kline_frequency(self, klines: pd.DataFrame, to_f: str) -> pd.DataFrame:
         """
         转换K线周期
         """
+        return self.kline_frequency_converter()(klines, to_f)
+
+    def convert_kline_frequency_incremental(
+        self, klines: pd.DataFrame, to_f: str, period_klines: pd.DataFrame = None
+    ) -> pd.DataFrame:
+        """
+        增量转换K线周期，只重新合并最后未完成的大周期k线
+        :param klines: 小周期k线
+        :param to_f: 转换的周期
+        :param period_klines: 上一次本方法返回的结果
+        :return: 比 convert_kline_frequency 的结果增加 first_date 列
+        """
+        return convert_kline_frequency_incremental(
+            self.kline_frequency_converter(), klines, to_f, period_klines
+        )
+
+    def kline_frequency_converter(self):
+        """
+        当前市场使用的K线周期转换方法
+        """
         if (
             self.market == Market.CURRENCY.value
             or self.market == Market.CURRENCY_SPOT.value
         ):
-            return convert_currency_kline_frequency(klines, to_f)
+            return convert_currency_kline_frequency
         elif self.market == Market.FUTURES.value:
-            return convert_futures_kline_frequency(klines, to_f)
+            return convert_futures_kline_frequency
         elif self.market == Market.US.value:
-            return convert_us_kline_frequency(klines, to_f)
+            return convert_us_kline_frequency
         else:
-            return convert_stock_kline_frequency(klines, to_f)
+            return convert_stock_kline_frequency
 
     def all_stocks(self):
         return []
@@ -1,22 +1,21 @@
-import copy
 import pathlib
 import time
 import traceback
 from typing import Union
-import warnings
 
 from pytdx.errors import TdxConnectionError
-from pytdx.hq import TdxHq_API
 from pytdx.util import best_ip
 from tenacity import retry, stop_after_attempt, wait_random, retry_if_result
 
 from chanlun import fun
 from chanlun.exchange.exchange import *
+from chanlun.exchange.adj_factor import AdjFactorStore, xdxr_events, xdxr_fq
 from chanlun.exchange.stocks_bkgn import StocksBKGN
+from chanlun.exchange.symbol_registry import SymbolRegistry
 from chanlun.exchange.tdx_bkgn import TdxBKGN
+from chanlun.exchange.tdx_pool import TdxHqPool, select_best_ips
 from chanlun.file_db import FileCacheDB
 from chanlun.db import db
-from chanlun.config import get_data_path
 
 
 @fun.singleton
@@ -30,12 +29,16 @@ class ExchangeTDX(Exchange):
     def __init__(self):
         # super().__init__()
 
-        # 选择最优的服务器，并保存到 cache 中
-        self.connect_info = db.cache_get("tdx_connect_ip")
-        # connect_info = None # 手动重新选择最优服务器
-        if self.connect_info is None:
-            self.connect_info = self.reset_tdx_ip()
-            # print(f"最优服务器：{self.connect_info}")
+        # 选择最优的几个服务器，并保存到 cache 中
+        self.connect_infos = db.cache_get("tdx_connect_ips")
+        # connect_infos = None # 手动重新选择最优服务器
+        if not self.connect_infos:
+            self.connect_infos = self.reset_tdx_ip()
+            # print(f"最优服务器：{self.connect_infos}")
+        self.connect_info = self.connect_infos[0]
+
+        # 服务器连接池，请求分布在多个服务器上，连接复用
+        self.pool = TdxHqPool(self.connect_infos, servers_fun=self.reset_tdx_ip)
 
         # 板块概念信息
         self.stock_bkgn = StocksBKGN()
@@ -44,18 +47,27 @@ class ExchangeTDX(Exchange):
         # 文件缓存
         self.fdb = FileCacheDB()
 
+        # 复权数据（除权除息事件）
+        self.adj_factors = AdjFactorStore("tdx_a")
+
         # 设置时区
         self.tz = pytz.timezone("Asia/Shanghai")
 
     def reset_tdx_ip(self):
         """
-        重新选择tdx最优ip，并返回
+        重新选择tdx最优的几个ip，并返回
+        都连接不上（比如网络暂时不可用），则使用 pytdx 默认的服务器列表，不保存到 cache 中，下次重新选择
         """
-        connect_info = best_ip.select_best_ip("stock")
-        connect_info = {"ip": connect_info["ip"], "port": int(connect_info["port"])}
-        db.cache_set("tdx_connect_ip", connect_info)
-        self.connect_info = connect_info
-        return connect_info
+        connect_infos = select_best_ips(3)
+        if len(connect_infos) == 0:
+            connect_infos = [
+                {"ip": _s["ip"], "port": int(_s["port"])} for _s in best_ip.stock_ip[:3]
+            ]
+        else:
+            db.cache_set("tdx_connect_ips", connect_infos)
+        self.connect_infos = connect_infos
+        self.connect_info = connect_infos[0]
+        return connect_infos
 
     def default_code(self):
         return "SH.000001"
@@ -83,12 +95,17 @@ class ExchangeTDX(Exchange):
         if len(self.g_all_stocks) > 0:
             return self.g_all_stocks
 
+        # 文件缓存中有效期内的股票列表
+        cache_stocks = SymbolRegistry.load_cache(self.fdb, "tdx_a")
+        if cache_stocks is not None:
+            self.g_all_stocks = cache_stocks
+            return self.g_all_stocks
+
         __all_stocks = []
-        __codes = []
+        __codes = set()
         try:
             for market in range(2):
-                client = TdxHq_API(raise_exception=True, auto_retry=True)
-                with client.connect(self.connect_info["ip"], self.connect_info["port"]):
+                with self.pool.client() as client:
                     count = client.get_security_count(market)
                     data = pd.concat(
                         [
@@ -108,14 +125,16 @@ class ExchangeTDX(Exchange):
                         code = f"{sse}.{str(code)}"
                         if code in __codes:
                             continue
-                        __codes.append(code)
+                        __codes.add(code)
                         __all_stocks.append({"code": code, "name": name, "type": _type})
         except TdxConnectionError:
-            print("连接失败，重新选择最优服务器")
-            self.reset_tdx_ip()
+            # 连接池会将异常的服务器标记为不可用，重试时使用其他服务器
+            print("连接失败，切换服务器重试")
             return self.all_stocks()
 
         self.g_all_stocks = __all_stocks
+        if len(__all_stocks) > 0:
+            SymbolRegistry.save_cache(self.fdb, "tdx_a", __all_stocks)
         # print(f"股票共获取数量：{len(self.g_all_stocks)}")
         return self.g_all_stocks
 
@@ -135,9 +154,8 @@ class ExchangeTDX(Exchange):
             market = 0
         else:
             market = None
-        all_stocks = self.all_stocks()
-        stock = [_s for _s in all_stocks if _s["code"] == code]
-        _type = stock[0]["type"] if stock else None
+        stock = self.symbols().get(code)
+        _type = stock["type"] if stock else None
         return market, code[-6:], _type
 
     @retry(
@@ -190,8 +208,7 @@ class ExchangeTDX(Exchange):
             return None
 
         try:
-            client = TdxHq_API(raise_exception=True, auto_retry=True)
-            with client.connect(self.connect_info["ip"], self.connect_info["port"]):
+            with self.pool.client() as client:
                 if "index" in _type:
                     get_bars = client.get_index_bars
                 else:
@@ -282,8 +299,7 @@ class ExchangeTDX(Exchange):
             ks = ks[["code", "date", "open", "close", "high", "low", "volume"]]
             return ks
         except TdxConnectionError:
-            print("连接失败，重新选择最优服务器")
-            self.reset_tdx_ip()
+            print("连接失败，切换服务器重试")
         except Exception as e:
             print(f"获取行情异常 {code} Exception ：{str(e)}")
             print(traceback.format_exc())
@@ -312,11 +328,7 @@ class ExchangeTDX(Exchange):
         """
         获取股票名称
         """
-        all_stock = self.all_stocks()
-        stock = [_s for _s in all_stock if _s["code"] == code]
-        if not stock:
-            return None
-        return {"code": stock[0]["code"], "name": stock[0]["name"]}
+        return self.symbols().stock_info(code)
 
     def ticks(self, codes: List[str]) -> Dict[str, Tick]:
         """
@@ -328,12 +340,14 @@ class ExchangeTDX(Exchange):
         if len(codes) == 0:
             return ticks
         query_stocks = []
+        # tdx 代码 : 代码，行情返回的代码直接查找
+        tdx_codes = {}
         for _c in codes:
-            _m, _c, _t = self.to_tdx_code(_c)
+            _m, _tdx_c, _t = self.to_tdx_code(_c)
             if _m is not None:
-                query_stocks.append((_m, _c))
-        client = TdxHq_API(raise_exception=True, auto_retry=True)
-        with client.connect(self.connect_info["ip"], self.connect_info["port"]):
+                query_stocks.append((_m, _tdx_c))
+                tdx_codes.setdefault(_tdx_c, _c)
+        with self.pool.client() as client:
             # 获取总数据量
             total_quotes = len(query_stocks)
             # 分批次获取数据
@@ -356,10 +370,9 @@ class ExchangeTDX(Exchange):
                 if _q["code"] == "999999":
                     _code = "SH.000001"
                 else:
-                    _code = [_c for _c in codes if _c[-6:] == _q["code"]]
-                    if len(_code) == 0:
+                    _code = tdx_codes.get(_q["code"])
+                    if _code is None:
                         continue
-                    _code = _code[0]
                 ticks[_code] = Tick(
                     code=_code,
                     last=_q["price"],
@@ -539,24 +552,13 @@ class ExchangeTDX(Exchange):
     def order(self, code: str, o_type: str, amount: float, args=None):
         raise Exception("交易所不支持")
 
-    def xdxr(self, market: int, project_code: str, code: str):
+    def xdxr(self, market: int, project_code: str, code: str) -> pd.DataFrame:
         """
-        读取除权除息信息
+        读取除权除息事件（每天最多从接口检查一次，有新的事件才更新文件）
         """
-        xdxr_path = get_data_path() / "xdxr"
-        if xdxr_path.is_dir() is False:
-            xdxr_path.mkdir()
-        xdxr_file = xdxr_path / f"new_xdxr_{market}_{project_code}.pkl"
-        now_day = fun.datetime_to_str(datetime.datetime.now(), "%Y-%m-%d")
-        need_update = False  # 判断是否需要更新
-        if (
-            xdxr_file.is_file() is False
-            or fun.timeint_to_str(int(xdxr_file.stat().st_mtime), "%Y-%m-%d") != now_day
-        ):
-            need_update = True
-        if need_update:
-            client = TdxHq_API(raise_exception=True, auto_retry=True)
-            with client.connect(self.connect_info["ip"], self.connect_info["port"]):
+
+        def _fetch_xdxr():
+            with self.pool.client() as client:
                 data = client.to_df(client.get_xdxr_info(market, code))
             if len(data) > 0:
                 data.loc[:, "date"] = (
@@ -567,103 +569,15 @@ class ExchangeTDX(Exchange):
                     + data["day"].map(str)
                 )
                 data["date"] = pd.to_datetime(data["date"])
-            data.to_pickle(str(xdxr_file))
-        else:
-            # print('直接读取缓存')
-            data = pd.read_pickle(str(xdxr_file))
+            return xdxr_events(data, self.tz)
 
-        return data
+        return self.adj_factors.get(project_code, _fetch_xdxr)
 
     def klines_fq(self, fq_klines: pd.DataFrame, xdxr_data, fq_type: str):
         """
         对行情进行复权处理
         """
-        if len(xdxr_data) == 0:
-            return fq_klines
-        info = copy.deepcopy(xdxr_data.query("category==1"))
-        if len(info) == 0:
-            return fq_klines
-        info.loc[:, "idx_date"] = (
-            info["date"].dt.tz_localize(self.tz).dt.tz_convert("UTC")
-        )
-        info.set_index("idx_date", inplace=True)
-
-        fq_klines = fq_klines.assign(if_trade=1)
-        fq_klines.loc[:, "idx_date"] = fq_klines["date"].dt.tz_convert("UTC")
-        fq_klines.set_index("idx_date", inplace=True)
-
-        if len(info) > 0:
-            # 有除权数据
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore", category=FutureWarning)
-                data = pd.concat(
-                    [
-                        fq_klines,
-                        info.loc[
-                            fq_klines.index[0] : fq_klines.index[-1], ["category"]
-                        ],
-                    ],
-                    axis=1,
-                )
-                data["if_trade"].fillna(value=0, inplace=True)
-                data = data.fillna(method="ffill")
-                data = pd.concat(
-                    [
-                        data,
-                        info.loc[
-                            fq_klines.index[0] : fq_klines.index[-1],
-                            ["fenhong", "peigu", "peigujia", "songzhuangu"],
-                        ],
-                    ],
-                    axis=1,
-                )
-        else:
-            data = pd.concat(
-                [
-                    fq_klines,
-                    info.loc[
-                        :, ["category", "fenhong", "peigu", "peigujia", "songzhuangu"]
-                    ],
-                ],
-                axis=1,
-            )
-
-        # 数据补全
-        data = data.fillna(0)
-
-        # 计算前日收盘
-        data["preclose"] = (
-            data["close"].shift(1) * 10
-            - data["fenhong"]
-            + data["peigu"] * data["peigujia"]
-        ) / (10 + data["peigu"] + data["songzhuangu"])
-
-        # 前复权
-        if fq_type == "qfq":
-            data["adj"] = (
-                (data["preclose"].shift(-1) / data["close"]).fillna(1)[::-1].cumprod()
-            )
-            # ohlc 数据进行复权计算
-            for col in ["open", "high", "low", "close"]:
-                data[col] = round(data[col] * data["adj"], 2)
-
-        # 后复权
-        if fq_type == "hfq":
-            data["adj"] = (
-                (data["close"] / data["preclose"].shift(-1))
-                .cumprod()
-                .shift(1)
-                .fillna(1)
-            )
-            # ohlc 数据进行复权计算
-            for col in ["open", "high", "low", "close"]:
-                data[col] = round(data[col] / data["adj"], 2)
-
-        # data['volume'] = data['volume'] / data['adj'] if 'volume' in data.columns else data['vol'] / data['adj']
-
-        data = data.query("if_trade==1 and open != 0")
-
-        return data[["code", "date", "open", "close", "high", "low", "volume"]]
+        return xdxr_fq(fq_klines, xdxr_data, fq_type)
 
 
 if __name__ == "__main__":
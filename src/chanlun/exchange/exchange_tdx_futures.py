@@ -10,6 +10,8 @@ from tenacity import retry, stop_after_attempt, wait_random, retry_if_result
 from chanlun import fun
 from chanlun.db import db
 from chanlun.exchange.exchange import *
+from chanlun.exchange.symbol_registry import SymbolRegistry
+from chanlun.exchange.tdx_pool import TdxHqPool
 from chanlun.file_db import FileCacheDB
 
 
@@ -54,6 +56,15 @@ class ExchangeTDXFutures(Exchange):
             except TdxConnectionError:
                 self.reset_tdx_ip()
 
+        # 行情服务器的连接池，行情并发获取
+        self.pool = TdxHqPool(
+            [self.connect_info],
+            servers_fun=lambda: [self.reset_tdx_ip()],
+            api_class=TdxExHq_API,
+        )
+        # 行情的短时缓存，交易与 web 共用
+        self.ticks_cache = TicksCache(ttl=3)
+
     def reset_tdx_ip(self):
         """
         重新选择tdx最优服务器
@@ -88,6 +99,12 @@ class ExchangeTDXFutures(Exchange):
         if len(self.g_all_stocks) > 0:
             return self.g_all_stocks
 
+        # 文件缓存中有效期内的股票列表
+        cache_stocks = SymbolRegistry.load_cache(self.fdb, "tdx_futures")
+        if cache_stocks is not None:
+            self.g_all_stocks = cache_stocks
+            return self.g_all_stocks
+
         __all_stocks = []
         client = TdxExHq_API(raise_exception=True, auto_retry=True)
         with client.connect(self.connect_info["ip"], self.connect_info["port"]):
@@ -118,6 +135,8 @@ class ExchangeTDXFutures(Exchange):
                     break
 
         self.g_all_stocks = __all_stocks
+        if len(__all_stocks) > 0:
+            SymbolRegistry.save_cache(self.fdb, "tdx_futures", __all_stocks)
         # print(f"期货获取数量：{len(self.g_all_stocks)}")
 
         return self.g_all_stocks
@@ -267,55 +286,59 @@ class ExchangeTDXFutures(Exchange):
         """
         获取股票名称
         """
-        all_stock = self.all_stocks()
-        stock = [_s for _s in all_stock if _s["code"] == code]
-        if not stock:
-            return None
-        return {"code": stock[0]["code"], "name": stock[0]["name"]}
+        return self.symbols().stock_info(code)
 
     def ticks(self, codes: List[str]) -> Dict[str, Tick]:
         """
-        如果可以使用 富途 的接口，就用 富途的，否则就用 日线的 K线计算
-        使用 富途 的接口会很快，日线则很慢
-        获取日线的k线，并返回最后一根k线的数据
+        获取行情，有效期内的行情使用缓存（ticks_cache），其他的代码使用连接池并发获取
+        """
+        return self.ticks_cache.ticks(codes, self.query_ticks)
+
+    def query_ticks(self, codes: List[str]) -> Dict[str, Tick]:
+        """
+        使用连接池并发获取行情，代码分为多批，每批在一个连接中依次获取
         """
+        query_codes = []
+        for _code in codes:
+            _market, _tdx_code = self.to_tdx_code(_code)
+            if _market is None:
+                continue
+            query_codes.append((_code, _market, _tdx_code))
+        quotes = self.pool.map(
+            lambda _client, _q: _client.get_instrument_quote(_q[1], _q[2]), query_codes
+        )
+
         ticks = {}
-        client = TdxExHq_API(raise_exception=True, auto_retry=True)
-        with client.connect(self.connect_info["ip"], self.connect_info["port"]):
-            for _code in codes:
-                _market, _tdx_code = self.to_tdx_code(_code)
-                if _market is None:
-                    continue
-                _quote = client.get_instrument_quote(_market, _tdx_code)
-                # [OrderedDict([('market', 1), ('code', 'FG2305'), ('pre_close', 1546.0), ('open', 1548.0),
-                # ('high', 1558.0), ('low', 1536.0), ('price', 1543.0), ('kaicang', 341886), ('zongliang', 367292),
-                # ('xianliang', 1), ('neipan', 192905), ('waipan', 174387), ('chicang', 993096), ('bid1', 1543.0),
-                # ('bid2', 0.0), ('bid3', 0.0), ('bid4', 0.0), ('bid5', 0.0), ('bid_vol1', 903), ('bid_vol2', 0),
-                # ('bid_vol3', 0), ('bid_vol4', 0), ('bid_vol5', 0), ('ask1', 1544.0), ('ask2', 0.0), ('ask3', 0.0),
-                # ('ask4', 0.0), ('ask5', 0.0), ('ask_vol1', 512), ('ask_vol2', 0), ('ask_vol3', 0), ('ask_vol4', 0),
-                # ('ask_vol5', 0)])]
-                if len(_quote) > 0:
-                    _quote = _quote[0]
-                    ticks[_code] = Tick(
-                        code=_code,
-                        last=_quote["price"],
-                        buy1=_quote["bid1"],
-                        sell1=_quote["ask1"],
-                        low=_quote["low"],
-                        high=_quote["high"],
-                        volume=_quote["zongliang"],
-                        open=_quote["open"],
-                        rate=(
-                            round(
-                                (_quote["price"] - _quote["pre_close"])
-                                / _quote["price"]
-                                * 100,
-                                2,
-                            )
-                            if _quote["price"] > 0
-                            else 0
-                        ),
-                    )
+        for (_code, _market, _tdx_code), _quote in zip(query_codes, quotes):
+            # [OrderedDict([('market', 1), ('code', 'FG2305'), ('pre_close', 1546.0), ('open', 1548.0),
+            # ('high', 1558.0), ('low', 1536.0), ('price', 1543.0), ('kaicang', 341886), ('zongliang', 367292),
+            # ('xianliang', 1), ('neipan', 192905), ('waipan', 174387), ('chicang', 993096), ('bid1', 1543.0),
+            # ('bid2', 0.0), ('bid3', 0.0), ('bid4', 0.0), ('bid5', 0.0), ('bid_vol1', 903), ('bid_vol2', 0),
+            # ('bid_vol3', 0), ('bid_vol4', 0), ('bid_vol5', 0), ('ask1', 1544.0), ('ask2', 0.0), ('ask3', 0.0),
+            # ('ask4', 0.0), ('ask5', 0.0), ('ask_vol1', 512), ('ask_vol2', 0), ('ask_vol3', 0), ('ask_vol4', 0),
+            # ('ask_vol5', 0)])]
+            if len(_quote) > 0:
+                _quote = _quote[0]
+                ticks[_code] = Tick(
+                    code=_code,
+                    last=_quote["price"],
+                    buy1=_quote["bid1"],
+                    sell1=_quote["ask1"],
+                    low=_quote["low"],
+                    high=_quote["high"],
+                    volume=_quote["zongliang"],
+                    open=_quote["open"],
+                    rate=(
+                        round(
+                            (_quote["price"] - _quote["pre_close"])
+                            / _quote["price"]
+                            * 100,
+                            2,
+                        )
+                        if _quote["price"] > 0
+                        else 0
+                    ),
+                )
         return ticks
 
     def now_trading(self):
@@ -11,8 +11,9 @@ from chanlun import fun
 
 from chanlun.db import db
 from chanlun.exchange.exchange import *
+from chanlun.exchange.adj_factor import AdjFactorStore, factor_qfq, qfq_factors
+from chanlun.exchange.symbol_registry import SymbolRegistry
 from chanlun.file_db import FileCacheDB
-from chanlun.config import get_data_path
 
 
 @fun.singleton
@@ -38,6 +39,9 @@ class ExchangeTDXHK(Exchange):
         # 文件缓存
         self.fdb = FileCacheDB()
 
+        # 复权数据（复权因子）
+        self.adj_factors = AdjFactorStore("tdx_hk")
+
         # 初始化，映射交易所代码
         self.market_maps = {}
         while True:
@@ -90,6 +94,12 @@ class ExchangeTDXHK(Exchange):
         if len(self.g_all_stocks) > 0:
             return self.g_all_stocks
 
+        # 文件缓存中有效期内的股票列表
+        cache_stocks = SymbolRegistry.load_cache(self.fdb, "tdx_hk")
+        if cache_stocks is not None:
+            self.g_all_stocks = cache_stocks
+            return self.g_all_stocks
+
         __all_stocks = []
         client = TdxExHq_API(raise_exception=True, auto_retry=True)
         with client.connect(self.connect_info["ip"], self.connect_info["port"]):
@@ -114,6 +124,8 @@ class ExchangeTDXHK(Exchange):
                     break
 
         self.g_all_stocks = __all_stocks
+        if len(__all_stocks) > 0:
+            SymbolRegistry.save_cache(self.fdb, "tdx_hk", __all_stocks)
         # print(f"香港获取数量：{len(self.g_all_stocks)}")
 
         return self.g_all_stocks
@@ -243,11 +255,7 @@ class ExchangeTDXHK(Exchange):
         """
         获取股票名称
         """
-        all_stock = self.all_stocks()
-        stock = [_s for _s in all_stock if _s["code"] == code]
-        if not stock:
-            return None
-        return {"code": stock[0]["code"], "name": stock[0]["name"]}
+        return self.symbols().stock_info(code)
 
     def ticks(self, codes: List[str]) -> Dict[str, Tick]:
         """
@@ -307,47 +315,20 @@ class ExchangeTDXHK(Exchange):
         return False
 
     def klines_qfq(self, code: str, klines: pd.DataFrame):
+        """
+        使用复权因子进行前复权（复权因子每天最多从接口检查一次，有变化才更新文件）
+        """
         try:
-            xdxr_path = get_data_path() / "xdxr"
-            if xdxr_path.is_dir() is False:
-                xdxr_path.mkdir()
-            xdxr_file = xdxr_path / f"hk_qfq_factor_{code.replace('.', '_')}.csv"
-            now_day = fun.datetime_to_str(datetime.datetime.now(), "%Y-%m-%d")
-            if (
-                xdxr_file.is_file() is False
-                or fun.timeint_to_str(int(xdxr_file.stat().st_mtime), "%Y-%m-%d")
-                != now_day
-            ):
-                qfq_factor_df = ak.stock_hk_daily(
-                    symbol=code.split(".")[1], adjust="qfq-factor"
-                )
-                if qfq_factor_df is not None and len(qfq_factor_df) > 0:
-                    qfq_factor_df.to_csv(xdxr_file, index=False)
-            else:
-                qfq_factor_df = pd.read_csv(xdxr_file)
-
-            if qfq_factor_df is None or len(qfq_factor_df) == 0:
-                return klines
-
-            qfq_factor_df["qfq_date"] = pd.to_datetime(
-                qfq_factor_df["date"]
-            ).dt.tz_localize(self.tz)
-            qfq_factor_df["qfq_factor"] = qfq_factor_df["qfq_factor"].astype(float)
-            qfq_factor_df = qfq_factor_df.drop(columns=["date"])
-
-            # 合并k线与复权因子，进行复权计算
-            df = pd.concat([klines, qfq_factor_df], axis=0)
-            df["qfq_date"].fillna(df["date"], inplace=True)
-            df.sort_values(by="qfq_date", inplace=True)
-            df["qfq_factor"].fillna(method="ffill", inplace=True)
-            df.dropna(inplace=True)
-            df.reset_index(drop=True, inplace=True)
-
-            df["open"] = df["open"] * df["qfq_factor"]
-            df["high"] = df["high"] * df["qfq_factor"]
-            df["low"] = df["low"] * df["qfq_factor"]
-            df["close"] = df["close"] * df["qfq_factor"]
-            return df[["code", "date", "open", "high", "low", "close", "volume"]]
+            factors = self.adj_factors.get(
+                code,
+                lambda: qfq_factors(
+                    ak.stock_hk_daily(
+                        symbol=code.split(".")[1], adjust="qfq-factor"
+                    ),
+                    self.tz,
+                ),
+            )
+            return factor_qfq(klines, factors)
         except Exception as e:
             print(f"计算 {code} 复权异常： {e}")
             return klines
@@ -10,8 +10,10 @@ from chanlun import fun
 
 from chanlun.db import db
 from chanlun.exchange.exchange import *
+from chanlun.exchange.adj_factor import AdjFactorStore, factor_qfq, qfq_factors
+from chanlun.exchange.symbol_registry import SymbolRegistry
+from chanlun.exchange.tdx_pool import TdxHqPool
 from chanlun.file_db import FileCacheDB
-from chanlun.config import get_data_path
 
 
 @fun.singleton
@@ -37,6 +39,18 @@ class ExchangeTDXUS(Exchange):
         # 文件缓存
         self.fdb = FileCacheDB()
 
+        # 复权数据（复权因子）
+        self.adj_factors = AdjFactorStore("tdx_us")
+
+        # 行情服务器的连接池，行情并发获取
+        self.pool = TdxHqPool(
+            [self.connect_info],
+            servers_fun=lambda: [self.reset_tdx_ip()],
+            api_class=TdxExHq_API,
+        )
+        # 行情的短时缓存，交易与 web 共用
+        self.ticks_cache = TicksCache(ttl=3)
+
     def reset_tdx_ip(self):
         """
         重新选择tdx最优服务器
@@ -72,6 +86,12 @@ class ExchangeTDXUS(Exchange):
         """
         if len(self.g_all_stocks) > 0:
             return self.g_all_stocks
+
+        # 文件缓存中有效期内的股票列表
+        cache_stocks = SymbolRegistry.load_cache(self.fdb, "tdx_us")
+        if cache_stocks is not None:
+            self.g_all_stocks = cache_stocks
+            return self.g_all_stocks
         client = TdxExHq_API(raise_exception=True, auto_retry=True)
         __all_stocks = []
         with client.connect(self.connect_info["ip"], self.connect_info["port"]):
@@ -94,6 +114,8 @@ class ExchangeTDXUS(Exchange):
                     break
 
         self.g_all_stocks = __all_stocks
+        if len(__all_stocks) > 0:
+            SymbolRegistry.save_cache(self.fdb, "tdx_us", __all_stocks)
         # print(f"美股共获取数量：{len(self.g_all_stocks)}")
         return self.g_all_stocks
 
@@ -244,56 +266,60 @@ class ExchangeTDXUS(Exchange):
         """
         获取股票名称
         """
-        all_stock = self.all_stocks()
-        stock = [_s for _s in all_stock if _s["code"] == code]
-        if not stock:
-            return None
-        return {"code": stock[0]["code"], "name": stock[0]["name"]}
+        return self.symbols().stock_info(code)
 
     def ticks(self, codes: List[str]) -> Dict[str, Tick]:
         """
-        如果可以使用 富途 的接口，就用 富途的，否则就用 日线的 K线计算
-        使用 富途 的接口会很快，日线则很慢
-        获取日线的k线，并返回最后一根k线的数据
+        获取行情，有效期内的行情使用缓存（ticks_cache），其他的代码使用连接池并发获取
         """
+        return self.ticks_cache.ticks(codes, self.query_ticks)
+
+    def query_ticks(self, codes: List[str]) -> Dict[str, Tick]:
+        """
+        使用连接池并发获取行情，代码分为多批，每批在一个连接中依次获取
+        """
+        query_codes = []
+        for _code in codes:
+            _market, _tdx_code = self.to_tdx_code(_code)
+            if _market is None:
+                continue
+            query_codes.append((_code, _market, _tdx_code))
+        quotes = self.pool.map(
+            lambda _client, _q: _client.get_instrument_quote(_q[1], _q[2]), query_codes
+        )
+
         ticks = {}
-        client = TdxExHq_API(raise_exception=True, auto_retry=True)
-        with client.connect(self.connect_info["ip"], self.connect_info["port"]):
-            for _code in codes:
-                _market, _tdx_code = self.to_tdx_code(_code)
-                if _market is None:
-                    continue
-                _quote = client.get_instrument_quote(_market, _tdx_code)
-                # OrderedDict(
-                #     [('market', 1), ('code', '00700'), ('pre_close', 362.8000183105469), ('open', 372.20001220703125),
-                #      ('high', 374.8000183105469), ('low', 364.4000244140625), ('price', 367.6000061035156),
-                #      ('kaicang', 0), ('zongliang', 17784504), ('xianliang', 1189500), ('neipan', 8892299),
-                #      ('waipan', 8892205), ('chicang', 0), ('bid1', 0.0), ('bid2', 0.0), ('bid3', 0.0), ('bid4', 0.0),
-                #      ('bid5', 0.0), ('bid_vol1', 0), ('bid_vol2', 0), ('bid_vol3', 0), ('bid_vol4', 0), ('bid_vol5', 0),
-                #      ('ask1', 0.0), ('ask2', 0.0), ('ask3', 0.0), ('ask4', 0.0), ('ask5', 0.0), ('ask_vol1', 0),
-                #      ('ask_vol2', 0), ('ask_vol3', 0), ('ask_vol4', 0), ('ask_vol5', 0)])
-                if len(_quote) > 0:
-                    _quote = _quote[0]
-                    ticks[_code] = Tick(
-                        code=_code,
-                        last=_quote["price"],
-                        buy1=_quote["bid1"],
-                        sell1=_quote["ask1"],
-                        low=_quote["low"],
-                        high=_quote["high"],
-                        volume=_quote["zongliang"],
-                        open=_quote["open"],
-                        rate=(
-                            round(
-                                (_quote["price"] - _quote["pre_close"])
-                                / _quote["price"]
-                                * 100,
-                                2,
-                            )
-                            if _quote["pre_close"] > 0 and _quote["price"] > 0
-                            else 0
-                        ),
-                    )
+        for (_code, _market, _tdx_code), _quote in zip(query_codes, quotes):
+            # OrderedDict(
+            #     [('market', 1), ('code', '00700'), ('pre_close', 362.8000183105469), ('open', 372.20001220703125),
+            #      ('high', 374.8000183105469), ('low', 364.4000244140625), ('price', 367.6000061035156),
+            #      ('kaicang', 0), ('zongliang', 17784504), ('xianliang', 1189500), ('neipan', 8892299),
+            #      ('waipan', 8892205), ('chicang', 0), ('bid1', 0.0), ('bid2', 0.0), ('bid3', 0.0), ('bid4', 0.0),
+            #      ('bid5', 0.0), ('bid_vol1', 0), ('bid_vol2', 0), ('bid_vol3', 0), ('bid_vol4', 0), ('bid_vol5', 0),
+            #      ('ask1', 0.0), ('ask2', 0.0), ('ask3', 0.0), ('ask4', 0.0), ('ask5', 0.0), ('ask_vol1', 0),
+            #      ('ask_vol2', 0), ('ask_vol3', 0), ('ask_vol4', 0), ('ask_vol5', 0)])
+            if len(_quote) > 0:
+                _quote = _quote[0]
+                ticks[_code] = Tick(
+                    code=_code,
+                    last=_quote["price"],
+                    buy1=_quote["bid1"],
+                    sell1=_quote["ask1"],
+                    low=_quote["low"],
+                    high=_quote["high"],
+                    volume=_quote["zongliang"],
+                    open=_quote["open"],
+                    rate=(
+                        round(
+                            (_quote["price"] - _quote["pre_close"])
+                            / _quote["price"]
+                            * 100,
+                            2,
+                        )
+                        if _quote["pre_close"] > 0 and _quote["price"] > 0
+                        else 0
+                    ),
+                )
         return ticks
 
     def now_trading(self):
@@ -313,45 +339,18 @@ class ExchangeTDXUS(Exchange):
         return False
 
     def klines_qfq(self, code: str, klines: pd.DataFrame):
+        """
+        使用复权因子进行前复权（复权因子每天最多从接口检查一次，有变化才更新文件）
+        """
         try:
-            xdxr_path = get_data_path() / "xdxr"
-            if xdxr_path.is_dir() is False:
-                xdxr_path.mkdir()
-            xdxr_file = xdxr_path / f"us_qfq_factor_{code}.csv"
-            now_day = fun.datetime_to_str(datetime.datetime.now(), "%Y-%m-%d")
-            if (
-                xdxr_file.is_file() is False
-                or fun.timeint_to_str(int(xdxr_file.stat().st_mtime), "%Y-%m-%d")
-                != now_day
-            ):
-                qfq_factor_df = ak.stock_us_daily(symbol=code, adjust="qfq-factor")
-                if qfq_factor_df is not None and len(qfq_factor_df) > 0:
-                    qfq_factor_df.to_csv(xdxr_file, index=False)
-            else:
-                qfq_factor_df = pd.read_csv(xdxr_file)
-
-            if qfq_factor_df is None or len(qfq_factor_df) == 0:
-                return klines
-
-            qfq_factor_df["qfq_date"] = pd.to_datetime(
-                qfq_factor_df["date"]
-            ).dt.tz_localize(self.tz)
-            qfq_factor_df["qfq_factor"] = qfq_factor_df["qfq_factor"].astype(float)
-            qfq_factor_df = qfq_factor_df.drop(columns=["date", "adjust"])
-
-            # 合并k线与复权因子，进行复权计算
-            df = pd.concat([klines, qfq_factor_df], axis=0)
-            df["qfq_date"].fillna(df["date"], inplace=True)
-            df.sort_values(by="qfq_date", inplace=True)
-            df["qfq_factor"].fillna(method="ffill", inplace=True)
-            df.dropna(inplace=True)
-            df.reset_index(drop=True, inplace=True)
-
-            df["open"] = df["open"] * df["qfq_factor"]
-            df["high"] = df["high"] * df["qfq_factor"]
-            df["low"] = df["low"] * df["qfq_factor"]
-            df["close"] = df["close"] * df["qfq_factor"]
-            return df[["code", "date", "open", "high", "low", "close", "volume"]]
+            factors = self.adj_factors.get(
+                code,
+                lambda: qfq_factors(
+                    ak.stock_us_daily(symbol=code, adjust="qfq-factor"),
+                    self.tz,
+                ),
+            )
+            return factor_qfq(klines, factors)
         except Exception as e:
             print(f"计算 {code} 复权数据异常：{e}")
             return klines
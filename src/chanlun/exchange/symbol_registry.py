@@ -0,0 +1,86 @@
+import time
+from typing import Dict, List, Union
+
+"""
+交易所的代码注册表
+
+之前 stock_info、to_tdx_code 每次调用都遍历 all_stocks 查找代码，行情获取的代码转换会对每个代码都遍历一次
+这里根据 all_stocks 的股票列表建立一次 代码 : 股票信息 的字典（Exchange.symbols），查找不需要遍历
+股票列表可以保存到文件缓存中（FileCacheDB.cache_pkl_path），重启后在有效期内直接读取，不需要再从接口分页获取
+"""
+
+
+class SymbolRegistry(object):
+    """
+    代码注册表
+    """
+
+    def __init__(self, stocks: List[dict]):
+        """
+        :param stocks: 所有股票列表（all_stocks 的返回），相同的代码使用第一个
+        """
+        self.stocks = stocks
+        self.size = len(stocks)
+        self.infos: Dict[str, dict] = {}
+        for _s in stocks:
+            if _s["code"] not in self.infos.keys():
+                self.infos[_s["code"]] = _s
+
+    def __len__(self):
+        return len(self.infos)
+
+    def __contains__(self, code: str):
+        return code in self.infos.keys()
+
+    def get(self, code: str) -> Union[dict, None]:
+        """
+        获取代码的股票信息，不存在返回 None
+        """
+        return self.infos.get(code)
+
+    def stock_info(self, code: str) -> Union[Dict, None]:
+        """
+        获取代码的名称信息 {'code': 代码, 'name': 名称}
+        """
+        stock = self.infos.get(code)
+        if stock is None:
+            return None
+        return {"code": stock["code"], "name": stock["name"]}
+
+    @staticmethod
+    def cache_filename(name: str) -> str:
+        return f"symbols_{name}.pkl"
+
+    @staticmethod
+    def save_cache(fdb, name: str, stocks: List[dict]):
+        """
+        保存股票列表到文件缓存
+        :param fdb: FileCacheDB
+        :param name: 缓存名称（交易所市场）
+        """
+        fdb.cache_pkl_to_file(
+            SymbolRegistry.cache_filename(name), {"time": time.time(), "stocks": stocks}
+        )
+        return True
+
+    @staticmethod
+    def load_cache(
+        fdb, name: str, expire_seconds: int = 24 * 60 * 60
+    ) -> Union[List[dict], None]:
+        """
+        读取文件缓存中的股票列表，不存在或者超过有效期返回 None
+        :param fdb: FileCacheDB
+        :param name: 缓存名称（交易所市场）
+        :param expire_seconds: 有效期（秒）
+        """
+        try:
+            cache = fdb.cache_pkl_from_file(SymbolRegistry.cache_filename(name))
+        except Exception:
+            return None
+        if (
+            cache is None
+            or time.time() - cache["time"] > expire_seconds
+            or len(cache["stocks"]) == 0
+        ):
+            return None
+        return cache["stocks"]
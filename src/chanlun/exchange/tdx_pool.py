@@ -0,0 +1,253 @@
+import contextlib
+import math
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+from pytdx.errors import TdxConnectionError
+from pytdx.hq import TdxHq_API
+from pytdx.util import best_ip
+
+
+def select_best_ips(nums: int = 3) -> List[dict]:
+    """
+    并发测试通达信行情服务器的速度，返回最快的 nums 个服务器
+    """
+    ip_list = best_ip.stock_ip
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        pings = list(
+            executor.map(lambda _s: best_ip.ping(_s["ip"], _s["port"], "stock"), ip_list)
+        )
+    results = sorted(
+        [
+            (_p, _s)
+            for _p, _s in zip(pings, ip_list)
+            # ping 不通的服务器返回的是 9 天的时间
+            if _p.days < 9
+        ],
+        key=lambda _r: _r[0],
+    )
+    return [{"ip": _s["ip"], "port": int(_s["port"])} for _p, _s in results[:nums]]
+
+
+class TdxHqPool(object):
+    """
+    通达信行情服务器的连接池
+
+    连接分布在多个服务器上，每个服务器有最大的并发连接数限制，优先使用当前连接数最少的服务器
+    空闲的连接保持连接，由 pytdx 的心跳线程定时发送心跳包
+    连接出现异常，会断开并将服务器标记为不可用一段时间，之后的请求自动使用其他的服务器
+    所有服务器都不可用，则调用 servers_fun 重新选择服务器
+    扩展行情（期货、港股、美股）使用 api_class=TdxExHq_API
+    """
+
+    def __init__(
+        self,
+        servers: List[dict],
+        max_conn_per_server: int = 4,
+        bad_server_seconds: int = 60,
+        servers_fun: Callable[[], List[dict]] = None,
+        api_class=TdxHq_API,
+    ):
+        """
+        :param servers: 服务器列表，例如 [{'ip': '1.1.1.1', 'port': 7709}]，按照优先级排序
+        :param max_conn_per_server: 每个服务器的最大并发连接数
+        :param bad_server_seconds: 连接异常的服务器，多长时间内不再使用
+        :param servers_fun: 重新选择服务器的方法，在所有服务器都不可用时调用
+        :param api_class: 连接的接口类，TdxHq_API 或 TdxExHq_API
+        """
+        self.max_conn_per_server = max_conn_per_server
+        self.bad_server_seconds = bad_server_seconds
+        self.servers_fun = servers_fun
+        self.api_class = api_class
+
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+        # 是否有请求正在重新选择服务器
+        self._reselecting = False
+        self.servers: List[dict] = []
+        # 连接与计数使用服务器的 (ip, port) 作为 key，服务器列表变更后，之前获取的连接仍然能归还到对应的服务器
+        self._idle: Dict[Tuple[str, int], List[TdxHq_API]] = {}
+        self._active: Dict[Tuple[str, int], int] = {}
+        self._bad_until: Dict[Tuple[str, int], float] = {}
+        self.set_servers(servers)
+
+    @staticmethod
+    def server_key(server: dict) -> Tuple[str, int]:
+        return server["ip"], int(server["port"])
+
+    def set_servers(self, servers: List[dict]):
+        """
+        设置新的服务器列表，保留的服务器，连接与计数不变；移除的服务器，空闲连接断开，使用中的连接归还时断开
+        """
+        if len(servers) == 0:
+            raise ValueError("通达信服务器列表不能为空")
+        with self._cond:
+            self.servers = list(servers)
+            keys = [self.server_key(_s) for _s in self.servers]
+            old_idle = [
+                _c for _k, _cs in self._idle.items() if _k not in keys for _c in _cs
+            ]
+            self._idle = {_k: self._idle.get(_k, []) for _k in keys}
+            # 移除的服务器，还有使用中的连接，保留计数
+            self._active = {
+                _k: _n
+                for _k, _n in self._active.items()
+                if _k in self._idle or _n > 0
+            }
+            for _k in keys:
+                self._active.setdefault(_k, 0)
+            self._bad_until = {}
+            self._cond.notify_all()
+        for _c in old_idle:
+            self._disconnect(_c)
+        return True
+
+    @staticmethod
+    def _disconnect(client: TdxHq_API):
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+
+    def _check_pid(self):
+        """
+        fork 后的子进程不能使用父进程的连接，丢弃后重新创建
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._reselecting = False
+            self._idle = {_k: [] for _k in self._idle.keys()}
+            self._active = {_k: 0 for _k in self._idle.keys()}
+
+    def _reselect_servers(self):
+        """
+        所有服务器都不可用，重新选择服务器
+        在锁外调用 servers_fun（测速需要较长时间），期间其他请求等待，没有选出服务器则继续使用之前的服务器
+        """
+        servers = []
+        try:
+            servers = self.servers_fun()
+        finally:
+            with self._cond:
+                self._reselecting = False
+                if not servers:
+                    self._bad_until = {}
+                self._cond.notify_all()
+        if servers:
+            self.set_servers(servers)
+
+    def _acquire(self):
+        """
+        选择当前连接数最少的可用服务器，返回服务器与空闲的连接（没有空闲连接则返回 None）
+        """
+        while True:
+            with self._cond:
+                self._check_pid()
+                while True:
+                    now = time.time()
+                    usable = [
+                        _s
+                        for _s in self.servers
+                        if self._bad_until.get(self.server_key(_s), 0) <= now
+                    ]
+                    if len(usable) == 0:
+                        if self.servers_fun is None:
+                            self._bad_until = {}
+                            continue
+                        if self._reselecting:
+                            self._cond.wait(1)
+                            continue
+                        self._reselecting = True
+                        break
+                    usable = [
+                        _s
+                        for _s in usable
+                        if self._active[self.server_key(_s)] < self.max_conn_per_server
+                    ]
+                    if len(usable) > 0:
+                        server = min(
+                            usable, key=lambda _s: self._active[self.server_key(_s)]
+                        )
+                        key = self.server_key(server)
+                        self._active[key] += 1
+                        idle = self._idle[key]
+                        return server, idle.pop() if len(idle) > 0 else None
+                    self._cond.wait(1)
+            self._reselect_servers()
+
+    def _release(self, server: dict, client: TdxHq_API, is_bad: bool):
+        key = self.server_key(server)
+        with self._cond:
+            # fork 后的连接，直接断开
+            if key in self._active and self._pid == os.getpid():
+                self._active[key] = max(self._active[key] - 1, 0)
+                if key not in self._idle:
+                    # 服务器已经从列表中移除，断开连接
+                    if self._active[key] == 0:
+                        del self._active[key]
+                elif is_bad:
+                    self._bad_until[key] = time.time() + self.bad_server_seconds
+                elif client is not None:
+                    self._idle[key].append(client)
+                    client = None
+            self._cond.notify()
+        if client is not None:
+            self._disconnect(client)
+
+    @contextlib.contextmanager
+    def client(self):
+        """
+        获取一个连接，使用方法：
+            with pool.client() as client:
+                client.get_security_bars(...)
+        """
+        server, client = self._acquire()
+        is_bad = False
+        try:
+            if client is not None and (
+                client.client is None or client.last_transaction_failed
+            ):
+                # 连接已经失效，重新连接
+                self._disconnect(client)
+                client = None
+            if client is None:
+                client = self.api_class(
+                    heartbeat=True, raise_exception=True, auto_retry=True
+                )
+                client.connect(server["ip"], server["port"])
+            yield client
+        except (TdxConnectionError, socket.error):
+            is_bad = True
+            raise
+        finally:
+            self._release(server, client, is_bad)
+
+    def map(self, fun: Callable[[Any, Any], Any], items: list, workers: int = None):
+        """
+        并发请求：items 分为多批，每批使用一个连接依次调用 fun(client, item)
+        :param fun: 请求方法
+        :param items: 请求参数列表
+        :param workers: 并发数量，默认为所有服务器的最大连接数之和
+        :return: 与 items 顺序相同的结果列表
+        """
+        if len(items) == 0:
+            return []
+        if workers is None:
+            with self._cond:
+                workers = self.max_conn_per_server * len(self.servers)
+        batch_size = math.ceil(len(items) / max(min(workers, len(items)), 1))
+        batches = [items[i : i + batch_size] for i in range(0, len(items), batch_size)]
+
+        def _run(batch: list) -> list:
+            with self.client() as client:
+                return [fun(client, _i) for _i in batch]
+
+        if len(batches) == 1:
+            return _run(batches[0])
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            results = list(executor.map(_run, batches))
+        return [_r for _rs in results for _r in _rs]
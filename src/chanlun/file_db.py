@@ -1,11 +1,16 @@
+import atexit
+import contextlib
+import copy
 import datetime
 import hashlib
+import os
 import pathlib
 import pickle
 import random
+import threading
+from collections import OrderedDict
 from decimal import Decimal
-import time
-from typing import Union
+from typing import Dict, Union
 
 import pandas as pd
 import pytz
@@ -86,6 +91,11 @@ class FileCacheDB(object):
             "cl_mmd_cal_not_in_zs_gt_9_3mmd",
         ]
 
+        # web 缠论数据快照的格式版本，格式有变化则修改，旧版本的快照会被重新计算
+        self.cl_snapshot_version = 2
+        # 快照之后新增的 K 线数量超过这个值，才重新写入快照；之间的 K 线在读取快照后，通过传入的 K 线增量计算
+        self.cl_snapshot_compact_nums = 100
+
         # 缠论的更新时间，如果与当前保存不一致，需要清空缓存的计算结果，重新计算
         self.cl_update_date = "2024-09-03"
         cache_cl_update_date = db.cache_get("__cl_update_date")
@@ -146,87 +156,93 @@ class FileCacheDB(object):
         frequency: str,
         cl_config: dict,
         klines: pd.DataFrame,
+        cd: ICL = None,
+        save: bool = True,
     ) -> ICL:
         """
         获取web缓存的的缠论数据对象
+        :param cd: 内存中已有的缠论数据对象，不为空则不读取文件缓存，检查与K线一致后直接在此对象上增量计算
+        :param save: 是否将计算后的对象写入文件缓存
         """
-        unique_md5_str = (
-            f'{[f"{k}:{v}" for k, v in cl_config.items() if k in self.config_keys]}'
-        )
-        key = hashlib.md5(unique_md5_str.encode("UTF-8")).hexdigest()
-
-        file_pathname = (
-            self.cl_data_path
-            / f"{market}_{code.replace('/', '_').replace('.', '_')}_{frequency}_{key}.pkl"
-        )
-        cd: ICL = cl.CL(code, frequency, cl_config)
+        key = self.web_cl_config_key(cl_config)
+        file_pathname = self.web_cl_data_filename(market, code, frequency, cl_config)
+
+        # 读取到的快照对象及其 K 线数量
+        snapshot_cd = None
+        snapshot_kline_nums = 0
+        if cd is not None:
+            snapshot_cd = cd
+            snapshot_kline_nums = len(cd.get_src_klines())
+        else:
+            cd = cl.CL(code, frequency, cl_config)
         try:
-            if file_pathname.is_file():
+            if snapshot_cd is None and file_pathname.is_file():
                 # print(f'{market}-{code}-{frequency} {key} K-Nums {len(klines)} 使用缓存')
-                try_num = 0
-                while True:
-                    try:
-                        with open(file_pathname, "rb") as fp:
-                            cd = pickle.load(fp)
-                        break
-                    except Exception as e:
-                        try_num += 1
-                        time.sleep(0.5)
-                        if try_num > 5:
-                            raise e
-                # 判断缓存中的最后k线是否大于给定的最新一根k线时间，如果小于说明直接有断档，不连续，重新全量重新计算
+                # 快照是写入临时文件后替换的，读取的一定是完整的文件
+                with open(file_pathname, "rb") as fp:
+                    snapshot = pickle.load(fp)
                 if (
-                    len(cd.get_src_klines()) > 0
-                    and len(klines) > 0
-                    and (
-                        cd.get_src_klines()[-1].date < klines.iloc[0]["date"]
-                        or cd.get_src_klines()[0].date > klines.iloc[0]["date"]
-                    )
+                    isinstance(snapshot, dict)
+                    and snapshot.get("version") == self.cl_snapshot_version
+                ):
+                    cd = snapshot_cd = snapshot["cd"]
+                    snapshot_kline_nums = snapshot["kline_nums"]
+            # 内存中的对象与读取的快照，都检查与给定的K线是否一致，不一致则重新全量计算
+            # 判断缓存中的最后k线是否大于给定的最新一根k线时间，如果小于说明直接有断档，不连续，重新全量重新计算
+            if (
+                len(cd.get_src_klines()) > 0
+                and len(klines) > 0
+                and (
+                    cd.get_src_klines()[-1].date < klines.iloc[0]["date"]
+                    or cd.get_src_klines()[0].date > klines.iloc[0]["date"]
+                )
+            ):
+                print(
+                    f"{market}-{code}-{frequency} {key} K-Nums {len(klines)} 历史数据有错位，重新计算"
+                )
+                cd = cl.CL(code, frequency, cl_config)
+            # 判断缓存中的数据，与给定的K线数据是否有差异，有则表示数据有变（比如复权会产生变化），则重新全量计算
+            if len(cd.get_src_klines()) >= 2 and len(klines) >= 2:
+                cd_pre_kline = cd.get_src_klines()[-2]
+                src_klines = klines[klines["date"] == cd_pre_kline.date]
+                # 计算后的数据没有最开始的日期或者 开高低收其中有不同的，则重新计算
+                if (
+                    len(src_klines) == 0
+                    or Decimal(src_klines.iloc[0]["close"])
+                    != Decimal(cd_pre_kline.c)
+                    or Decimal(src_klines.iloc[0]["high"])
+                    != Decimal(cd_pre_kline.h)
+                    or Decimal(src_klines.iloc[0]["low"]) != Decimal(cd_pre_kline.l)
+                    or Decimal(src_klines.iloc[0]["open"])
+                    != Decimal(cd_pre_kline.o)
+                    or Decimal(src_klines.iloc[0]["volume"])
+                    != Decimal(cd_pre_kline.a)
                 ):
                     print(
-                        f"{market}-{code}-{frequency} {key} K-Nums {len(klines)} 历史数据有错位，重新计算"
+                        f"{market}--{code}--{frequency} {key}",
+                        cd_pre_kline,
+                        src_klines.iloc[0].to_dict(),
+                    )
+                    print(
+                        f"{market}--{code}--{frequency} {key} 计算前的数据有差异，重新计算"
+                    )
+                    # print(cd_pre_kline, src_klines)
+                    cd = cl.CL(code, frequency, cl_config)
+            # 判断缓存中的最近一百根时间范围内的数量是否一致
+            if len(cd.get_src_klines()) >= 100 and len(klines) >= 100:
+                _valid_cd_klines = cd.get_src_klines()[-100:]
+                _valid_src_klines = klines[
+                    (klines["date"] >= _valid_cd_klines[0].date)
+                    & (klines["date"] <= _valid_cd_klines[-1].date)
+                ]
+                if len(_valid_cd_klines) != len(_valid_src_klines):
+                    print(
+                        f"{market}--{code}--{frequency} {key} 计算后的缠论数据有丢失数据 [{len(_valid_cd_klines)} - {len(_valid_src_klines)}]，重新计算"
                     )
                     cd = cl.CL(code, frequency, cl_config)
-                # 判断缓存中的数据，与给定的K线数据是否有差异，有则表示数据有变（比如复权会产生变化），则重新全量计算
-                if len(cd.get_src_klines()) >= 2 and len(klines) >= 2:
-                    cd_pre_kline = cd.get_src_klines()[-2]
-                    src_klines = klines[klines["date"] == cd_pre_kline.date]
-                    # 计算后的数据没有最开始的日期或者 开高低收其中有不同的，则重新计算
-                    if (
-                        len(src_klines) == 0
-                        or Decimal(src_klines.iloc[0]["close"])
-                        != Decimal(cd_pre_kline.c)
-                        or Decimal(src_klines.iloc[0]["high"])
-                        != Decimal(cd_pre_kline.h)
-                        or Decimal(src_klines.iloc[0]["low"]) != Decimal(cd_pre_kline.l)
-                        or Decimal(src_klines.iloc[0]["open"])
-                        != Decimal(cd_pre_kline.o)
-                        or Decimal(src_klines.iloc[0]["volume"])
-                        != Decimal(cd_pre_kline.a)
-                    ):
-                        print(
-                            f"{market}--{code}--{frequency} {key}",
-                            cd_pre_kline,
-                            src_klines.iloc[0].to_dict(),
-                        )
-                        print(
-                            f"{market}--{code}--{frequency} {key} 计算前的数据有差异，重新计算"
-                        )
-                        # print(cd_pre_kline, src_klines)
-                        cd = cl.CL(code, frequency, cl_config)
-                # 判断缓存中的最近一百根时间范围内的数量是否一致
-                if len(cd.get_src_klines()) >= 100 and len(klines) >= 100:
-                    _valid_cd_klines = cd.get_src_klines()[-100:]
-                    _valid_src_klines = klines[
-                        (klines["date"] >= _valid_cd_klines[0].date)
-                        & (klines["date"] <= _valid_cd_klines[-1].date)
-                    ]
-                    if len(_valid_cd_klines) != len(_valid_src_klines):
-                        print(
-                            f"{market}--{code}--{frequency} {key} 计算后的缠论数据有丢失数据 [{len(_valid_cd_klines)} - {len(_valid_src_klines)}]，重新计算"
-                        )
-                        cd = cl.CL(code, frequency, cl_config)
         except Exception as e:
+            snapshot_cd = None
+            cd = cl.CL(code, frequency, cl_config)
             if file_pathname.is_file():
                 print(
                     f"获取 web 缓存的缠论数据对象异常 {market} {code} {frequency} - {e}，尝试删除缓存文件重新计算"
@@ -238,11 +254,15 @@ class FileCacheDB(object):
 
         cd.process_klines(klines)
 
-        try:
-            with open(file_pathname, "wb") as fp:
-                pickle.dump(cd, fp)
-        except Exception as e:
-            print(f"写入缓存异常 {market} {code} {frequency} - {e}")
+        # 重新计算的，或者快照之后新增的 K 线较多，才重新写入快照，其他情况下次读取快照后再增量计算
+        kline_nums = len(cd.get_src_klines())
+        if save and (
+            snapshot_cd is None
+            or cd is not snapshot_cd
+            or kline_nums - snapshot_kline_nums >= self.cl_snapshot_compact_nums
+            or kline_nums < snapshot_kline_nums
+        ):
+            self.save_web_cl_data(market, code, frequency, cl_config, cd)
 
         # 加一个随机概率，去清理历史的缓存，避免太多占用空间
         if random.randint(0, 100) <= 5:
@@ -250,6 +270,47 @@ class FileCacheDB(object):
 
         return cd
 
+    def web_cl_config_key(self, cl_config: dict) -> str:
+        """
+        缠论配置中影响计算结果的配置项的 md5 值
+        """
+        unique_md5_str = (
+            f'{[f"{k}:{v}" for k, v in cl_config.items() if k in self.config_keys]}'
+        )
+        return hashlib.md5(unique_md5_str.encode("UTF-8")).hexdigest()
+
+    def web_cl_data_filename(
+        self, market: str, code: str, frequency: str, cl_config: dict
+    ) -> pathlib.Path:
+        """
+        web缓存的缠论数据对象的文件名
+        """
+        key = self.web_cl_config_key(cl_config)
+        return (
+            self.cl_data_path
+            / f"{market}_{code.replace('/', '_').replace('.', '_')}_{frequency}_{key}.pkl"
+        )
+
+    def save_web_cl_data(
+        self, market: str, code: str, frequency: str, cl_config: dict, cd: ICL
+    ) -> bool:
+        """
+        将缠论数据对象写入web缓存的快照文件
+        """
+        try:
+            self.write_pkl_file(
+                self.web_cl_data_filename(market, code, frequency, cl_config),
+                {
+                    "version": self.cl_snapshot_version,
+                    "kline_nums": len(cd.get_src_klines()),
+                    "cd": cd,
+                },
+            )
+        except Exception as e:
+            print(f"写入缓存异常 {market} {code} {frequency} - {e}")
+            return False
+        return True
+
     def clear_web_cl_data(self, market: str, code: str):
         """
         清除指定市场下标的缠论缓存对象
@@ -269,7 +330,9 @@ class FileCacheDB(object):
         清除时间超过7天的缓存数据
         """
         del_lt_times = fun.datetime_to_int(datetime.datetime.now()) - (7 * 24 * 60 * 60)
-        for filename in self.cl_data_path.glob("*.pkl"):
+        for filename in list(self.cl_data_path.glob("*.pkl")) + list(
+            self.cl_data_path.glob("*.tmp")
+        ):
             try:
                 if filename.stat().st_mtime < del_lt_times:
                     filename.unlink()
@@ -318,16 +381,30 @@ class FileCacheDB(object):
             limit = 1000
         klines = db_ex.klines(code, frequency, args={"limit": limit})
         cd.process_klines(klines)
-        with open(filename, "wb") as fp:
-            pickle.dump(cd, fp)
+        self.write_pkl_file(filename, cd)
         return cd
 
+    @staticmethod
+    def write_pkl_file(filename: pathlib.Path, data: object):
+        """
+        将数据 pickle 写入文件，先写入临时文件再替换，避免其他进程读取到写入一半的文件
+        """
+        tmp_filename = filename.with_name(
+            f"{filename.name}.{os.getpid()}_{threading.get_ident()}.tmp"
+        )
+        try:
+            with open(tmp_filename, "wb") as fp:
+                pickle.dump(data, fp)
+            os.replace(tmp_filename, filename)
+        finally:
+            if tmp_filename.is_file():
+                tmp_filename.unlink()
+
     def cache_pkl_to_file(self, filename: str, data: object):
         """
         将缓存数据持久化到文件中
         """
-        with open(self.cache_pkl_path / filename, "wb") as fp:
-            pickle.dump(data, fp)
+        self.write_pkl_file(self.cache_pkl_path / filename, data)
 
     def cache_pkl_from_file(self, filename: str) -> object:
         """
@@ -339,7 +416,132 @@ class FileCacheDB(object):
             return pickle.load(fp)
 
 
+class WebCLDataCache(object):
+    """
+    web 缠论数据对象的进程内 LRU 缓存
+    按照 (市场, 代码, 周期, 缠论配置) 保存计算好的缠论对象，后续请求直接在内存对象上增量计算，不再读写文件
+    同一个 key 同时只有一个请求在计算，缓存中 K 线总数超过限制，淘汰最久未使用的对象，淘汰及进程退出时写入文件缓存
+    """
+
+    def __init__(self, file_db: FileCacheDB, max_kline_nums: int = 500000):
+        """
+        :param file_db: 文件缓存对象，用于读取和写入缠论数据快照
+        :param max_kline_nums: 缓存中所有缠论对象的 K 线总数限制
+        """
+        self.fdb = file_db
+        self.max_kline_nums = max_kline_nums
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        # key : [锁, 正在使用的数量]，没有使用并且已经不在缓存中的 key 删除其锁
+        self._key_locks: Dict[tuple, list] = {}
+        atexit.register(self.save_all)
+
+    @contextlib.contextmanager
+    def _key_lock(self, key: tuple):
+        """
+        获取 key 的锁，同一个 key 同时只有一个请求在计算或写入
+        """
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0 and key not in self._items:
+                    self._key_locks.pop(key, None)
+
+    @contextlib.contextmanager
+    def hold_web_cl_data(
+        self,
+        market: str,
+        code: str,
+        frequency: str,
+        cl_config: dict,
+        klines: pd.DataFrame,
+    ):
+        """
+        获取缠论数据对象，在 with 语句中持有 key 的锁，其他请求不会同时修改这个对象，参数与 FileCacheDB.get_web_cl_data 一致
+        返回的是缓存中共享的对象，只能在 with 语句中使用（比如转换成图表数据），不要在之外保存或修改
+
+        with web_cl_cache.hold_web_cl_data(market, code, frequency, cl_config, klines) as cd:
+            cl_chart_data = cl_data_to_tv_chart(cd, cl_config)
+        """
+        key = (market, code, frequency, self.fdb.web_cl_config_key(cl_config))
+        evict_items = []
+        try:
+            with self._key_lock(key):
+                with self._lock:
+                    item = self._items.get(key)
+                cd = self.fdb.get_web_cl_data(
+                    market,
+                    code,
+                    frequency,
+                    cl_config,
+                    klines,
+                    cd=item["cd"] if item is not None else None,
+                    save=False,
+                )
+                with self._lock:
+                    self._items[key] = {
+                        "market": market,
+                        "code": code,
+                        "frequency": frequency,
+                        "cl_config": cl_config,
+                        "cd": cd,
+                    }
+                    self._items.move_to_end(key)
+                    evict_items = self._evict()
+                yield cd
+        finally:
+            # 在当前 key 的锁之外写入，避免与其他 key 的锁互相等待
+            for _key, _item in evict_items:
+                with self._key_lock(_key):
+                    self.fdb.save_web_cl_data(**_item)
+
+    def get_web_cl_data(
+        self,
+        market: str,
+        code: str,
+        frequency: str,
+        cl_config: dict,
+        klines: pd.DataFrame,
+    ) -> ICL:
+        """
+        获取缠论数据对象，参数与 FileCacheDB.get_web_cl_data 一致
+        返回缓存对象的副本，调用方可以在锁之外使用，不受其他请求增量计算的影响
+        """
+        with self.hold_web_cl_data(market, code, frequency, cl_config, klines) as cd:
+            return copy.deepcopy(cd)
+
+    def _evict(self) -> list:
+        """
+        K 线总数超过限制，按照最久未使用的顺序移除，至少保留最近使用的一个
+        """
+        evict_items = []
+        total_nums = sum(len(_i["cd"].get_src_klines()) for _i in self._items.values())
+        while total_nums > self.max_kline_nums and len(self._items) > 1:
+            _key, _item = self._items.popitem(last=False)
+            total_nums -= len(_item["cd"].get_src_klines())
+            evict_items.append((_key, _item))
+        return evict_items
+
+    def save_all(self) -> bool:
+        """
+        将缓存中的缠论对象全部写入文件缓存
+        """
+        with self._lock:
+            items = list(self._items.items())
+        for _key, _item in items:
+            with self._key_lock(_key):
+                self.fdb.save_web_cl_data(**_item)
+        return True
+
+
 fdb = FileCacheDB()
+web_cl_cache = WebCLDataCache(fdb)
 
 if __name__ == "__main__":
     from chanlun.cl_utils import query_cl_chart_config
@@ -72,7 +72,7 @@ def xg_multiple_xd_bi_mmd(cl_datas: List[ICL], opt_type: list = []):
         low_bi.mmd_exists(opt_mmd, "|") or low_bi.bc_exists(["pz", "qs"], "|")
     ):
         return {
-            "code": high_data.get_code,
+            "code": high_data.get_code(),
             "msg": f"{high_data.get_frequency()} 线段买点【{high_xd.line_mmds('|')}】背驰【{high_xd.line_bcs('|')}】 {low_data.get_frequency()} 笔买点【{low_bi.line_mmds('|')}】背驰【{low_bi.line_bcs('|')}】",
         }
 
@@ -0,0 +1,330 @@
+import datetime
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from multiprocessing import get_context
+from typing import Callable, Dict, List, Union
+
+import numpy as np
+import pandas as pd
+from tqdm.auto import tqdm
+
+from chanlun import fun, zixuan
+from chanlun.base import Market
+from chanlun.config import get_data_path
+from chanlun.exchange import get_exchange
+from chanlun.xuangu.xuangu_signal import SignalTable, extract_signal_rows
+
+"""
+全市场选股扫描
+
+分为三个阶段：
+    1. 行情获取：线程池并发获取 K 线，限制并发数量，避免行情服务器限制
+    2. 缠论计算与选股：进程池执行，每个进程启动时初始化一次缠论配置与选股方法，缠论对象使用文件缓存快照增量计算
+    3. 结果处理：在主进程中汇总结果，写入自选分组
+
+扫描过程中定时记录进度到检查点文件，中断后再次运行，会跳过已经完成的代码继续扫描
+检查点记录扫描的日期与代码列表的哈希，日期或代码列表不一致（比如第二天的定时扫描），则丢弃检查点重新扫描
+扫描完成后，输出每个阶段的处理速度（代码/秒）与用时的 p50/p99
+扫描中提取每个代码的选股信号行，保存为信号表（xuangu_signal.SignalTable），之后更换选股条件可以直接在信号表上选股
+"""
+
+# 计算进程中的全局变量，在进程初始化时设置
+_worker_args: Dict[str, object] = {}
+
+
+def _init_compute_worker(market: str, cl_config: dict, xg_fun: Callable, opt_type):
+    """
+    计算进程的初始化，只执行一次
+    """
+    _worker_args["market"] = market
+    _worker_args["cl_config"] = cl_config
+    _worker_args["xg_fun"] = xg_fun
+    _worker_args["opt_type"] = opt_type
+
+
+def _compute_xuangu(code: str, klines: Dict[str, pd.DataFrame]):
+    """
+    在计算进程中，计算缠论数据并执行选股方法，同时提取选股信号行
+    :return: 代码，选股结果，信号行，异常信息，用时
+    """
+    from chanlun.cl_utils import web_batch_get_cl_datas
+
+    s_time = time.time()
+    try:
+        cds = web_batch_get_cl_datas(
+            _worker_args["market"], code, klines, _worker_args["cl_config"]
+        )
+        signal_rows = extract_signal_rows(cds)
+        if _worker_args["opt_type"] is None:
+            res = _worker_args["xg_fun"](cds)
+        else:
+            res = _worker_args["xg_fun"](cds, _worker_args["opt_type"])
+        return code, res, signal_rows, None, time.time() - s_time
+    except Exception as e:
+        return code, None, None, str(e), time.time() - s_time
+
+
+class XuanguScanner(object):
+    """
+    全市场选股扫描引擎
+    """
+
+    def __init__(
+        self,
+        market: str,
+        xg_fun: Callable,
+        frequencys: List[str],
+        cl_config: dict,
+        opt_type: Union[List[str], None] = None,
+        zx_group: str = None,
+        fetch_workers: int = 8,
+        compute_workers: int = 4,
+        checkpoint_name: str = None,
+        signal_name: str = None,
+    ):
+        """
+        :param market: 市场
+        :param xg_fun: 选股方法，xuangu 模块中的方法（需要可以 pickle，传递给计算进程）
+        :param frequencys: 选股的周期列表
+        :param cl_config: 缠论配置
+        :param opt_type: 选股方法的 opt_type 参数，None 则不传递
+        :param zx_group: 选出的代码写入的自选分组，None 则不写入
+        :param fetch_workers: 行情获取的并发线程数量
+        :param compute_workers: 缠论计算的进程数量
+        :param checkpoint_name: 检查点名称，None 则根据市场、选股方法、周期生成
+        :param signal_name: 保存的信号表名称，None 则根据市场、周期生成
+        """
+        self.market = market
+        self.xg_fun = xg_fun
+        self.frequencys = [_f for _f in frequencys if _f != ""]
+        self.cl_config = cl_config
+        self.opt_type = opt_type
+        self.zx_group = zx_group
+        self.fetch_workers = fetch_workers
+        self.compute_workers = compute_workers
+
+        self.ex = get_exchange(Market(market))
+        self.zx = zixuan.ZiXuan(market) if zx_group is not None else None
+
+        if checkpoint_name is None:
+            checkpoint_name = (
+                f"{market}_{xg_fun.__name__}_{'_'.join(self.frequencys)}_{zx_group}"
+            )
+        checkpoint_path = get_data_path() / "xuangu_checkpoint"
+        if checkpoint_path.is_dir() is False:
+            checkpoint_path.mkdir()
+        self.checkpoint_file = checkpoint_path / f"{checkpoint_name}.json"
+        if signal_name is None:
+            signal_name = f"{market}_{'_'.join(self.frequencys)}"
+        self.signal_name = signal_name
+        # 处理多少个代码，写入一次检查点
+        self.checkpoint_interval = 50
+
+        self.log = fun.get_logger()
+
+    @staticmethod
+    def scan_date() -> str:
+        """
+        扫描的交易日期（当天）
+        """
+        return fun.datetime_to_str(datetime.datetime.now(), "%Y-%m-%d")
+
+    @staticmethod
+    def codes_hash(codes: List[str]) -> str:
+        """
+        扫描代码列表的哈希
+        """
+        return hashlib.md5(",".join(codes).encode("UTF-8")).hexdigest()
+
+    def load_checkpoint(self, codes: List[str]) -> Union[dict, None]:
+        """
+        读取检查点，不存在或者与本次扫描的日期、代码列表不一致，返回 None
+        :param codes: 本次扫描的代码列表
+        """
+        if self.checkpoint_file.is_file() is False:
+            return None
+        try:
+            with open(self.checkpoint_file, "r", encoding="utf-8") as fp:
+                checkpoint = json.load(fp)
+        except Exception as e:
+            self.log.warning(f"读取选股检查点异常 {self.checkpoint_file} - {e}")
+            return None
+        if checkpoint.get("scan_date") != self.scan_date() or checkpoint.get(
+            "codes_hash"
+        ) != self.codes_hash(codes):
+            tqdm.write(
+                f"{self.market} 选股检查点的日期或代码列表与本次扫描不一致，重新开始扫描"
+            )
+            return None
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint: dict):
+        """
+        写入检查点（先写临时文件再替换）
+        """
+        tmp_file = self.checkpoint_file.with_name(f"{self.checkpoint_file.name}.tmp")
+        with open(tmp_file, "w", encoding="utf-8") as fp:
+            json.dump(checkpoint, fp, ensure_ascii=False, default=str)
+        os.replace(tmp_file, self.checkpoint_file)
+
+    def clear_checkpoint(self):
+        if self.checkpoint_file.is_file():
+            self.checkpoint_file.unlink()
+
+    def _fetch_klines(self, code: str):
+        """
+        获取代码各个周期的 K 线
+        :return: 代码，K 线字典（获取失败或没有数据返回 None），用时
+        """
+        s_time = time.time()
+        try:
+            klines = {_f: self.ex.klines(code, _f) for _f in self.frequencys}
+            if len(klines) > 0 and min(
+                [len(_k) if _k is not None else 0 for _k in klines.values()]
+            ) > 0:
+                return code, klines, time.time() - s_time
+        except Exception as e:
+            tqdm.write(f"{self.market} {code} 获取行情异常 ：{e}")
+        return code, None, time.time() - s_time
+
+    @staticmethod
+    def _stage_stats(times: List[float], total_seconds: float) -> dict:
+        if len(times) == 0:
+            return {"nums": 0, "codes_per_sec": 0, "p50": 0, "p99": 0}
+        return {
+            "nums": len(times),
+            "codes_per_sec": len(times) / total_seconds if total_seconds > 0 else 0,
+            "p50": float(np.percentile(times, 50)),
+            "p99": float(np.percentile(times, 99)),
+        }
+
+    def run(self, codes: List[str], resume: bool = True) -> dict:
+        """
+        执行选股扫描
+        :param codes: 扫描的代码列表
+        :param resume: 是否从上次中断的检查点继续，否则重新开始扫描
+        :return: {'results': {代码: 选股结果}, 'signals': 信号表, 'stats': 各阶段的统计信息}
+        """
+        checkpoint = self.load_checkpoint(codes) if resume else None
+        if checkpoint is None or len(checkpoint["done_codes"]) == 0:
+            checkpoint = {
+                "scan_date": self.scan_date(),
+                "codes_hash": self.codes_hash(codes),
+                "done_codes": [],
+                "results": {},
+                "signals": {},
+            }
+            # 全新的扫描，清空自选分组
+            if self.zx is not None:
+                self.zx.clear_zx_stocks(self.zx_group)
+        else:
+            tqdm.write(
+                f"{self.market} 从检查点继续选股，已完成 {len(checkpoint['done_codes'])} 个代码"
+            )
+
+        done_codes = set(checkpoint["done_codes"])
+        run_codes = [_c for _c in codes if _c not in done_codes]
+
+        fetch_times = []
+        compute_times = []
+        total_times = []
+        code_start_times = {}
+        s_time = time.time()
+        bar = tqdm(total=len(run_codes), desc="选股进度")
+
+        def code_done(_code: str, _res, _signal_rows=None):
+            checkpoint["done_codes"].append(_code)
+            if _signal_rows is not None:
+                checkpoint["signals"][_code] = _signal_rows
+            total_times.append(time.time() - code_start_times.pop(_code))
+            if _res is not None:
+                checkpoint["results"][_code] = _res
+                tqdm.write(f"{self.market} 选择 {_code} : {_res}")
+                if self.zx is not None:
+                    _stock = self.ex.stock_info(_code)
+                    self.zx.add_stock(
+                        self.zx_group, _code, _stock["name"] if _stock else None
+                    )
+            if len(checkpoint["done_codes"]) % self.checkpoint_interval == 0:
+                self.save_checkpoint(checkpoint)
+            bar.update(1)
+
+        # 同时在处理中的代码数量，避免获取的 K 线数据在内存中堆积
+        max_inflight = self.fetch_workers + self.compute_workers * 2
+        code_iter = iter(run_codes)
+        try:
+            with ThreadPoolExecutor(max_workers=self.fetch_workers) as fetch_executor:
+                with ProcessPoolExecutor(
+                    max_workers=self.compute_workers,
+                    mp_context=get_context("spawn"),
+                    initializer=_init_compute_worker,
+                    initargs=(self.market, self.cl_config, self.xg_fun, self.opt_type),
+                ) as compute_executor:
+                    fetch_futures = set()
+                    compute_futures = set()
+                    while True:
+                        # 补充行情获取的任务
+                        while len(fetch_futures) + len(compute_futures) < max_inflight:
+                            _code = next(code_iter, None)
+                            if _code is None:
+                                break
+                            code_start_times[_code] = time.time()
+                            fetch_futures.add(fetch_executor.submit(self._fetch_klines, _code))
+                        if len(fetch_futures) + len(compute_futures) == 0:
+                            break
+
+                        done, _ = wait(
+                            fetch_futures | compute_futures, return_when=FIRST_COMPLETED
+                        )
+                        for _f in done:
+                            if _f in fetch_futures:
+                                fetch_futures.remove(_f)
+                                _code, _klines, _use_time = _f.result()
+                                fetch_times.append(_use_time)
+                                if _klines is None:
+                                    code_done(_code, None)
+                                    continue
+                                compute_futures.add(
+                                    compute_executor.submit(_compute_xuangu, _code, _klines)
+                                )
+                            else:
+                                compute_futures.remove(_f)
+                                _code, _res, _rows, _error, _use_time = _f.result()
+                                compute_times.append(_use_time)
+                                if _error is not None:
+                                    tqdm.write(f"{self.market} 执行 {_code} 异常 ：{_error}")
+                                code_done(_code, _res, _rows)
+        except BaseException:
+            # 中断或异常退出，记录当前的进度，下次运行从这里继续
+            self.save_checkpoint(checkpoint)
+            raise
+        finally:
+            bar.close()
+
+        # 全部完成，保存信号表，删除检查点
+        signals = SignalTable(self.market, self.frequencys)
+        for _code, _rows in checkpoint.get("signals", {}).items():
+            signals.add(_code, _rows)
+        signals.save(self.signal_name)
+        self.clear_checkpoint()
+
+        total_seconds = time.time() - s_time
+        stats = {
+            "fetch": self._stage_stats(fetch_times, total_seconds),
+            "compute": self._stage_stats(compute_times, total_seconds),
+            "total": self._stage_stats(total_times, total_seconds),
+        }
+        for _stage, _s in stats.items():
+            tqdm.write(
+                f"{self.market} 选股 {_stage} : {_s['nums']} 个代码，{_s['codes_per_sec']:.2f} 个/秒，"
+                f"p50 {_s['p50']:.3f}s，p99 {_s['p99']:.3f}s"
+            )
+        return {"results": checkpoint["results"], "signals": signals, "stats": stats}
@@ -0,0 +1,473 @@
+import pickle
+from typing import Callable, Dict, List, Union
+
+import numpy as np
+import pandas as pd
+
+from chanlun.cl_interface import ICL, LINE, CLKline, Kline
+from chanlun.config import get_data_path
+from chanlun.file_db import FileCacheDB
+
+"""
+选股信号表
+
+缠论计算完成后，提取每个代码每个周期的关键信号（最后的笔、线段、中枢、MACD、均线等）为一行数据，
+全市场的信号行组成列式的表格（每个周期一个 DataFrame，索引为代码）
+选股条件在整个表格上进行向量化的过滤，更换选股条件重新选股，不需要再重新获取行情和计算缠论数据
+
+买卖点与背驰使用位掩码记录，例如 bi_mmds & mmd_mask(['1buy', '2buy']) != 0 表示最后一笔有一买或二买
+"""
+
+# 买卖点与背驰的名称，顺序不能修改（对应位掩码中的位置）
+MMD_NAMES = [
+    "1buy",
+    "2buy",
+    "3buy",
+    "l2buy",
+    "l3buy",
+    "1sell",
+    "2sell",
+    "3sell",
+    "l2sell",
+    "l3sell",
+]
+BC_NAMES = ["bi", "xd", "zsd", "pz", "qs"]
+
+# 记录的均线周期
+MA_PERIODS = [5, 10, 20, 60, 120, 250]
+
+
+def mmd_mask(names: List[str]) -> int:
+    """
+    买卖点名称列表转换为位掩码
+    """
+    return sum([1 << MMD_NAMES.index(_n) for _n in names if _n in MMD_NAMES])
+
+
+def bc_mask(names: List[str]) -> int:
+    """
+    背驰类型列表转换为位掩码
+    """
+    return sum([1 << BC_NAMES.index(_n) for _n in names if _n in BC_NAMES])
+
+
+def _line_signal(prefix: str, line: Union[LINE, None]) -> dict:
+    """
+    提取线（笔 or 线段）的信号
+    """
+    if line is None:
+        return {
+            f"{prefix}_index": -1,
+            f"{prefix}_type": "",
+            f"{prefix}_done": False,
+            f"{prefix}_high": np.nan,
+            f"{prefix}_low": np.nan,
+            f"{prefix}_mmds": 0,
+            f"{prefix}_mmds_all": 0,
+            f"{prefix}_bcs": 0,
+            f"{prefix}_bcs_all": 0,
+        }
+    row = {
+        f"{prefix}_index": int(line.index),
+        f"{prefix}_type": line.type,
+        f"{prefix}_done": bool(line.is_done()),
+        f"{prefix}_high": float(line.high),
+        f"{prefix}_low": float(line.low),
+        # 默认中枢类型的买卖点与背驰
+        f"{prefix}_mmds": mmd_mask(line.line_mmds()),
+        f"{prefix}_bcs": bc_mask(line.line_bcs()),
+        # 所有中枢类型的买卖点与背驰合集
+        f"{prefix}_mmds_all": mmd_mask(line.line_mmds("|")),
+        f"{prefix}_bcs_all": bc_mask(line.line_bcs("|")),
+    }
+    return row
+
+
+def _kline_signal(prefix: str, kline: Union[Kline, CLKline, None]) -> dict:
+    """
+    提取 K 线的信号
+    """
+    if kline is None:
+        return {
+            f"{prefix}_date": "",
+            f"{prefix}_o": np.nan,
+            f"{prefix}_h": np.nan,
+            f"{prefix}_l": np.nan,
+            f"{prefix}_c": np.nan,
+        }
+    return {
+        f"{prefix}_date": str(kline.date),
+        f"{prefix}_o": float(kline.o),
+        f"{prefix}_h": float(kline.h),
+        f"{prefix}_l": float(kline.l),
+        f"{prefix}_c": float(kline.c),
+    }
+
+
+def extract_signal_row(cd: ICL) -> dict:
+    """
+    提取缠论数据的信号行，值都是 python 的基础类型，可以 pickle 与 json 序列化
+    """
+    klines = cd.get_src_klines()
+    bis = cd.get_bis()
+    xds = cd.get_xds()
+    bi_zss = cd.get_bi_zss()
+
+    bi = bis[-1] if len(bis) > 0 else None
+    xd = xds[-1] if len(xds) > 0 else None
+    bi_zs = bi_zss[-1] if len(bi_zss) > 0 else None
+
+    row = {
+        "frequency": cd.get_frequency(),
+        "bi_nums": len(bis),
+        "xd_nums": len(xds),
+        "bi_zs_nums": len(bi_zss),
+    }
+
+    # 最后的原始 K 线与缠论 K 线（包含处理后）
+    cl_klines = cd.get_klines()
+    row.update(_kline_signal("k", klines[-1] if len(klines) > 0 else None))
+    row.update(_kline_signal("cl_k", cl_klines[-1] if len(cl_klines) > 0 else None))
+
+    row.update(_line_signal("bi", bi))
+    row.update(_line_signal("xd", xd))
+
+    # 最后一笔的买卖点，所有中枢类型中，对应中枢的最小笔数量（没有该买卖点为 nan）
+    for _name in MMD_NAMES:
+        row[f"bi_{_name}_zs_line_num"] = np.nan
+    if bi is not None:
+        for _mmds in bi.zs_type_mmds.values():
+            for _m in _mmds:
+                _key = f"bi_{_m.name}_zs_line_num"
+                if _key in row and not (row[_key] <= _m.zs.line_num):
+                    row[_key] = float(_m.zs.line_num)
+
+    # 最后的笔中枢
+    if bi_zs is not None:
+        row.update(
+            {
+                "bi_zs_type": bi_zs.type,
+                "bi_zs_done": bool(bi_zs.done),
+                "bi_zs_zg": float(bi_zs.zg),
+                "bi_zs_zd": float(bi_zs.zd),
+                "bi_zs_gg": float(bi_zs.gg),
+                "bi_zs_dd": float(bi_zs.dd),
+                "bi_zs_line_num": int(bi_zs.line_num),
+                "bi_zs_zf": float(bi_zs.zf()),
+                # 最后线段的起始，是否是最后笔中枢的起始
+                "xd_start_is_bi_zs_start": bool(
+                    xd is not None
+                    and len(bi_zs.lines) > 0
+                    and xd.start.index == bi_zs.lines[0].start.index
+                ),
+            }
+        )
+    else:
+        row.update(
+            {
+                "bi_zs_type": "",
+                "bi_zs_done": False,
+                "bi_zs_zg": np.nan,
+                "bi_zs_zd": np.nan,
+                "bi_zs_gg": np.nan,
+                "bi_zs_dd": np.nan,
+                "bi_zs_line_num": 0,
+                "bi_zs_zf": np.nan,
+                "xd_start_is_bi_zs_start": False,
+            }
+        )
+
+    # MACD
+    macd = cd.get_idx()["macd"]
+    for _key in ["dif", "dea", "hist"]:
+        row[f"macd_{_key}"] = float(macd[_key][-1]) if len(macd[_key]) > 0 else np.nan
+
+    # 均线
+    closes = np.array([_k.c for _k in klines[-max(MA_PERIODS) :]], dtype=float)
+    for _p in MA_PERIODS:
+        row[f"ma{_p}"] = float(closes[-_p:].mean()) if len(closes) >= _p else np.nan
+
+    return row
+
+
+def extract_signal_rows(cl_datas: List[ICL]) -> List[dict]:
+    """
+    提取多个周期缠论数据的信号行
+    """
+    return [extract_signal_row(_cd) for _cd in cl_datas]
+
+
+class SignalTable(object):
+    """
+    全市场的选股信号表
+    """
+
+    def __init__(self, market: str, frequencys: List[str]):
+        self.market = market
+        self.frequencys = [_f for _f in frequencys if _f != ""]
+        self.rows: Dict[str, List[dict]] = {}
+        self._levels: Union[List[pd.DataFrame], None] = None
+
+    def add(self, code: str, rows: List[dict]):
+        """
+        添加代码的信号行（extract_signal_rows 的返回）
+        """
+        self.rows[code] = rows
+        self._levels = None
+
+    def add_cl_datas(self, code: str, cl_datas: List[ICL]):
+        self.add(code, extract_signal_rows(cl_datas))
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def levels(self) -> List[pd.DataFrame]:
+        """
+        每个周期的信号表格，索引为代码
+        """
+        if self._levels is None:
+            codes = list(self.rows.keys())
+            self._levels = []
+            for i in range(len(self.frequencys)):
+                self._levels.append(
+                    pd.DataFrame(
+                        [self.rows[_c][i] for _c in codes],
+                        index=pd.Index(codes, name="code"),
+                    )
+                )
+        return self._levels
+
+    def __getitem__(self, i: int) -> pd.DataFrame:
+        return self.levels[i]
+
+    def select(self, sg_fun: Callable, opt_type: list = None) -> pd.DataFrame:
+        """
+        执行向量化的选股条件
+        :param sg_fun: 本模块中 sg_ 开头的选股方法
+        :param opt_type: 选股方法的 opt_type 参数，None 则不传递
+        :return: 选中的代码与信息 DataFrame (code, msg)
+        """
+        if len(self.rows) == 0:
+            return pd.DataFrame(columns=["code", "msg"])
+        if opt_type is None:
+            return sg_fun(self)
+        return sg_fun(self, opt_type)
+
+    @staticmethod
+    def file_path(name: str):
+        path = get_data_path() / "xuangu_signal"
+        if path.is_dir() is False:
+            path.mkdir()
+        return path / f"{name}.pkl"
+
+    def save(self, name: str):
+        FileCacheDB.write_pkl_file(
+            self.file_path(name),
+            {
+                "market": self.market,
+                "frequencys": self.frequencys,
+                "rows": self.rows,
+            },
+        )
+        return True
+
+    @classmethod
+    def load(cls, name: str) -> Union["SignalTable", None]:
+        file = cls.file_path(name)
+        if file.is_file() is False:
+            return None
+        with open(file, "rb") as fp:
+            data = pickle.load(fp)
+        table = cls(data["market"], data["frequencys"])
+        table.rows = data["rows"]
+        return table
+
+
+def _opt_types(opt_type: list):
+    from chanlun.xuangu.xuangu import get_opt_types
+
+    return get_opt_types(opt_type)
+
+
+def _result(df: pd.DataFrame, cond: pd.Series, msg) -> pd.DataFrame:
+    """
+    根据过滤条件生成选股结果，msg 可以是字符串或与 df 对齐的 Series
+    """
+    cond = cond.fillna(False).astype(bool)
+    res = pd.DataFrame({"code": df.index[cond.values]})
+    if isinstance(msg, pd.Series):
+        res["msg"] = msg[cond].values
+    else:
+        res["msg"] = msg
+    return res
+
+
+def _mmd_names(mask: pd.Series) -> pd.Series:
+    return mask.map(
+        lambda _m: str([_n for i, _n in enumerate(MMD_NAMES) if _m & (1 << i)])
+    )
+
+
+def _bc_names(mask: pd.Series) -> pd.Series:
+    return mask.map(
+        lambda _m: str([_n for i, _n in enumerate(BC_NAMES) if _m & (1 << i)])
+    )
+
+
+def sg_single_xd_and_bi_mmd(table: SignalTable, opt_type: list = []):
+    """
+    线段和笔都有出现买点（同 xuangu.xg_single_xd_and_bi_mmd）
+    """
+    opt_direction, opt_mmd = _opt_types(opt_type)
+    df = table[0]
+    mask = mmd_mask(opt_mmd)
+    cond = (
+        (df["xd_nums"] > 0)
+        & (df["bi_nums"] > 0)
+        & ((df["xd_mmds_all"] & mask) != 0)
+        & ((df["bi_mmds_all"] & mask) != 0)
+    )
+    msg = (
+        "线段买点 【"
+        + _mmd_names(df["xd_mmds_all"])
+        + "】 笔买点【"
+        + _mmd_names(df["bi_mmds_all"])
+        + "】"
+    )
+    return _result(df, cond, msg)
+
+
+def sg_multiple_xd_bi_mmd(table: SignalTable, opt_type: list = []):
+    """
+    高级别线段买点或背驰，并且次级别笔买点或背驰（同 xuangu.xg_multiple_xd_bi_mmd）
+    """
+    opt_direction, opt_mmd = _opt_types(opt_type)
+    high = table[0]
+    low = table[1]
+    mmd = mmd_mask(opt_mmd)
+    bc = bc_mask(["pz", "qs"])
+    cond = (
+        (high["xd_nums"] > 0)
+        & (high["bi_nums"] > 0)
+        & (low["xd_nums"] > 0)
+        & (low["bi_nums"] > 0)
+        & high["xd_type"].isin(opt_direction)
+        & low["bi_type"].isin(opt_direction)
+        & (((high["xd_mmds_all"] & mmd) != 0) | ((high["xd_bcs_all"] & bc) != 0))
+        & (((low["bi_mmds_all"] & mmd) != 0) | ((low["bi_bcs_all"] & bc) != 0))
+    )
+    msg = (
+        high["frequency"]
+        + " 线段买点【"
+        + _mmd_names(high["xd_mmds_all"])
+        + "】背驰【"
+        + _bc_names(high["xd_bcs_all"])
+        + "】 "
+        + low["frequency"]
+        + " 笔买点【"
+        + _mmd_names(low["bi_mmds_all"])
+        + "】背驰【"
+        + _bc_names(low["bi_bcs_all"])
+        + "】"
+    )
+    return _result(high, cond, msg)
+
+
+def sg_single_xd_bi_zs_zf_5(table: SignalTable):
+    """
+    上涨线段的第一个笔中枢，突破笔中枢，大涨 5% 以上（同 xuangu.xg_single_xd_bi_zs_zf_5，使用缠论 K 线）
+    """
+    df = table[0]
+    cond = (
+        (df["xd_type"] == "up")
+        & df["xd_start_is_bi_zs_start"]
+        & (df["cl_k_h"] > df["bi_zs_zg"])
+        & (df["bi_zs_zg"] >= df["cl_k_l"])
+        & ((df["cl_k_c"] - df["cl_k_o"]) / df["cl_k_o"] > 0.05)
+    )
+    return _result(df, cond, "线段向上，当前K线突破中枢高点，并且涨幅大于 5% 涨幅")
+
+
+def _sg_single_bi_mmd(table: SignalTable, opt_type: list, mmd: str, msg: str):
+    opt_direction, opt_mmd = _opt_types(opt_type)
+    df = table[0]
+    cond = (
+        (df["bi_nums"] > 0)
+        & df["bi_type"].isin(opt_direction)
+        & (df[f"bi_{mmd}_zs_line_num"] < 9)
+    )
+    return _result(df, cond, df["frequency"] + msg)
+
+
+def sg_single_bi_1mmd(table: SignalTable, opt_type: list = []):
+    """
+    笔的一类买卖点（同 xuangu.xg_single_bi_1mmd）
+    """
+    return _sg_single_bi_mmd(table, opt_type, "1buy", " 出现本级别笔一买")
+
+
+def sg_single_bi_2mmd(table: SignalTable, opt_type: list = []):
+    """
+    笔的二类买卖点（同 xuangu.xg_single_bi_2mmd）
+    """
+    return _sg_single_bi_mmd(table, opt_type, "2buy", " 出现本级别笔二买")
+
+
+def sg_single_bi_3mmd(table: SignalTable, opt_type: list = []):
+    """
+    笔的三类买卖点（同 xuangu.xg_single_bi_3mmd）
+    """
+    return _sg_single_bi_mmd(table, opt_type, "3buy", " 出现本级别笔三买")
+
+
+def sg_multiple_zs_tupo_low_3buy(table: SignalTable):
+    """
+    高级别中枢突破，在低级别有三买（同 xuangu.xg_multiple_zs_tupo_low_3buy）
+    """
+    high = table[0]
+    low = table[len(table.frequencys) - 1]
+    cond = (
+        (high["bi_zs_nums"] > 0)
+        & ~high["bi_zs_done"]
+        & (high["bi_zs_line_num"] >= 9)
+        & (high["bi_zs_zf"] > 50)
+        & ~(high["macd_dif"] < 0)
+        & ~(high["macd_dea"] < 0)
+        & (low["bi_nums"] > 0)
+        & ((low["bi_mmds"] & mmd_mask(["3buy"])) != 0)
+    )
+    return _result(
+        high, cond, high["frequency"] + " 中枢有可能突破，低级别出现三买，进行关注"
+    )
+
+
+def sg_single_ma_250(table: SignalTable, opt_type: list = []):
+    """
+    最新价格在 ma 250 线的上下（同 xuangu.xg_single_ma_250）
+    """
+    opt_direction, opt_mmd = _opt_types(opt_type)
+    df = table[0]
+    up = df["k_c"] > df["ma250"]
+    down = df["k_c"] < df["ma250"]
+    res = []
+    if "up" in opt_direction:
+        res.append(_result(df, up, "最新价格高于250日均线"))
+    if "down" in opt_direction:
+        res.append(_result(df, down, "最新价格低于250日均线"))
+    if len(res) == 0:
+        return pd.DataFrame(columns=["code", "msg"])
+    return pd.concat(res, ignore_index=True)
+
+
+# xuangu 模块的选股方法，对应的向量化选股方法
+signal_xuangu_funcs: Dict[str, Callable] = {
+    "xg_single_xd_and_bi_mmd": sg_single_xd_and_bi_mmd,
+    "xg_multiple_xd_bi_mmd": sg_multiple_xd_bi_mmd,
+    "xg_single_xd_bi_zs_zf_5": sg_single_xd_bi_zs_zf_5,
+    "xg_single_bi_1mmd": sg_single_bi_1mmd,
+    "xg_single_bi_2mmd": sg_single_bi_2mmd,
+    "xg_single_bi_3mmd": sg_single_bi_3mmd,
+    "xg_multiple_zs_tupo_low_3buy": sg_multiple_zs_tupo_low_3buy,
+    "xg_single_ma_250": sg_single_ma_250,
+}
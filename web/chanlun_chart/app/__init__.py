@@ -6,7 +6,6 @@ import time
 import traceback
 from flask_login import LoginManager, UserMixin, login_required, login_user
 
-import pinyin
 import pytz
 from apscheduler.events import (
     EVENT_ALL,
@@ -34,18 +33,19 @@ from chanlun import fun, config
 from chanlun.cl_utils import (
     kcharts_frequency_h_l_map,
     query_cl_chart_config,
-    web_batch_get_cl_datas,
     cl_data_to_tv_chart,
     set_cl_chart_config,
     del_cl_chart_config,
 )
 from chanlun.db import db
 from chanlun.exchange import get_exchange
+from chanlun.file_db import web_cl_cache
 from chanlun.config import get_data_path
 from chanlun.zixuan import ZiXuan
 from .alert_tasks import AlertTasks
 from .xuangu_tasks import XuanguTasks
 from .other_tasks import OtherTasks
+from .symbol_search import SymbolSearch
 
 
 def create_app(test_config=None):
@@ -182,6 +182,8 @@ def create_app(test_config=None):
 
     _other_tasks = OtherTasks(scheduler)
 
+    _symbol_search = SymbolSearch(scheduler)
+
     __log = fun.get_logger()
 
     # create and configure the app
@@ -376,23 +378,8 @@ def create_app(test_config=None):
         exchange = request.args.get("exchange")
         limit = request.args.get("limit")
 
-        ex = get_exchange(Market(exchange))
-        all_stocks = ex.all_stocks()
-
-        if exchange in ["us", "currency", "currency_spot"]:
-            res_stocks = [
-                stock for stock in all_stocks if query.lower() in stock["code"].lower()
-            ]
-        else:
-            res_stocks = [
-                stock
-                for stock in all_stocks
-                if query.lower() in stock["code"].lower()
-                or query.lower() in stock["name"].lower()
-                or query.lower()
-                in "".join([pinyin.get_initial(_p)[0] for _p in stock["name"]]).lower()
-            ]
-        res_stocks = res_stocks[0 : int(limit)]
+        # 使用预先构建的索引检索（us、currency、currency_spot 只检索代码）
+        res_stocks = _symbol_search.search(exchange, query, int(limit))
 
         infos = []
         for stock in res_stocks:
@@ -484,27 +471,25 @@ def create_app(test_config=None):
         ):
             # 如果开启并设置的该级别的低级别数据，获取低级别数据，并在转换成高级图表展示
             # s_time = time.time()
+            cl_frequency = frequency_low
             klines = ex.klines(code, frequency_low)
             # __log.info(f'{code} - {frequency_low} enable low to high get klines time : {time.time() - s_time}')
-            # s_time = time.time()
-            cd = web_batch_get_cl_datas(
-                market, code, {frequency_low: klines}, cl_config
-            )[0]
-            # __log.info(f'{code} - {frequency_low} enable low to high get cd time : {time.time() - s_time}')
         else:
             kchart_to_frequency = None
             # s_time = time.time()
+            cl_frequency = frequency
             klines = ex.klines(code, frequency)
             # __log.info(f'{code} - {frequency} get klines time : {time.time() - s_time}')
-            # s_time = time.time()
-            cd = web_batch_get_cl_datas(market, code, {frequency: klines}, cl_config)[0]
-            # __log.info(f'{code} - {frequency} get cd time : {time.time() - s_time}')
 
-        # 将缠论数据，转换成 tv 画图的坐标数据
+        # 计算缠论数据，并转换成 tv 画图的坐标数据
+        # 缓存中的缠论对象是多个请求共享的，在持有锁的期间转换，避免其他请求同时增量计算
         # s_time = time.time()
-        cl_chart_data = cl_data_to_tv_chart(
-            cd, cl_config, to_frequency=kchart_to_frequency
-        )
+        with web_cl_cache.hold_web_cl_data(
+            market, code, cl_frequency, cl_config, klines
+        ) as cd:
+            cl_chart_data = cl_data_to_tv_chart(
+                cd, cl_config, to_frequency=kchart_to_frequency
+            )
         # __log.info(f'{code} - {frequency} to tv chart data time : {time.time() - s_time}')
 
         info = {
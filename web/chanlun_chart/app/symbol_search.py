@@ -0,0 +1,143 @@
+from typing import Dict, List
+
+import pinyin
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from chanlun import fun
+from chanlun.base import Market
+from chanlun.exchange import get_exchange
+
+"""
+图表的商品检索（/tv/search）索引
+
+之前每次检索都遍历市场的所有股票，并对每个股票名称的每个字逐个转换拼音首字母
+这里每个市场在第一次检索时，根据 all_stocks 构建一次索引：
+    每个股票的检索字段（小写的代码、名称、名称拼音首字母）预先计算，
+    字段中所有长度 1~3 的子串（n-gram）对应包含它的股票序号列表（按照 all_stocks 的顺序）
+检索时，长度不超过 3 的查询直接返回子串对应的列表，更长的查询使用其中股票数量最少的三元组作为候选，再检查是否包含查询
+检索的结果与之前遍历的结果（包括顺序）相同
+"""
+
+log = fun.get_logger()
+
+
+class SymbolIndex:
+    """
+    一个市场的商品检索索引
+    """
+
+    def __init__(self, stocks: List[dict], code_only: bool = False):
+        """
+        :param stocks: 市场的所有股票（all_stocks 的返回）
+        :param code_only: 是否只检索代码
+        """
+        self.stocks = stocks
+        self.size = len(stocks)
+        # 每个股票的检索字段
+        self.fields: List[List[str]] = []
+        # 子串 : 包含子串的股票序号列表
+        self.grams: Dict[str, List[int]] = {}
+
+        for _i, stock in enumerate(stocks):
+            fields = [stock["code"].lower()]
+            if not code_only:
+                fields.append(stock["name"].lower())
+                fields.append(
+                    "".join([pinyin.get_initial(_p)[0] for _p in stock["name"]]).lower()
+                )
+            self.fields.append(fields)
+
+            grams = set()
+            for _f in fields:
+                for _n in range(1, 4):
+                    for _s in range(len(_f) - _n + 1):
+                        grams.add(_f[_s : _s + _n])
+            for _g in grams:
+                self.grams.setdefault(_g, []).append(_i)
+
+    def search(self, query: str, limit: int) -> List[dict]:
+        """
+        检索代码、名称或拼音首字母包含查询的股票
+        :param query: 查询（不区分大小写）
+        :param limit: 返回的最大数量
+        """
+        query = query.lower()
+        if len(query) == 0:
+            return self.stocks[0:limit]
+        if len(query) <= 3:
+            return [self.stocks[_i] for _i in self.grams.get(query, [])[0:limit]]
+
+        postings = []
+        for _s in range(len(query) - 2):
+            _posting = self.grams.get(query[_s : _s + 3])
+            if _posting is None:
+                return []
+            postings.append(_posting)
+        res_stocks = []
+        for _i in min(postings, key=len):
+            if any(query in _f for _f in self.fields[_i]):
+                res_stocks.append(self.stocks[_i])
+                if 0 < limit <= len(res_stocks):
+                    break
+        return res_stocks[0:limit]
+
+
+class SymbolSearch:
+    """
+    每个市场的商品检索索引，第一次检索时构建，每天定时重新构建
+    """
+
+    # 只检索代码的市场
+    code_only_markets = ["us", "currency", "currency_spot"]
+
+    def __init__(self, scheduler: BackgroundScheduler):
+        self.scheduler = scheduler
+
+        self.indexs: Dict[str, SymbolIndex] = {}
+
+        self.run_task()
+
+    def run_task(self):
+        # 每天 9 点重新构建已经使用的市场索引
+        self.scheduler.add_job(
+            self.refresh,
+            trigger="cron",
+            hour=9,
+            minute=0,
+            id="refresh_symbol_search",
+            name="每天9点更新商品检索索引",
+        )
+
+    def build(self, market: str) -> SymbolIndex:
+        ex = get_exchange(Market(market))
+        return SymbolIndex(
+            ex.all_stocks(), code_only=market in self.code_only_markets
+        )
+
+    def index(self, market: str) -> SymbolIndex:
+        """
+        获取市场的检索索引，没有或者市场的股票列表有变化，则重新构建
+        """
+        index = self.indexs.get(market)
+        if index is not None:
+            stocks = get_exchange(Market(market)).all_stocks()
+            if stocks is not index.stocks or len(stocks) != index.size:
+                index = None
+        if index is None:
+            index = self.build(market)
+            self.indexs[market] = index
+        return index
+
+    def search(self, market: str, query: str, limit: int) -> List[dict]:
+        return self.index(market).search(query, limit)
+
+    def refresh(self):
+        """
+        重新构建已经使用的市场索引（构建完成后替换，检索不受影响）
+        """
+        for market in list(self.indexs.keys()):
+            try:
+                self.indexs[market] = self.build(market)
+            except Exception as e:
+                log.error(f"{market} 更新商品检索索引异常：{e}")
+        return True
@@ -7,8 +7,9 @@ from chanlun import fun
 from chanlun import utils
 from chanlun.exchange import Market, get_exchange
 from chanlun.xuangu import xuangu
+from chanlun.xuangu.xuangu_scanner import XuanguScanner
 from tqdm.auto import tqdm
-from chanlun.cl_utils import query_cl_chart_config, web_batch_get_cl_datas
+from chanlun.cl_utils import query_cl_chart_config
 
 log = fun.get_logger()
 
@@ -96,22 +97,15 @@ def process_xuangu_task(
 
         cl_config = query_cl_chart_config(market, "----")
         tqdm.write(f"{market} {task_name} 选股任务开始，选股代码数量 {len(run_codes)}")
-        zx.clear_zx_stocks(to_zx_group)
-        for _c in tqdm(run_codes, desc="选股进度"):
-            try:
-                klines = {_f: ex.klines(_c, _f) for _f in freqs if _f != ""}
-                if len(klines) == 0:
-                    continue
-                if min([len(_k) for _k in klines.values()]) == 0:
-                    continue
-                cds = web_batch_get_cl_datas(market, _c, klines, cl_config)
-
-                res = xuangu_task_configs[task_name]["task_fun"](cds, opt_type)
-                if res is not None:
-                    tqdm.write(f"{market} {task_name} 选择 {_c} : {res}")
-                    zx.add_stock(to_zx_group, _c, None)
-            except Exception as e:
-                tqdm.write(f"{market} {task_name} 执行 {_c} 异常 ：{e}")
+        # 中断后再次执行，会从上次的检查点继续
+        XuanguScanner(
+            market,
+            xuangu_task_configs[task_name]["task_fun"],
+            freqs,
+            cl_config,
+            opt_type=opt_type,
+            zx_group=to_zx_group,
+        ).run(run_codes)
         xg_stocks = zx.zx_stocks(to_zx_group)
         utils.send_fs_msg(
             market,